@@ -0,0 +1,56 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+# Number of set bits in each byte value.
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Number of packed masks counted at a time.
+COUNT_CHUNK_SIZE = 256
+
+def echogramActivity(bgs_data):
+    """
+    Returns the number of foreground bins in each frame (row) of a background subtracted echogram.
+    """
+    return np.count_nonzero(bgs_data, axis=1)
+
+def packedMaskActivity(packed):
+    """
+    Returns the number of foreground pixels in each bit-packed mask (row) of packed.
+    """
+    counts = np.zeros(len(packed), dtype=np.int64)
+    for start in range(0, len(packed), COUNT_CHUNK_SIZE):
+        chunk = np.asarray(packed[start:start + COUNT_CHUNK_SIZE])
+        counts[start:start + len(chunk)] = np.sum(POPCOUNT_TABLE[chunk], axis=1, dtype=np.int64)
+    return counts
+
+def candidateFrames(activity, threshold, padding):
+    """
+    Marks frames where activity is at least threshold as candidates, and extends each
+    candidate window by padding frames in both directions.
+    Returns a boolean array.
+    """
+    active = np.asarray(activity) >= threshold
+    if padding <= 0 or not np.any(active):
+        return active
+
+    # Dilation with a window of 2 * padding + 1 frames.
+    kernel = np.ones(2 * padding + 1, dtype=np.int64)
+    return np.convolve(active.astype(np.int64), kernel, mode="same") > 0
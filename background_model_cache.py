@@ -0,0 +1,117 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+import file_handler as fh
+from log_object import LogObject
+
+CACHE_DIRECTORY_NAME = "background_models"
+
+class BackgroundModelCache:
+    """
+    Disk cache for trained background models. Each entry is a set of named arrays.
+
+    Batch models (see batch_background) are stored directly: the background (and variance) arrays
+    and the foreground occupancy, so restoring replaces training.
+    OpenCV does not expose the internal state (mixture weights, means and variances) of MOG2,
+    so for MOG2 the cache stores the frames the model was trained with, exactly as they were fed to
+    the model. Replaying them results in an identical model (MOG2 is deterministic), while
+    skipping the reading, decoding and remapping of the training frames.
+
+    Entries are identified with a key, e.g. (file identity, PolarTransform geometry, MOGParameters),
+    and the total size of the cache is limited by the bg_model_cache_limit value (MB) in the conf file.
+    Least recently used entries are removed first.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory if directory is not None else fh.getFilePathInAppData(CACHE_DIRECTORY_NAME)
+
+    def isEnabled(self):
+        return fh.getConfValue(fh.ConfKeys.bg_model_cache_limit) > 0
+
+    def getPath(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + ".npz")
+
+    def load(self, key):
+        """
+        Returns the arrays stored with the key as a dictionary, or None if not found.
+        image_shape is the shape of the original (uncropped) images as a tuple.
+        """
+        if key is None or not self.isEnabled():
+            return None
+
+        path = self.getPath(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                if str(data["key"]) != repr(key):
+                    return None
+                arrays = { name: data[name] for name in data.files if name != "key" }
+                arrays["image_shape"] = tuple(int(v) for v in arrays["image_shape"])
+            os.utime(path)
+            return arrays
+        except (OSError, ValueError, KeyError) as e:
+            LogObject().print2(f"Could not read background model cache file {path}: {e}")
+            return None
+
+    def save(self, key, image_shape, **arrays):
+        """
+        Stores the arrays (e.g. frames, or background and occupancy) and the shape of the original
+        images with the key, and removes old entries exceeding the size limit.
+        """
+        if key is None or not self.isEnabled() or any(len(a) == 0 for a in arrays.values()):
+            return
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.getPath(key)
+            np.savez_compressed(path, key=np.array(repr(key)), image_shape=np.array(image_shape), **arrays)
+            LogObject().print2(f"Background model cached: {path}")
+            self.removeOldEntries()
+        except OSError as e:
+            LogObject().print2(f"Could not write background model cache: {e}")
+
+    def removeOldEntries(self):
+        limit = fh.getConfValue(fh.ConfKeys.bg_model_cache_limit) * 1024 * 1024
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        # Newest first
+        entries.sort(reverse=True)
+        total = 0
+        for _, size, path in entries:
+            total += size
+            if total > limit:
+                os.remove(path)
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
@@ -17,13 +17,67 @@ You should have received a copy of the GNU General Public License
 along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import collections
+import os
 import numpy as np
 import cv2
 from math import floor
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5 import QtCore
 
 from log_object import LogObject
 from mog_parameters import MOGParameters
+from background_model_cache import BackgroundModelCache
+from batch_background import BatchBackgroundModel, MOG2_MODEL, downscale
+from binary_median import binaryMedian
+
+# Number of threads remapping training frames in initMOG.
+PREFETCH_THREADS = min(8, os.cpu_count() or 1)
+
+def getTrainingIndices(nof_frames, nof_bg_frames):
+    """
+    Returns the indices of the frames used to create the background model.
+    Frames are spread evenly over the whole file.
+    """
+    nof_bg_frames = min(nof_frames, nof_bg_frames)
+    if nof_bg_frames <= 0:
+        return []
+
+    # Count step based on number of frames
+    step = nof_frames / nof_bg_frames
+    return [floor(i * step) for i in range(nof_bg_frames)]
+
+def createMOG(mog_parameters: MOGParameters):
+    """
+    Returns an untrained background subtractor configured with mog_parameters:
+    OpenCV MOG2 or one of the batch models in batch_background (bg_model).
+    """
+    data = mog_parameters.data
+    if data.bg_model != MOG2_MODEL:
+        return BatchBackgroundModel(data.bg_model, data.bg_percentile, data.bg_threshold, data.mog_var_thresh, data.training_scale)
+
+    fgbg_mog = cv2.createBackgroundSubtractorMOG2()
+    fgbg_mog.setNMixtures(mog_parameters.data.mixture_count)
+    fgbg_mog.setVarThreshold(mog_parameters.data.mog_var_thresh)
+    fgbg_mog.setShadowValue(0)
+    if data.training_scale < 1:
+        return ScaledBackgroundModel(fgbg_mog, data.training_scale)
+    return fgbg_mog
+
+class ScaledBackgroundModel:
+    """
+    Runs a MOG2 model at reduced resolution. Frames are downscaled before they are
+    passed to the model and the foreground masks are upscaled back to the frame size.
+    """
+    def __init__(self, model, scale):
+        self.model = model
+        self.scale = scale
+
+    def apply(self, image, learningRate=-1):
+        fg_mask = self.model.apply(downscale(image, self.scale), learningRate=learningRate)
+        if fg_mask.shape != image.shape[:2]:
+            fg_mask = cv2.resize(fg_mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+        return fg_mask
 
 class BackgroundSubtractor(QtCore.QObject):
     """
@@ -57,6 +111,36 @@ class BackgroundSubtractor(QtCore.QObject):
         self.mog_parameters = None
         self.applied_mog_parameters = None
         self.resetParameters()
+
+        # Parameters (dict) used to train the current model.
+        self.trained_parameter_dict = None
+
+        # Number of training frames each pixel was foreground in, counted after the
+        # model has settled. Used to find static clutter (Detector.updateClutterMask).
+        self.occupancy = None
+        self.occupancy_count = 0
+
+        # Region of interest (CompiledRegion). If set, the model covers only the bounding box
+        # of the region and the pixels outside the region are always background.
+        self.region = None
+        self.trained_region = None
+
+        # Identity of the input (file and image geometry) used in the background model cache key.
+        # Set by the owner of the subtractor (Detector). If None, the model is not cached.
+        self.cache_identity = None
+        self.trained_cache_key = None
+        self.model_cache = BackgroundModelCache()
+
+        # [flag] Rolling update is in progress: frames are processed in order and update the model.
+        self.rolling_active = False
+
+        # [flag] Model has been updated after training (rolling update) and must be retrained
+        # before processing the frames again from the beginning.
+        self.model_modified = False
+
+        # Bounded sample of recently processed frames for re-snapshots, and the number of frames processed.
+        self.rolling_sample = None
+        self.rolling_count = 0
     
     def setParameter(self, key, value):
         if self.mog_parameters is not None:
@@ -75,7 +159,71 @@ class BackgroundSubtractor(QtCore.QObject):
     def resetParameters(self):
         self.setParameters(MOGParameters())
 
+    def setRegion(self, region):
+        """
+        Sets the region of interest (CompiledRegion or None) used when the model is trained next time.
+        """
+        self.region = region
+
+    def getRegionKey(self, region):
+        return None if region is None else region.key
+
+    def cropToRegion(self, image, region):
+        if region is None:
+            return image
+        return region.crop(image)
+
+    def expandFromRegion(self, fg_mask, region):
+        if region is None or fg_mask is None:
+            return fg_mask
+        return region.expand(fg_mask)
+
+    def setCacheIdentity(self, identity):
+        self.cache_identity = identity
+
+    def getCacheKey(self):
+        """
+        Returns the key identifying the model trained with the current input and parameters, or None.
+        """
+        if self.cache_identity is None:
+            return None
+        return (self.cache_identity, self.image_provider.getFrameCount(),
+                tuple(sorted(self.mog_parameters.getParameterDict().items())), self.getRegionKey(self.region))
+
+    def iterTrainingFrames(self, indices):
+        """
+        Yields the cartesian frames at indices in order. If the image provider exposes the
+        polar frames, the frames are read on the calling thread (file access is not thread-safe)
+        and remapped in a thread pool ahead of the consumer.
+        """
+        if not (hasattr(self.image_provider, "getPolarFrame") and hasattr(self.image_provider, "remapPolarFrame")) \
+                or PREFETCH_THREADS <= 1:
+            for ind in indices:
+                yield self.image_provider.getFrame(ind)
+            return
+
+        with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as executor:
+            pending = collections.deque()
+            try:
+                for ind in indices:
+                    polar = self.image_provider.getPolarFrame(ind)
+                    pending.append(executor.submit(self.image_provider.remapPolarFrame, polar))
+                    if len(pending) >= 2 * PREFETCH_THREADS:
+                        yield pending.popleft().result()
+                while len(pending) > 0:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
     def initMOG(self):
+        cache_key = self.getCacheKey()
+        if self.mog_ready and not self.model_modified and cache_key is not None and cache_key == self.trained_cache_key:
+            LogObject().print2("BG Subtractor already initialized with current parameters")
+            self.applied_mog_parameters = self.mog_parameters.copy()
+            self.state_changed_signal.emit()
+            return
+
         if hasattr(self.image_provider, "pausePolarLoading"):
             self.image_provider.pausePolarLoading(True)
 
@@ -85,42 +233,68 @@ class BackgroundSubtractor(QtCore.QObject):
         self.compute_on_event = True
         self.state_changed_signal.emit()
 
-        self.fgbg_mog = cv2.createBackgroundSubtractorMOG2()
-        self.fgbg_mog.setNMixtures(self.mog_parameters.data.mixture_count)
-        self.fgbg_mog.setVarThreshold(self.mog_parameters.data.mog_var_thresh)
-        self.fgbg_mog.setShadowValue(0)
-
-        nof_frames = self.image_provider.getFrameCount()
-        nof_bg_frames = min(nof_frames, self.mog_parameters.data.nof_bg_frames)
-
-        # Create background model from fixed number of frames.
-        # Count step based on number of frames
-        step = nof_frames / nof_bg_frames
+        self.fgbg_mog = createMOG(self.mog_parameters)
+        self.trained_parameter_dict = None
+        self.occupancy = None
+        self.occupancy_count = 0
+        self.trained_region = None
+        self.trained_cache_key = None
+        self.model_modified = False
+
+        training_indices = self.getTrainingIndices()
+        occupancy_start = len(training_indices) // 2
+        batch_model = isinstance(self.fgbg_mog, BatchBackgroundModel)
+
+        # Batch models are restored from the cache directly. For MOG2, whose state OpenCV does not
+        # expose, the cached training frames are replayed. Otherwise the model is trained and cached.
+        cached = self.model_cache.load(cache_key)
+        cached_frames = None
+        if cached is not None and batch_model and "background" in cached:
+            self.fgbg_mog.setState(cached["background"], cached.get("variance"))
+            occupancy = cached["occupancy"]
+            image_shape = cached["image_shape"]
+            LogObject().print1("Background model read from cache.")
+        else:
+            if cached is not None and not batch_model and len(cached.get("frames", [])) == len(training_indices):
+                cached_frames = cached["frames"]
+                LogObject().print1("Background model training frames read from cache.")
+            store = cached_frames is None and cache_key is not None and self.model_cache.isEnabled()
 
-        for i in range(nof_bg_frames):
-            ind = floor(i * step)
-            
-            if self.stop_initializing:
-                LogObject().print2("Stopped initializing (BG subtraction) at", ind)
+            trained = self.trainModel(training_indices, cached_frames, store and not batch_model)
+            if trained is None:
                 self.stop_initializing = False
                 self.mog_ready = False
                 self.initializing = False
                 self.applied_mog_parameters = None
                 self.state_changed_signal.emit()
                 return
-
-            image_o = self.image_provider.getFrame(ind)
-            self.fgbg_mog.apply(image_o, learningRate=self.mog_parameters.data.learning_rate)
-
-        self.image_height = image_o.shape[0]
+            occupancy, image_shape, training_frames = trained
+            if cached_frames is not None:
+                image_shape = cached["image_shape"]
+
+            if store and batch_model:
+                background, variance = self.fgbg_mog.getState()
+                arrays = { "background": background, "occupancy": occupancy }
+                if variance is not None:
+                    arrays["variance"] = variance
+                self.model_cache.save(cache_key, image_shape, **arrays)
+            elif store:
+                self.model_cache.save(cache_key, image_shape, frames=np.asarray(training_frames))
+
+        self.image_height = image_shape[0]
         try:
-            self.image_width = image_o.shape[1]
+            self.image_width = image_shape[1]
         except IndexError:
             self.image_width = 1
 
         self.mog_ready = True
         self.initializing = False;
         self.applied_mog_parameters = self.mog_parameters.copy()
+        self.trained_parameter_dict = self.mog_parameters.getParameterDict()
+        self.occupancy = self.expandFromRegion(occupancy, self.region)
+        self.trained_region = self.region
+        self.trained_cache_key = cache_key
+        self.occupancy_count = len(training_indices) - occupancy_start
 
         self.state_changed_signal.emit()
         LogObject().print2("BG Subtractor Initialized")
@@ -131,26 +305,161 @@ class BackgroundSubtractor(QtCore.QObject):
         if hasattr(self.image_provider, "refreshFrame"):
             self.image_provider.refreshFrame()
 
+    def trainModel(self, training_indices, cached_frames=None, store_frames=False):
+        """
+        Trains self.fgbg_mog with the frames at training_indices, or with cached_frames if given.
+        Returns the foreground occupancy (in the region), the shape of the original images (None if
+        cached_frames are used) and the training frames if store_frames is set, or None if stopped.
+        """
+        training_frames = []
+        image_shape = None
+
+        # Foreground occupancy is accumulated over the latter half of the training frames,
+        # when the model has already learned most of the background (see occupancy_count).
+        occupancy_start = len(training_indices) // 2
+        occupancy = None
+
+        frames = None if cached_frames is not None else self.iterTrainingFrames(training_indices)
+
+        # Create background model from fixed number of frames.
+        for i, ind in enumerate(training_indices):
+            
+            if self.stop_initializing:
+                LogObject().print2("Stopped initializing (BG subtraction) at", ind)
+                if frames is not None:
+                    frames.close()
+                return None
+
+            if cached_frames is not None:
+                image = cached_frames[i]
+            else:
+                image_o = next(frames)
+                image_shape = image_o.shape
+                image = self.cropToRegion(image_o, self.region)
+                if store_frames:
+                    training_frames.append(image)
+
+            fg_mask = self.fgbg_mog.apply(image, learningRate=self.mog_parameters.data.learning_rate)
+
+            if i >= occupancy_start:
+                if occupancy is None:
+                    occupancy = np.zeros(fg_mask.shape[:2], dtype=np.uint16)
+                occupancy += fg_mask > 0
+
+        # Batch models are built from the whole sample at once, after which the occupancy can be counted.
+        if isinstance(self.fgbg_mog, BatchBackgroundModel):
+            settled = np.stack(self.fgbg_mog.sample[occupancy_start:])
+            self.fgbg_mog.train()
+            occupancy = np.count_nonzero(self.fgbg_mog.applyBlock(settled), axis=0).astype(np.uint16)
+
+            # Occupancy of a model trained at reduced resolution is upscaled to the frame size.
+            if occupancy.shape != image.shape[:2]:
+                occupancy = cv2.resize(occupancy, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+
+        return occupancy, image_shape, training_frames
+
+    def getTrainingIndices(self):
+        """
+        Returns the indices of the frames used in initMOG with the current parameters.
+        """
+        return getTrainingIndices(self.image_provider.getFrameCount(), self.mog_parameters.data.nof_bg_frames)
+
+    def getModelKey(self):
+        """
+        Returns a hashable key identifying the current background model, or None if not trained.
+        """
+        if not self.mog_ready or self.trained_parameter_dict is None:
+            return None
+        return tuple(sorted(self.trained_parameter_dict.items())) + (self.getRegionKey(self.trained_region),)
+
+    def isRolling(self):
+        return self.mog_parameters.data.rolling_update
+
+    def beginRolling(self):
+        """
+        Starts a rolling update. Frames passed to subtractBG until endRolling are expected to be
+        in order, and they update the model so that it follows drifting conditions:
+        MOG2 is updated with rolling_learning_rate on every frame, and if rolling_snapshot is set
+        (always for batch models), the model is rebuilt every rolling_window frames from a bounded
+        sample (nof_bg_frames) of the latest window.
+        """
+        if not self.isRolling():
+            return
+        data = self.mog_parameters.data
+        self.rolling_active = True
+        self.rolling_sample = collections.deque(maxlen=max(1, data.nof_bg_frames))
+        self.rolling_count = 0
+
+    def endRolling(self):
+        self.rolling_active = False
+        self.rolling_sample = None
+
+    def subtractBGRolling(self, image):
+        data = self.mog_parameters.data
+        batch_model = isinstance(self.fgbg_mog, BatchBackgroundModel)
+        cropped = self.cropToRegion(image, self.trained_region)
+
+        learning_rate = 0 if batch_model else data.rolling_learning_rate
+        fg_mask_mog = self.fgbg_mog.apply(cropped, learningRate=learning_rate)
+        self.model_modified = True
+
+        window = max(1, data.rolling_window)
+        self.rolling_count += 1
+        if self.rolling_count % max(1, window // self.rolling_sample.maxlen) == 0:
+            self.rolling_sample.append(cropped)
+        if (data.rolling_snapshot or batch_model) and self.rolling_count % window == 0:
+            self.snapshotModel()
+
+        return self.expandFromRegion(fg_mask_mog, self.trained_region)
+
+    def snapshotModel(self):
+        """
+        Replaces the model with one trained from the rolling sample.
+        """
+        if len(self.rolling_sample) == 0:
+            return
+        LogObject().print2(f"BG Subtractor: model rebuilt from the latest {len(self.rolling_sample)} sampled frames")
+        fgbg_mog = createMOG(self.mog_parameters)
+        for frame in self.rolling_sample:
+            fgbg_mog.apply(frame, learningRate=self.mog_parameters.data.learning_rate)
+        if isinstance(fgbg_mog, BatchBackgroundModel):
+            fgbg_mog.train()
+        self.fgbg_mog = fgbg_mog
+
     def subtractBG(self, image):
+        if self.rolling_active:
+            return self.subtractBGRolling(image)
+
 		# Get foreground mask, without updating the  model (learningRate = 0)
         try:
-            fg_mask_mog = self.fgbg_mog.apply(image, learningRate=0)
-            return fg_mask_mog
+            fg_mask_mog = self.fgbg_mog.apply(self.cropToRegion(image, self.trained_region), learningRate=0)
+            return self.expandFromRegion(fg_mask_mog, self.trained_region)
 
         except AttributeError as e:
             LogObject().print2("BG subtractor not initialized", e)
             return None
 
+    def subtractBGBlock(self, images):
+        """
+        Returns the foreground masks of a block of frames (N x H x W).
+        Batch models threshold the whole block at once.
+        """
+        if isinstance(self.fgbg_mog, BatchBackgroundModel):
+            cropped = np.stack([self.cropToRegion(image, self.trained_region) for image in images])
+            return [self.expandFromRegion(mask, self.trained_region) for mask in self.fgbg_mog.applyBlock(cropped)]
+        return [self.subtractBG(image) for image in images]
+
     def subtractBGFiltered(self, image, median_size):
-        fg_mask_mog = self.fgbg_mog.apply(image, learningRate=0)
-        fg_mask_filt = cv2.medianBlur(fg_mask_mog, median_size)
-        return fg_mask_filt
+        fg_mask_mog = self.fgbg_mog.apply(self.cropToRegion(image, self.trained_region), learningRate=0)
+        fg_mask_filt, _ = binaryMedian(fg_mask_mog, median_size)
+        return self.expandFromRegion(fg_mask_filt, self.trained_region)
 
     def applyParameters(self):
         self.applied_mog_parameters = self.mog_parameters.copy()
+        self.trained_region = self.region
 
     def parametersDirty(self):
-        return self.mog_parameters != self.applied_mog_parameters
+        return self.mog_parameters != self.applied_mog_parameters or self.getRegionKey(self.region) != self.getRegionKey(self.trained_region)
 
     def abortComputing(self):
         self.applied_mog_parameters = None
\ No newline at end of file
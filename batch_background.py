@@ -0,0 +1,194 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import cv2
+
+# Background models selectable in MOGParameters.bg_model.
+MOG2_MODEL = "mog2"
+PERCENTILE_MODEL = "percentile"
+GAUSSIAN_MODEL = "gaussian"
+BACKGROUND_MODELS = [MOG2_MODEL, PERCENTILE_MODEL, GAUSSIAN_MODEL]
+
+# Lower limit of the per-pixel variance in the Gaussian model, same as the default of MOG2 (varMin).
+MIN_VARIANCE = 4.0
+
+# Number of frames thresholded at a time.
+BLOCK_SIZE = 64
+
+def downscale(image, scale):
+    """
+    Returns the image resized by scale (<= 1), averaging the pixels.
+    """
+    if scale >= 1:
+        return image
+    height, width = image.shape[:2]
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+class BatchBackgroundModel:
+    """
+    Background model built from a sample of frames in one NumPy reduction, instead of
+    updating a model one frame at a time as in MOG2. Implements the apply interface of
+    OpenCV background subtractors, so it can be used in place of MOG2:
+    frames applied with learningRate > 0 are added to the training sample, and frames
+    applied with learningRate = 0 are thresholded against the model.
+
+    percentile: Background is a per-pixel temporal percentile of the sample, foreground
+        pixels are brighter than the background by more than threshold.
+    gaussian: Background is a per-pixel mean and variance of the sample, foreground pixels
+        differ from the mean by more than sqrt(var_threshold) standard deviations
+        (mog_var_thresh has the same meaning as in MOG2).
+
+    If scale < 1, the model is trained from downscaled frames and upsampled to the size
+    of the thresholded frames.
+    """
+    def __init__(self, model=PERCENTILE_MODEL, percentile=50, threshold=25, var_threshold=11, scale=1.0):
+        self.model = model
+        self.percentile = percentile
+        self.threshold = threshold
+        self.var_threshold = var_threshold
+        self.scale = scale
+
+        self.sample = []
+        self.background = None
+        self.variance = None
+
+        # Model resized to the size of the thresholded frames.
+        self.resized_shape = None
+        self.resized = None
+
+    def apply(self, image, learningRate=0):
+        if learningRate != 0:
+            self.sample.append(downscale(np.asarray(image), self.scale))
+            return np.zeros(np.shape(image)[:2], dtype=np.uint8)
+        return self.applyBlock(np.asarray(image)[np.newaxis])[0]
+
+    def isTrained(self):
+        return self.background is not None
+
+    def getState(self):
+        """
+        Returns the trained model: (background, variance), variance is None for the percentile model.
+        """
+        return self.background, self.variance
+
+    def setState(self, background, variance=None):
+        """
+        Restores a model returned by getState, replacing training.
+        """
+        self.sample = []
+        self.background = np.asarray(background, dtype=np.float32)
+        self.variance = None if variance is None else np.asarray(variance, dtype=np.float32)
+        self.resized_shape = None
+
+    def train(self, frames=None):
+        """
+        Builds the model from frames (N x H x W), or from the frames added with apply.
+        """
+        if frames is None:
+            frames = np.stack(self.sample)
+        self.sample = []
+
+        if self.model == GAUSSIAN_MODEL:
+            frames = frames.astype(np.float32)
+            self.background = np.mean(frames, axis=0)
+            self.variance = np.maximum(np.var(frames, axis=0), MIN_VARIANCE)
+        else:
+            self.background = np.percentile(frames, self.percentile, axis=0).astype(np.float32)
+        self.resized_shape = None
+
+    def getModel(self, shape):
+        """
+        Returns the background (and variance) resized to shape.
+        """
+        if shape == self.background.shape:
+            return self.background, self.variance
+        if shape != self.resized_shape:
+            size = (shape[1], shape[0])
+            background = cv2.resize(self.background, size, interpolation=cv2.INTER_LINEAR)
+            variance = None if self.variance is None else cv2.resize(self.variance, size, interpolation=cv2.INTER_LINEAR)
+            self.resized = (background, variance)
+            self.resized_shape = shape
+        return self.resized
+
+    def applyBlock(self, frames):
+        """
+        Returns the foreground masks (0 / 255) of a block of frames (N x H x W).
+        """
+        if not self.isTrained():
+            self.train()
+
+        background, variance = self.getModel(frames.shape[1:])
+        masks = np.empty(frames.shape, dtype=np.uint8)
+        for start in range(0, len(frames), BLOCK_SIZE):
+            block = frames[start:start + BLOCK_SIZE].astype(np.float32)
+            diff = block - background
+            if self.model == GAUSSIAN_MODEL:
+                foreground = diff * diff > self.var_threshold * variance
+            else:
+                foreground = diff > self.threshold
+            masks[start:start + BLOCK_SIZE] = foreground * np.uint8(255)
+        return masks
+
+
+if __name__ == "__main__":
+    import time
+    from mog_parameters import MOGParameters
+    from background_subtractor import createMOG
+
+    def syntheticFrames(count, shape=(1000, 600), targets=5, seed=0):
+        """
+        Noisy static background with a few bright targets moving through the image.
+        """
+        rng = np.random.default_rng(seed)
+        background = cv2.GaussianBlur(rng.integers(0, 120, shape, dtype=np.uint8), (15, 15), 0)
+        positions = rng.uniform(0, 1, (targets, 2)) * shape
+        velocities = rng.normal(0, 5, (targets, 2))
+        for i in range(count):
+            frame = np.clip(background + rng.normal(0, 5, shape), 0, 255).astype(np.uint8)
+            for y, x in (positions + i * velocities) % shape:
+                cv2.circle(frame, (int(x), int(y)), 6, 255, -1)
+            yield frame
+
+    def benchmark(model, frames, training_frames):
+        parameters = MOGParameters(bg_model=model)
+        t = time.time()
+        subtractor = createMOG(parameters)
+        for frame in training_frames:
+            subtractor.apply(frame, learningRate=parameters.data.learning_rate)
+        if isinstance(subtractor, BatchBackgroundModel):
+            subtractor.train()
+        t_train = time.time() - t
+
+        t = time.time()
+        if isinstance(subtractor, BatchBackgroundModel):
+            masks = subtractor.applyBlock(frames)
+        else:
+            masks = np.stack([subtractor.apply(frame, learningRate=0) for frame in frames])
+        t_apply = time.time() - t
+
+        fg = np.count_nonzero(masks) / masks.size
+        print(f"{model:>10}: training {t_train:.2f} s, subtraction {t_apply:.2f} s "
+              f"({1000 * t_apply / len(frames):.1f} ms / frame), foreground {100 * fg:.2f} %")
+
+    frames = np.stack(list(syntheticFrames(300)))
+    training_frames = frames[::3]
+    for model in BACKGROUND_MODELS:
+        benchmark(model, frames, training_frames)
@@ -135,6 +135,19 @@ class BatchDialog(QtWidgets.QDialog):
 
         self.main_layout.addLayout(self.double_layout)
 
+        self.streaming_layout = QtWidgets.QHBoxLayout()
+        streaming_tooltip = "Detect and track frames in a pipeline, so that tracking runs while the file is being detected."
+        self.label_streaming = QtWidgets.QLabel("Streaming:")
+        self.label_streaming.setToolTip(streaming_tooltip)
+        self.streaming_layout.addWidget(self.label_streaming)
+
+        self.check_streaming = QtWidgets.QCheckBox("")
+        self.check_streaming.setChecked(fh.getConfValue(fh.ConfKeys.batch_streaming))
+        self.check_streaming.stateChanged.connect(lambda x: fh.setConfValue(fh.ConfKeys.batch_streaming, x))
+        self.streaming_layout.addWidget(self.check_streaming)
+
+        self.main_layout.addLayout(self.streaming_layout)
+
         # Test file
         if fh.getTestFilePath() is not None:
             self.test_layout = QtWidgets.QHBoxLayout()
@@ -270,6 +283,7 @@ class BatchDialog(QtWidgets.QDialog):
         """
         fh.setParallelProcesses(self.n_parallel)
         fh.setConfValue(fh.ConfKeys.batch_double_track, self.check_double.isChecked())
+        fh.setConfValue(fh.ConfKeys.batch_streaming, self.check_streaming.isChecked())
         fh.setConfValue(fh.ConfKeys.latest_batch_directory, self.save_path)
 
         self.batch_track = BatchTrack(False, self.files, self.save_path, self.n_parallel,
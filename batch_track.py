@@ -69,6 +69,7 @@ class BatchTrack(QtCore.QObject):
         self.save_tracks = fh.getConfValue(fh.ConfKeys.batch_save_tracks)
         self.save_complete = fh.getConfValue(fh.ConfKeys.batch_save_complete)
         self.as_binary = fh.getConfValue(fh.ConfKeys.save_as_binary)
+        self.streaming = fh.getConfValue(fh.ConfKeys.batch_streaming)
 
         if params_detector is None:
             LogObject().print2("BatchTrack: Using default parameters for Detector.")
@@ -162,7 +163,8 @@ class BatchTrack(QtCore.QObject):
             save_detections = self.save_detections,
             save_tracks = self.save_tracks,
             save_complete = self.save_complete,
-            as_binary = self.as_binary
+            as_binary = self.as_binary,
+            streaming = self.streaming
             )
 
         proc = mp.Process(target=tp.trackProcess, args=(process_info,))
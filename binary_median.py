@@ -0,0 +1,123 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+from numba import njit
+
+# Side length of the tiles the mask is processed in. Tiles with no foreground
+# within the filter radius are skipped.
+TILE_SIZE = 32
+
+@njit
+def _activeTiles(mask, tile, radius):
+    """
+    Returns a boolean grid of the tiles that have foreground within radius pixels.
+    """
+    height, width = mask.shape
+    tiles_y = (height + tile - 1) // tile
+    tiles_x = (width + tile - 1) // tile
+    occupied = np.zeros((tiles_y, tiles_x), np.bool_)
+    for y in range(height):
+        ty = y // tile
+        for x in range(width):
+            if mask[y, x] != 0:
+                occupied[ty, x // tile] = True
+
+    reach = (radius + tile - 1) // tile
+    active = np.zeros((tiles_y, tiles_x), np.bool_)
+    for ty in range(tiles_y):
+        for tx in range(tiles_x):
+            if occupied[ty, tx]:
+                for ny in range(max(0, ty - reach), min(tiles_y, ty + reach + 1)):
+                    for nx in range(max(0, tx - reach), min(tiles_x, tx + reach + 1)):
+                        active[ny, nx] = True
+    return active
+
+@njit
+def _medianKernel(mask, radius, tile, active, out, pixels):
+    """
+    Binary median of the active tiles of mask into out. Foreground coordinates are
+    written to pixels in row-major order. Returns the number of foreground pixels.
+    """
+    height, width = mask.shape
+    size = 2 * radius + 1
+    majority = size * size // 2
+    integral = np.zeros((tile + 2 * radius + 1, tile + 2 * radius + 1), np.int32)
+    count = 0
+
+    for ty in range(active.shape[0]):
+        y0 = ty * tile
+        y1 = min(y0 + tile, height)
+        for tx in range(active.shape[1]):
+            if not active[ty, tx]:
+                continue
+            x0 = tx * tile
+            x1 = min(x0 + tile, width)
+
+            # Integral image of the tile padded by radius, border replicated as in cv2.medianBlur.
+            for i in range(y1 - y0 + 2 * radius):
+                y = min(max(y0 - radius + i, 0), height - 1)
+                row_sum = 0
+                for j in range(x1 - x0 + 2 * radius):
+                    x = min(max(x0 - radius + j, 0), width - 1)
+                    if mask[y, x] != 0:
+                        row_sum += 1
+                    integral[i + 1, j + 1] = integral[i, j + 1] + row_sum
+
+            for i in range(y1 - y0):
+                for j in range(x1 - x0):
+                    s = integral[i + size, j + size] - integral[i, j + size] - integral[i + size, j] + integral[i, j]
+                    if s > majority:
+                        out[y0 + i, x0 + j] = 255
+
+        # Foreground of the finished band of tiles, row by row.
+        for y in range(y0, y1):
+            for tx in range(active.shape[1]):
+                if not active[ty, tx]:
+                    continue
+                for x in range(tx * tile, min(tx * tile + tile, width)):
+                    if out[y, x] != 0:
+                        pixels[count, 0] = y
+                        pixels[count, 1] = x
+                        count += 1
+    return count
+
+def binaryMedian(fg_mask, size):
+    """
+    Median filter for binary masks (0 / non-zero), fused with the extraction of the foreground pixels.
+    The median of a binary window is 255 if more than half of the pixels are foreground,
+    which is counted with an integral image. Only tiles with foreground nearby are visited.
+    Output equals cv2.medianBlur(fg_mask, size) for odd size.
+
+    Returns (filtered mask (uint8, 0 / 255), foreground pixel coordinates (N x 2 int32, row-major order)).
+    """
+    mask = np.ascontiguousarray(fg_mask, dtype=np.uint8)
+    radius = max(0, int(size) // 2)
+    active = _activeTiles(mask, TILE_SIZE, radius)
+    out = np.zeros(mask.shape, np.uint8)
+    pixels = np.empty((int(np.count_nonzero(active)) * TILE_SIZE * TILE_SIZE, 2), np.int32)
+    count = _medianKernel(mask, radius, TILE_SIZE, active, out, pixels)
+    return out, pixels[:count]
+
+def maskPixels(fg_mask):
+    """
+    Returns the coordinates of the foreground pixels of a mask (N x 2 int32, row-major order).
+    """
+    return np.argwhere(np.asarray(fg_mask)).astype(np.int32)
@@ -0,0 +1,65 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import base64
+import numpy as np
+
+def exclusionMask(occupancy, sample_count, threshold):
+    """
+    Returns a boolean mask of the pixels that were foreground in at least
+    a fraction threshold of the sample_count sampled frames.
+    """
+    if occupancy is None or sample_count <= 0:
+        return None
+    return occupancy >= max(1, threshold * sample_count)
+
+def applyExclusionMask(fg_mask, exclusion_mask):
+    """
+    Returns a copy of fg_mask where the excluded pixels are set to background.
+    Returns fg_mask as is if there is no mask or it does not match the image size.
+    """
+    if exclusion_mask is None or fg_mask is None or exclusion_mask.shape != fg_mask.shape[:2]:
+        return fg_mask
+    fg_mask = fg_mask.copy()
+    fg_mask[exclusion_mask] = 0
+    return fg_mask
+
+def excludePixels(pixels, exclusion_mask, shape):
+    """
+    Returns the foreground pixel coordinates (N x 2) of an image of the given shape that are not excluded.
+    Returns pixels as is if there is no mask or it does not match the image size.
+    """
+    if exclusion_mask is None or len(pixels) == 0 or exclusion_mask.shape != tuple(shape[:2]):
+        return pixels
+    return pixels[~exclusion_mask[pixels[:, 0], pixels[:, 1]]]
+
+def encodeMask(mask):
+    """
+    Encodes a boolean mask into a dictionary that can be written to a save file (JSON / msgpack).
+    """
+    data = base64.b64encode(np.packbits(mask, axis=None).tobytes()).decode("ascii")
+    return { "shape": list(mask.shape), "data": data }
+
+def decodeMask(dictionary):
+    """
+    Decodes a mask encoded with encodeMask.
+    """
+    shape = tuple(int(s) for s in dictionary["shape"])
+    packed = np.frombuffer(base64.b64decode(dictionary["data"]), dtype=np.uint8)
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).astype(bool)
@@ -0,0 +1,147 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Otto Korkalo and Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import cv2
+from pixel_runs import pixelsToRuns, runsToPixels, encodeRuns
+from overlay_renderer import overlayAreas
+
+class Detection:
+	def __init__(self, label):
+		self.label = label
+		self.runs = None
+		self.diff = None
+		self.center = None
+		self.corners = None
+
+		self.length = 0
+		self.distance = 0
+		self.angle = 0
+
+	def __repr__(self):
+		return "Detection \"{}\" d:{:.1f}, a:{:.1f}".format(self.label, self.distance, self.angle)
+
+	@property
+	def data(self):
+		"""
+		Pixel coordinates (N x 2) of the detection area, decoded from the stored runs.
+		"""
+		if self.runs is None:
+			return None
+		return runsToPixels(self.runs)
+
+	def init_from_data(self, data, detection_size, polar_transform):
+		"""
+		Initialize detection parameters from the pixel data from the clusterer / detection algorithm. Saved pixel data
+		can also be used to (re)initialize the detection. The pixels are stored as runs (see pixel_runs).
+		"""
+		data = np.asarray(data)
+		self.runs = pixelsToRuns(data)
+
+		ca = np.cov(data, y=None, rowvar=0, bias=1)
+		v, vect = np.linalg.eig(ca)
+		tvect = np.transpose(vect)
+		ar = np.dot(data, np.linalg.inv(tvect))
+
+		# NOTE a fixed parameter --> to UI / file.
+		if ar.shape[0] > detection_size: #10:
+
+			mina = np.min(ar, axis=0)
+			maxa = np.max(ar, axis=0)
+			diff = (maxa - mina) * 0.5
+					
+			center = mina + diff
+
+			# Get the 4 corners by subtracting and adding half the bounding boxes height and width to the center
+			corners = np.array([center+[-diff[0],-diff[1]], \
+								center+[diff[0],-diff[1]], \
+								center+[diff[0],diff[1]], \
+								center+[-diff[0],diff[1]]])#, \
+								#center+[-diff[0],-diff[1]]])
+
+			self.diff = diff
+
+			# Use the the eigenvectors as a rotation matrix and rotate the corners and the center back
+			self.corners = np.dot(corners, tvect)
+			self.center = np.dot(center, tvect)
+
+			if polar_transform is not None:
+				metric_diff = polar_transform.pix2metCI(diff[0], diff[1])
+				self.length = float(2 * metric_diff[1])
+				self.distance, self.angle = polar_transform.cart2polMetric(self.center[0], self.center[1], True)
+				self.distance = float(self.distance)
+				self.angle = float(self.angle / np.pi * 180 + 90)
+
+	def init_from_file(self, corners, length, distance, angle):
+		"""
+		Initialize detection parameters from a csv file. Data is not stored when exporting a csv file,
+		which means it cannot be recovered here. This mainly affects the visualization of the detection.
+		"""
+		self.corners = np.array(corners)
+		self.center = np.average(self.corners, axis=0)
+		self.diff = self.center - self.corners[0]
+		self.length = length
+		self.distance = distance
+		self.angle = angle
+
+	def visualize(self, image, color, show_text, show_detection=True):
+		if self.corners is None:
+			return image
+
+		# Draw size text
+		if show_text:
+			if self.length > 0:
+				size_txt = self.getSizeText()
+				image = cv2.putText(image, size_txt, (int(self.center[1])-20, int(self.center[0])-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1, cv2.LINE_AA)
+
+		# Draw detection area and bounding box
+		if show_detection:
+			self.visualizeArea(image, color)
+
+			for i in range(0,3):
+				cv2.line(image, (int(self.corners[i,1]),int(self.corners[i,0])), (int(self.corners[i+1,1]),int(self.corners[i+1,0])),  (255,255,255), 1)
+			cv2.line(image, (int(self.corners[3,1]),int(self.corners[3,0])), (int(self.corners[0,1]),int(self.corners[0,0])),  (255,255,255), 1)
+
+		return image
+
+	def visualizeArea(self, image, color):
+		return overlayAreas(image, [(self.runs, color)])
+
+	def getSizeText(self):
+		return 'Size: ' + str(int(100*self.length))
+	
+	def getMessage(self):
+		# This message was used to send data to tracker process (C++) or save detections to file
+		if self.diff is None:
+			return ""
+		
+		return str(int(self.center[1]*10)) + ' ' + str(int(self.center[0]*10)) + ' ' + str(int(self.diff[1]*2))
+
+	def cornersToString(self, delim):
+		if self.corners is None:
+			return ""
+
+		base = "{:.2f}" + delim + "{:.2f}"
+		return delim.join(base.format(cx,cy) for cy, cx in self.corners[0:4])
+
+	def convertToWritable(self):
+		"""
+		Returns data in applicable format to be used by SaveManager
+		"""
+		return [int(self.label), encodeRuns(self.runs)]
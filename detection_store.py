@@ -0,0 +1,501 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Otto Korkalo and Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+from detection import Detection
+from log_object import LogObject
+
+class DetectionColumns:
+    """
+    Set of column arrays holding the detections of all frames. Existing rows are never modified,
+    but rows of later frames can be appended (see extend).
+    Detections of frame i are the rows frame_offsets[i]:frame_offsets[i+1].
+    Pixel runs (see pixel_runs) of detection j are the rows run_offsets[j]:run_offsets[j+1] of runs (CSR format).
+    """
+    ROW_COLUMNS = ("label", "center", "corners", "diff", "length", "distance", "angle")
+
+    def __init__(self, frame_count, frame_offsets=None, label=None, center=None, corners=None, diff=None,
+                 length=None, distance=None, angle=None, run_offsets=None, runs=None):
+
+        self.frame_offsets = np.zeros(frame_count + 1, dtype=np.int64) if frame_offsets is None else frame_offsets
+        self.label = np.empty(0, dtype=np.int32) if label is None else label
+        self.center = np.empty((0, 2)) if center is None else center
+        self.corners = np.empty((0, 4, 2)) if corners is None else corners
+        self.diff = np.empty((0, 2)) if diff is None else diff
+        self.length = np.empty(0) if length is None else length
+        self.distance = np.empty(0) if distance is None else distance
+        self.angle = np.empty(0) if angle is None else angle
+        self.run_offsets = np.zeros(1, dtype=np.int64) if run_offsets is None else run_offsets
+        self.runs = np.empty((0, 3), dtype=np.uint16) if runs is None else runs
+
+        # Arrays with room for appended rows: column name -> array, see extend.
+        self._buffers = {}
+
+    def __len__(self):
+        return len(self.label)
+
+    def rowFrames(self):
+        """
+        Returns the frame index of each row.
+        """
+        return np.repeat(np.arange(len(self.frame_offsets) - 1), np.diff(self.frame_offsets))
+
+    def rowFrame(self, row):
+        """
+        Returns the frame index of a row.
+        """
+        return int(np.searchsorted(self.frame_offsets, row, side="right")) - 1
+
+    def extend(self, first_frame, frames, new):
+        """
+        Appends the rows of new (DetectionColumns) in place. frames contains the frame index of each new row,
+        sorted and at least first_frame. The existing rows must be in frames before first_frame.
+        Columns grow by doubling, so appending is amortized linear in the number of new rows, and the
+        existing rows and views of them stay valid.
+        """
+        n = len(self)
+        for name in DetectionColumns.ROW_COLUMNS:
+            setattr(self, name, self._append(name, n, getattr(new, name)))
+        run_count = int(self.run_offsets[-1])
+        self.runs = self._append("runs", run_count, new.runs)
+        self.run_offsets = self._append("run_offsets", n + 1, new.run_offsets[1:] + run_count)
+
+        frame_count = len(self.frame_offsets) - 1
+        counts = np.bincount(np.asarray(frames, dtype=np.int64) - first_frame, minlength=frame_count - first_frame)
+        frame_offsets = self.frame_offsets.copy()
+        frame_offsets[first_frame + 1:] += np.cumsum(counts)
+        self.frame_offsets = frame_offsets
+
+    def _append(self, name, used, values):
+        """
+        Writes values after the first used elements of the buffer of a column. Returns the used part of the buffer.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None:
+            buffer = getattr(self, name)
+        end = used + len(values)
+        if end > len(buffer):
+            grown = np.empty((max(2 * len(buffer), end),) + buffer.shape[1:], dtype=buffer.dtype)
+            grown[:used] = buffer[:used]
+            buffer = grown
+        buffer[used:end] = values
+        self._buffers[name] = buffer
+        return buffer[:end]
+
+    def runIndices(self, rows):
+        """
+        Returns the indices of the runs of the given rows, in the order of the rows.
+        """
+        starts = self.run_offsets[rows]
+        counts = self.run_offsets[rows + 1] - starts
+        out_starts = np.cumsum(counts) - counts
+        return np.arange(np.sum(counts), dtype=np.int64) + np.repeat(starts - out_starts, counts), counts
+
+    @staticmethod
+    def fromDetections(frame_count, frames, detections):
+        """
+        Creates columns from Detection objects. frames contains the frame index of each detection
+        and is expected to be sorted.
+        """
+        n = len(detections)
+        counts = np.bincount(np.asarray(frames, dtype=np.int64), minlength=frame_count)
+        run_list = [np.empty((0, 3), dtype=np.uint16) if d.runs is None else np.asarray(d.runs, dtype=np.uint16).reshape(-1, 3)
+                    for d in detections]
+        run_counts = np.array([len(r) for r in run_list], dtype=np.int64)
+
+        return DetectionColumns(frame_count,
+            frame_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            label = np.array([d.label for d in detections], dtype=np.int32),
+            center = np.array([d.center for d in detections], dtype=np.float64).reshape(n, 2),
+            corners = np.array([d.corners for d in detections], dtype=np.float64).reshape(n, 4, 2),
+            diff = np.array([d.diff for d in detections], dtype=np.float64).reshape(n, 2),
+            length = np.array([d.length for d in detections], dtype=np.float64),
+            distance = np.array([d.distance for d in detections], dtype=np.float64),
+            angle = np.array([d.angle for d in detections], dtype=np.float64),
+            run_offsets = np.concatenate(([0], np.cumsum(run_counts))).astype(np.int64),
+            runs = np.concatenate(run_list) if len(run_list) > 0 else np.empty((0, 3), dtype=np.uint16)
+            )
+
+    @staticmethod
+    def concatenate(frame_count, frames, parts):
+        """
+        Combines rows of several DetectionColumns. parts is a list of (columns, rows) tuples
+        and frames contains the frame index of each combined row. Rows are reordered by frame.
+        """
+        order = np.argsort(frames, kind="stable")
+        counts = np.bincount(np.asarray(frames, dtype=np.int64), minlength=frame_count)
+
+        def combine(name):
+            return np.concatenate([getattr(c, name)[rows] for c, rows in parts])[order]
+
+        run_parts = []
+        run_counts = []
+        for c, rows in parts:
+            inds, cnts = c.runIndices(rows)
+            run_parts.append(c.runs[inds])
+            run_counts.append(cnts)
+
+        # Reorder run blocks to match the new row order
+        run_counts = np.concatenate(run_counts)
+        run_offsets = np.concatenate(([0], np.cumsum(run_counts))).astype(np.int64)
+        combined = DetectionColumns(frame_count, run_offsets=run_offsets, runs=np.concatenate(run_parts))
+        inds, run_counts = combined.runIndices(order)
+
+        return DetectionColumns(frame_count,
+            frame_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            label = combine("label"),
+            center = combine("center"),
+            corners = combine("corners"),
+            diff = combine("diff"),
+            length = combine("length"),
+            distance = combine("distance"),
+            angle = combine("angle"),
+            run_offsets = np.concatenate(([0], np.cumsum(run_counts))).astype(np.int64),
+            runs = combined.runs[inds]
+            )
+
+
+class DetectionView(Detection):
+    """
+    Read-only Detection that refers to a row in DetectionColumns.
+    Views are created on demand, so they are cheap to create and discard.
+    """
+    def __init__(self, columns, index):
+        self.columns = columns
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, DetectionView) and self.columns is other.columns and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.columns), self.index))
+
+    def toDetection(self):
+        """
+        Returns a copy of the detection that does not refer to the column arrays.
+        """
+        d = Detection(self.label)
+        runs = self.runs
+        d.runs = None if runs is None else runs.copy()
+        d.diff = self.diff.copy()
+        d.center = self.center.copy()
+        d.corners = self.corners.copy()
+        d.length = self.length
+        d.distance = self.distance
+        d.angle = self.angle
+        return d
+
+    @property
+    def label(self):
+        return int(self.columns.label[self.index])
+
+    @property
+    def runs(self):
+        start = self.columns.run_offsets[self.index]
+        end = self.columns.run_offsets[self.index + 1]
+        if start == end:
+            return None
+        return self.columns.runs[start:end]
+
+    @property
+    def diff(self):
+        return self.columns.diff[self.index]
+
+    @property
+    def center(self):
+        return self.columns.center[self.index]
+
+    @property
+    def corners(self):
+        return self.columns.corners[self.index]
+
+    @property
+    def length(self):
+        return float(self.columns.length[self.index])
+
+    @property
+    def distance(self):
+        return float(self.columns.distance[self.index])
+
+    @property
+    def angle(self):
+        return float(self.columns.angle[self.index])
+
+
+class DetectionStore:
+    """
+    Columnar storage for the detections of all frames. Replaces per-frame lists of Detection objects.
+    Supports list-like access: store[frame] returns a list of DetectionViews, or None if the frame has not
+    been computed, and store[frame] = detections sets the detections of a frame.
+
+    Newly set frames are kept as Detection objects until compact is called, which moves them to the
+    column arrays. Frames after all the stored rows are appended to the arrays; otherwise compacting
+    creates new arrays. Either way, previously created views remain valid.
+    Only valid detections (i.e. detections with a center) are stored.
+
+    The row of a detection in the column arrays is used as its id (see detectionIds).
+    """
+    def __init__(self, frame_count=0):
+        self.frame_count = frame_count
+        self.computed = np.zeros(frame_count, dtype=bool)
+        self.columns = DetectionColumns(frame_count)
+
+        # Frames set after the previous compact: frame index -> list of Detections
+        self.pending = {}
+
+        # Rows included in the store, or None if all rows are included (see excluding).
+        self.row_mask = None
+
+    def __len__(self):
+        return self.frame_count
+
+    def __getitem__(self, ind):
+        return self.getFrame(ind)
+
+    def __setitem__(self, ind, detections):
+        self.setFrame(ind, detections)
+
+    def __iter__(self):
+        for ind in range(self.frame_count):
+            yield self.getFrame(ind)
+
+    def isComputed(self, ind):
+        return self.computed[ind]
+
+    def setFrame(self, ind, detections):
+        if ind < 0 or ind >= self.frame_count:
+            raise IndexError(f"Frame index {ind} out of range {self.frame_count}")
+        if self.row_mask is not None:
+            raise ValueError("Detections cannot be set to a store created with excluding")
+
+        if detections is None:
+            self.computed[ind] = False
+            self.pending[ind] = []
+        else:
+            self.computed[ind] = True
+            self.pending[ind] = [d for d in detections if d.center is not None]
+
+    def getFrame(self, ind):
+        """
+        Returns detections of a frame (list of DetectionViews) or None if the frame is not computed.
+        """
+        if ind < 0 or ind >= self.frame_count:
+            raise IndexError(f"Frame index {ind} out of range {self.frame_count}")
+
+        if not self.computed[ind]:
+            return None
+
+        pending = self.pending.get(ind)
+        if pending is not None:
+            return pending
+
+        columns = self.columns
+        start, end = columns.frame_offsets[ind], columns.frame_offsets[ind + 1]
+        if self.row_mask is not None:
+            return [DetectionView(columns, i) for i in np.nonzero(self.row_mask[start:end])[0] + start]
+        return [DetectionView(columns, i) for i in range(start, end)]
+
+    def getFrameSlice(self, ind):
+        """
+        Returns the range of rows of the given frame. Pending frames are compacted first.
+        """
+        self.compact()
+        return self.columns.frame_offsets[ind], self.columns.frame_offsets[ind + 1]
+
+    def frameDetectionCount(self, ind):
+        dets = self.getFrame(ind)
+        return 0 if dets is None else len(dets)
+
+    def detectionCount(self):
+        self.compact()
+        if self.row_mask is not None:
+            return int(np.count_nonzero(self.row_mask))
+        return len(self.columns)
+
+    def detectionIds(self, detections, frames=None):
+        """
+        Returns the ids (rows in the column arrays) of the given detections as an array.
+        Views of earlier column arrays (replaced by compact) and other Detections are resolved by
+        frame and label (see getDetectionByLabel). The frames of the detections can be given in frames,
+        otherwise they are known only for views. Detections that are not found are skipped and counted in the log.
+        """
+        self.compact()
+        columns = self.columns
+        ids = []
+        missing = 0
+        for i, d in enumerate(detections):
+            if isinstance(d, DetectionView) and d.columns is columns:
+                ids.append(d.index)
+                continue
+
+            if frames is not None:
+                frame = frames[i]
+            elif isinstance(d, DetectionView):
+                frame = d.columns.rowFrame(d.index)
+            else:
+                frame = None
+
+            found = None if frame is None or not 0 <= frame < self.frame_count else self.getDetectionByLabel(frame, d.label)
+            if isinstance(found, DetectionView) and found.columns is columns:
+                ids.append(found.index)
+            else:
+                missing += 1
+
+        if missing > 0:
+            LogObject().print1(f"{missing} detections were not found in the detection store.")
+        return np.array(ids, dtype=np.int64)
+
+    def getRows(self):
+        """
+        Returns the rows of the detections in the store and their frame offsets, so that the rows of frame i
+        are rows[offsets[i]:offsets[i+1]] (CSR format). Pending frames are compacted first.
+        """
+        self.compact()
+        columns = self.columns
+        if self.row_mask is None:
+            return columns.frame_offsets, np.arange(len(columns), dtype=np.int64)
+
+        rows = np.nonzero(self.row_mask)[0]
+        counts = np.bincount(columns.rowFrames()[rows], minlength=self.frame_count)
+        return np.concatenate(([0], np.cumsum(counts))).astype(np.int64), rows
+
+    def excluding(self, ids):
+        """
+        Returns a read-only store without the detections with the given ids.
+        The returned store shares the column arrays with this store, so no detections are copied.
+        """
+        self.compact()
+        mask = np.ones(len(self.columns), dtype=bool) if self.row_mask is None else self.row_mask.copy()
+        mask[np.asarray(ids, dtype=np.int64)] = False
+
+        store = DetectionStore(0)
+        store.frame_count = self.frame_count
+        store.computed = self.computed
+        store.columns = self.columns
+        store.row_mask = mask
+        return store
+
+    def compact(self):
+        """
+        Moves pending frames to the column arrays.
+        """
+        if len(self.pending) == 0:
+            return
+
+        pending = self.pending
+        self.pending = {}
+
+        new_frames = []
+        new_dets = []
+        for ind in sorted(pending.keys()):
+            dets = pending[ind]
+            new_frames.extend([ind] * len(dets))
+            new_dets.extend(dets)
+
+        old = self.columns
+        new = DetectionColumns.fromDetections(self.frame_count, new_frames, new_dets)
+        first_frame = min(pending.keys())
+        if old.frame_offsets[first_frame] == len(old):
+            # No stored rows in the pending frames or after them (e.g. frames detected in order).
+            old.extend(first_frame, new_frames, new)
+            return
+
+        old_frames = old.rowFrames()
+        keep = ~np.isin(old_frames, np.fromiter(pending.keys(), dtype=np.int64, count=len(pending)))
+        old_rows = np.nonzero(keep)[0]
+        frames = np.concatenate((old_frames[old_rows], np.asarray(new_frames, dtype=np.int64)))
+        self.columns = DetectionColumns.concatenate(self.frame_count, frames,
+                                                    [(old, old_rows), (new, np.arange(len(new), dtype=np.int64))])
+
+    def release(self, end):
+        """
+        Removes the detections of the frames before end from memory, e.g. after they have been written to a file.
+        Released frames are marked not computed. Existing views of the released detections remain valid.
+        """
+        if self.row_mask is not None:
+            raise ValueError("Detections cannot be released from a store created with excluding")
+        self.compact()
+
+        end = min(end, self.frame_count)
+        columns = self.columns
+        start_row = int(columns.frame_offsets[end])
+        self.computed[:end] = False
+        if start_row == 0:
+            return
+
+        rows = np.arange(start_row, len(columns), dtype=np.int64)
+        self.columns = DetectionColumns.concatenate(self.frame_count, columns.rowFrames()[start_row:], [(columns, rows)])
+
+    def getBoxes(self, ind):
+        """
+        Returns the axis aligned bounding boxes [min_y, min_x, max_y, max_x] of the detections in a frame.
+        """
+        pending = self.pending.get(ind)
+        if pending is not None:
+            corners = np.array([d.corners for d in pending]).reshape(-1, 4, 2)
+        else:
+            columns = self.columns
+            start, end = columns.frame_offsets[ind], columns.frame_offsets[ind + 1]
+            corners = columns.corners[start:end]
+            if self.row_mask is not None:
+                corners = corners[self.row_mask[start:end]]
+        return np.concatenate((np.min(corners, axis=1), np.max(corners, axis=1)), axis=1)
+
+    def getVerticalDetections(self):
+        """
+        Returns the distances of the detections, split by frame.
+        """
+        self.compact()
+        return np.split(self.columns.distance, self.columns.frame_offsets[1:-1])
+
+    def getDetectionByLabel(self, ind, label):
+        """
+        Returns the detection with the given label in a frame or None if not found.
+        """
+        dets = self.getFrame(ind)
+        if dets is None:
+            return None
+
+        if ind in self.pending:
+            for d in dets:
+                if d.label == label:
+                    return d
+            return None
+
+        columns = self.columns
+        start, end = columns.frame_offsets[ind], columns.frame_offsets[ind + 1]
+        found = columns.label[start:end] == label
+        if self.row_mask is not None:
+            found &= self.row_mask[start:end]
+        matches = np.nonzero(found)[0]
+        if len(matches) == 0:
+            return None
+        return DetectionView(columns, start + matches[0])
+
+    @staticmethod
+    def fromFrames(frames):
+        """
+        Creates a store from per-frame lists of Detections (None for frames that are not computed).
+        """
+        store = DetectionStore(len(frames))
+        for ind, dets in enumerate(frames):
+            if dets is not None:
+                store.setFrame(ind, dets)
+        store.compact()
+        return store
@@ -29,13 +29,29 @@ import collections
 import os
 import sys
 import traceback
+import multiprocessing as mp
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 from playback_manager import PlaybackManager, Event, TestFigure
 from log_object import LogObject
 from mog_parameters import MOGParameters
 from detector_parameters import DetectorParameters
-from background_subtractor import BackgroundSubtractor
+from background_subtractor import BackgroundSubtractor, createMOG
+from batch_background import BatchBackgroundModel
+from detection import Detection
+from detection_store import DetectionStore
+from mask_cache import ForegroundMaskCache, fileIdentity, packMask, unpackMask
+from pipeline_stages import Stage, firstChangedStage, stageParameterValues
+from activity_filter import echogramActivity, packedMaskActivity, candidateFrames
+from clutter_mask import exclusionMask, applyExclusionMask, excludePixels, encodeMask, decodeMask
+from binary_median import binaryMedian, maskPixels
+from pixel_runs import encodeRuns, readPixels, runsToPixels
+from overlay_renderer import overlayAreas
+from roi import RegionOfInterest
+import file_handler as fh
+
+# Number of frames sent to a worker process at a time in parallel detection.
+PARALLEL_CHUNK_SIZE = 32
 
 def nothing(x):
     pass
@@ -43,6 +59,194 @@ def nothing(x):
 def round_up_to_odd(f):
     return np.ceil(f) // 2 * 2 + 1
 
+def filterMaskPixels(fg_mask_mog, params: DetectorParameters):
+	"""
+	Median filter stage. Removes noise from the raw foreground mask.
+	Returns (filtered mask, foreground pixel coordinates of the filtered mask).
+	"""
+	return binaryMedian(fg_mask_mog, params.getParameter(DetectorParameters.ParametersEnum.median_size))
+
+def filterMask(fg_mask_mog, params: DetectorParameters):
+	return filterMaskPixels(fg_mask_mog, params)[0]
+
+def clusterMask(fg_mask_filt, params: DetectorParameters):
+	"""
+	Clustering stage. Clusters the foreground pixels of a filtered mask.
+	Returns a list of (label, pixel coordinates) tuples.
+	"""
+	return clusterPixels(maskPixels(fg_mask_filt), params)
+
+def clusterPixels(data, params: DetectorParameters):
+	"""
+	Clusters foreground pixel coordinates (N x 2), see clusterMask.
+	"""
+	clusters = []
+
+	if data.shape[0] >= params.getParameter(DetectorParameters.ParametersEnum.min_fg_pixels):
+
+		# DBSCAN clusterer, NOTE: parameters should be in UI / read from file
+		clusterer = cluster.DBSCAN(eps=params.getParameter(DetectorParameters.ParametersEnum.dbscan_eps),
+						  min_samples=params.getParameter(DetectorParameters.ParametersEnum.dbscan_min_samples))
+		labels = clusterer.fit_predict(data)
+
+		data = data[labels != -1]
+		labels = labels[labels != -1]
+
+		for label in np.unique(labels):
+			foo = data[labels == label]
+			if foo.shape[0] < 2:
+				continue
+			clusters.append((label, foo))
+
+	return clusters
+
+def detectionsFromClusters(clusters, detection_size, polar_transform):
+	"""
+	Detection geometry stage. Creates detections from the clusters of a frame.
+	"""
+	detections = []
+	for label, data in clusters:
+		d = Detection(label)
+		d.init_from_data(data, detection_size, polar_transform)
+		detections.append(d)
+	return detections
+
+def clustersFromStore(store, ind):
+	"""
+	Returns the clusters of frame ind as a list of (label, pixel coordinates) tuples, decoded from the
+	pixel runs of the detections in a DetectionStore. Each cluster is stored as the runs of its detection,
+	so the pixels are the same (in the same row-major order) as the output of clusterPixels.
+	"""
+	columns = store.columns
+	start, end = store.getFrameSlice(ind)
+	return [(int(columns.label[row]), runsToPixels(columns.runs[columns.run_offsets[row]:columns.run_offsets[row + 1]]))
+		for row in range(start, end)]
+
+def detectFromMask(fg_mask_mog, params: DetectorParameters, polar_transform, exclusion_mask=None):
+	"""
+	Filters the foreground mask and clusters the remaining foreground pixels into detections.
+	Pixels in exclusion_mask (static clutter) are ignored in clustering.
+	Returns (detections, filtered mask).
+	"""
+	fg_mask_filt, pixels = filterMaskPixels(fg_mask_mog, params)
+	clusters = clusterPixels(excludePixels(pixels, exclusion_mask, fg_mask_mog.shape), params)
+	detection_size = params.getParameter(DetectorParameters.ParametersEnum.detection_size)
+	detections = detectionsFromClusters(clusters, detection_size, polar_transform)
+	return detections, fg_mask_filt
+
+
+DETECTIONS_FILE_HEADER = "frame;length;distance;angle;corner1 x;corner1 y;corner2 x;corner2 y;corner3 x;corner3 y;corner4 x;corner4 y\n"
+
+def writeFrameDetections(file, frame, dets):
+	"""
+	Writes the detections of a frame to an open detections file (see Detector.saveDetectionsToFile).
+	"""
+	# Default formatting
+	f1 = "{:.5f}"
+	lineBase1 = "{};" + "{};{};{};".format(f1,f1,f1)
+
+	for d in dets:
+		if d.corners is not None:
+			file.write(lineBase1.format(frame, d.length, d.distance, d.angle))
+			file.write(d.cornersToString(";"))
+			file.write("\n")
+
+def readDetectionLines(file, nof_frames=None):
+	"""
+	Reads the detections of an open detections file (see Detector.saveDetectionsToFile), after the header.
+	Returns a list of Detections for each frame (None if the frame has no detections) and the number of
+	detections ignored because their frame is out of range. If nof_frames is None, the last frame
+	in the file determines the number of frames.
+	"""
+	frames = {}
+	ignored_dets = 0
+
+	for line in file:
+		split_line = line.split(';')
+		frame = int(split_line[0])
+
+		if nof_frames is not None and frame >= nof_frames:
+			ignored_dets += 1
+			continue
+
+		length = float(split_line[1])
+		distance = float(split_line[2])
+		angle = float(split_line[3])
+
+		c1 = [float(split_line[5]), float(split_line[4])]
+		c2 = [float(split_line[7]), float(split_line[6])]
+		c3 = [float(split_line[9]), float(split_line[8])]
+		c4 = [float(split_line[11]), float(split_line[10])]
+		corners = np.array([c1, c2, c3, c4])
+
+		det = Detection(0)
+		det.init_from_file(corners, length, distance, angle)
+		frames.setdefault(frame, []).append(det)
+
+	if nof_frames is None:
+		nof_frames = max(frames.keys(), default=-1) + 1
+	return [frames.get(ind) for ind in range(nof_frames)], ignored_dets
+
+# State of a detection worker process, set by initDetectionWorker.
+_worker_state = {}
+
+def initDetectionWorker(mog_param_dict, det_param_dict, polar_transform, training_frames, exclusion_mask=None, region=None):
+	"""
+	Initializer for the worker processes used in Detector.computeAllParallel.
+	Rebuilds the background model from the same (polar) training frames that were used
+	in the main process. MOG2 is deterministic, so the resulting models are identical.
+	If region (CompiledRegion) is given, only its bounding box is remapped and modeled.
+	"""
+	mog_parameters = MOGParameters()
+	mog_parameters.setParameterDict(mog_param_dict)
+	det_parameters = DetectorParameters()
+	det_parameters.setParameterDict(det_param_dict)
+
+	fgbg_mog = createMOG(mog_parameters)
+	for polar in training_frames:
+		fgbg_mog.apply(remapToRegion(polar, polar_transform, region), learningRate=mog_parameters.data.learning_rate)
+
+	_worker_state["mog"] = fgbg_mog
+	_worker_state["parameters"] = det_parameters
+	_worker_state["polar_transform"] = polar_transform
+	_worker_state["exclusion_mask"] = exclusion_mask
+	_worker_state["region"] = region
+
+def remapToRegion(polar, polar_transform, region):
+	if region is None:
+		return polar_transform.remap(polar)
+	return region.remap(polar)
+
+def detectChunk(frames, mask_shape=None, return_masks=False):
+	"""
+	Detects the given frames in a worker process. Returns a list of (detections, packed mask) per frame.
+	If mask_shape is given, frames are cached foreground masks packed with packMask, and
+	background subtraction is skipped. Otherwise frames are polar frames.
+	Packed masks are returned only if return_masks is set.
+	"""
+	fgbg_mog = _worker_state["mog"]
+	params = _worker_state["parameters"]
+	polar_transform = _worker_state["polar_transform"]
+	exclusion_mask = _worker_state["exclusion_mask"]
+	region = _worker_state["region"]
+
+	if mask_shape is not None:
+		fg_masks = [unpackMask(frame, mask_shape) for frame in frames]
+	elif isinstance(fgbg_mog, BatchBackgroundModel):
+		# Batch models threshold the whole chunk at once.
+		fg_masks = fgbg_mog.applyBlock(np.stack([remapToRegion(frame, polar_transform, region) for frame in frames]))
+	else:
+		fg_masks = [fgbg_mog.apply(remapToRegion(frame, polar_transform, region), learningRate=0) for frame in frames]
+
+	results = []
+	for fg_mask_mog in fg_masks:
+		if mask_shape is None and region is not None:
+			fg_mask_mog = region.expand(fg_mask_mog)
+		detections, _ = detectFromMask(fg_mask_mog, params, polar_transform, exclusion_mask)
+		packed = packMask(fg_mask_mog) if return_masks and mask_shape is None else None
+		results.append((detections, packed))
+	return results
+
 class Detector(QtCore.QObject):
 
 	# When detector parameters change.
@@ -61,13 +265,36 @@ class Detector(QtCore.QObject):
 		super().__init__()
 		self.image_provider = image_provider
 		self.bg_subtractor = BackgroundSubtractor(image_provider)
+		self.mask_cache = ForegroundMaskCache()
+		self.filtered_mask_cache = ForegroundMaskCache()
 		self.parameters = None
 		self.applied_parameters = None
 
 		self.resetParameters()
-		self.detections = [None]
+		self.detections = DetectionStore(1)
 		self.vertical_detections = []
 
+		# DetectionStore of the latest computeAll and the key of its clustering stage. The clusters are
+		# read back from the pixel runs of the detections (see clustersFromStore), which allows
+		# recomputing detection geometry without clustering again.
+		self.cluster_source = None
+		self.cluster_key = None
+
+		# Echogram used in the activity prefilter, set by EchogramViewer.
+		self.echogram = None
+
+		# Fraction of frames skipped by the activity prefilter in the latest computeAll.
+		self.skipped_frame_fraction = 0.0
+
+		# Static clutter (boolean mask) excluded from clustering, and a counter that changes with the mask.
+		self.clutter_mask = None
+		self.clutter_mask_version = 0
+
+		# Region of interest compiled for the current image geometry (CompiledRegion), see getRegion.
+		self.region = None
+		self.exclusion_mask = None
+		self.exclusion_mask_key = None
+
 		self.current_ind = 0
 		self.current_len = 0
 
@@ -105,6 +332,8 @@ class Detector(QtCore.QObject):
 	def initMOG(self, clear_detections=True):
 		if clear_detections:
 			self.clearDetections()
+		self.updateRegion()
+		self.bg_subtractor.setCacheIdentity(self.getInputIdentity())
 		self.bg_subtractor.initMOG()
 
 	def compute_from_event(self, tuple):
@@ -124,9 +353,8 @@ class Detector(QtCore.QObject):
 			return images
 
 	def data_changed(self, ind):
-		dets = self.detections[ind]
 		self.current_ind = ind
-		self.current_len = 0 if dets is None else len(self.detections[ind])
+		self.current_len = self.detections.frameDetectionCount(ind)
 		self.data_changed_signal.emit(self.current_len)
 
 	def getPolarTransform(self):
@@ -136,57 +364,350 @@ class Detector(QtCore.QObject):
 			return None
 
 	def computeBase(self, ind, image, get_images=False, show_size=True):
-		params = self.parameters
-
 		image_o = image_o_gray = image
-		fg_mask_mog = self.bg_subtractor.subtractBG(image_o)
-		if fg_mask_mog is None:
-			return
+		fg_mask_mog = None
+		fg_mask_filt = self.getCachedFilteredMask(ind)
 
-		fg_mask_cpy = fg_mask_mog
-		fg_mask_filt = cv2.medianBlur(fg_mask_cpy, params.getParameter(DetectorParameters.ParametersEnum.median_size))
+		if fg_mask_filt is None or get_images:
+			fg_mask_mog = self.getForegroundMask(ind, image_o)
+			if fg_mask_mog is None:
+				return
 
-		data_tr = np.nonzero(np.asarray(fg_mask_filt))
-		data = np.asarray(data_tr).T
-		detections = []
+		detections, fg_mask_filt = self.detectFromForeground(ind, fg_mask_mog, fg_mask_filt, get_images)
+		if not self.computing and self.cluster_source is self.detections and self.getClusterKey() != self.cluster_key:
+			# Detections clustered with other parameters replace a part of the clusters.
+			self.cluster_source = None
+		self.detections[ind] = detections
 
 		if get_images:
 			image_o_rgb = cv2.applyColorMap(image_o, cv2.COLORMAP_OCEAN)
+			if len(detections) > 0:
+				colors = sns.color_palette('deep', max([d.label for d in detections]) + 1)
+				for d in detections:
+					image_o_rgb = d.visualize(image_o_rgb, colors[d.label], show_size)
 
-		if data.shape[0] >=params.getParameter(DetectorParameters.ParametersEnum.min_fg_pixels):
+			return (fg_mask_mog, image_o_gray, image_o_rgb, fg_mask_filt)
 
-			# DBSCAN clusterer, NOTE: parameters should be in UI / read from file
-			clusterer = cluster.DBSCAN(eps=params.getParameter(DetectorParameters.ParametersEnum.dbscan_eps),
-							  min_samples=params.getParameter(DetectorParameters.ParametersEnum.dbscan_min_samples))
-			labels = clusterer.fit_predict(data)
-		
-			data = data[labels != -1]
-			labels = labels[labels != -1]
+	def detectFromForeground(self, ind, fg_mask_mog, fg_mask_filt=None, get_images=False):
+		"""
+		Filters and clusters the foreground mask of frame ind. If the median filtered mask (fg_mask_filt)
+		is already known, fg_mask_mog is not used. Returns the detections and the filtered mask
+		(without the excluded pixels if get_images is set). The results are not stored.
+		"""
+		params = self.parameters
+		pixels = None
+		if fg_mask_filt is None:
+			fg_mask_filt, pixels = self.getFilteredMask(ind, fg_mask_mog)
+
+		if pixels is None:
+			pixels = maskPixels(fg_mask_filt)
+		exclusion_mask = self.getExclusionMask()
+		clusters = clusterPixels(excludePixels(pixels, exclusion_mask, fg_mask_filt.shape), params)
+		if get_images:
+			fg_mask_filt = applyExclusionMask(fg_mask_filt, exclusion_mask)
+		detection_size = params.getParameter(DetectorParameters.ParametersEnum.detection_size)
+		detections = detectionsFromClusters(clusters, detection_size, self.getPolarTransform())
+		return detections, fg_mask_filt
 
-			if labels.shape[0] > 0:
+	def getInputIdentity(self):
+		"""
+		Returns a tuple identifying the input of the background model: the file and the
+		PolarTransform geometry. Returns None if the geometry is not known yet.
+		"""
+		polar_transform = self.getPolarTransform()
+		if polar_transform is None:
+			return None
+		geometry = (tuple(polar_transform.pol_shape), tuple(polar_transform.cart_shape),
+			tuple(float(r) for r in polar_transform.radius_limits), tuple(float(a) for a in polar_transform.angle_limits))
+		return (fileIdentity(getattr(self.image_provider, "path", None)), geometry)
 
-				polar_transform = self.getPolarTransform()
+	def getMaskCacheKey(self):
+		"""
+		Returns the key identifying cached foreground masks: the file, the image geometry
+		and the trained background model.
+		"""
+		model_key = self.bg_subtractor.getModelKey()
+		if model_key is None:
+			return None
+		polar_transform = self.getPolarTransform()
+		cart_shape = None if polar_transform is None else tuple(polar_transform.cart_shape)
+		return (fileIdentity(getattr(self.image_provider, "path", None)), self.image_provider.getFrameCount(),
+			cart_shape, model_key)
 
-				for label in np.unique(labels):
-					foo = data[labels == label]
-					if foo.shape[0] < 2:
-						continue
-			
-					d = Detection(label)
-					d.init_from_data(foo, params.getParameter(DetectorParameters.ParametersEnum.detection_size), polar_transform)
-					detections.append(d)
+	def getFilteredMaskCacheKey(self):
+		"""
+		Returns the key identifying cached median filtered masks.
+		"""
+		key = self.getMaskCacheKey()
+		if key is None:
+			return None
+		return key + (stageParameterValues(self.parameters, Stage.MEDIAN_FILTER),)
 
-				if get_images:
-					colors = sns.color_palette('deep', np.unique(labels).max() + 1)
-					for d in detections:
-						image_o_rgb = d.visualize(image_o_rgb, colors[d.label], show_size)
+	def getClusterKey(self):
+		"""
+		Returns the key identifying the cached clusters.
+		"""
+		key = self.getFilteredMaskCacheKey()
+		if key is None:
+			return None
+		return key + (stageParameterValues(self.parameters, Stage.ACTIVITY_FILTER),
+			stageParameterValues(self.parameters, Stage.CLUTTER_MASK), self.clutter_mask_version,
+			stageParameterValues(self.parameters, Stage.CLUSTERING))
 
-		self.detections[ind] = detections
+	def setClutterMask(self, mask):
+		"""
+		Sets the static clutter mask excluded from clustering.
+		"""
+		if mask is None and self.clutter_mask is None:
+			return
+		if mask is not None and self.clutter_mask is not None and np.array_equal(mask, self.clutter_mask):
+			return
+		self.clutter_mask = mask
+		self.clutter_mask_version += 1
 
-		if get_images:
-			return (fg_mask_mog, image_o_gray, image_o_rgb, fg_mask_filt)
+	def updateClutterMask(self):
+		"""
+		Derives the static clutter mask from the foreground occupancy accumulated while
+		training the background model. Pixels that are foreground in at least a fraction
+		clutter_occupancy of the sampled frames are excluded. If the model has not been trained
+		in this session (e.g. parameters loaded from a file), the existing mask is kept.
+		"""
+		if not self.parameters.getParameter(DetectorParameters.ParametersEnum.clutter_filter):
+			return
+		occupancy = self.bg_subtractor.occupancy
+		if occupancy is None:
+			return
+
+		threshold = self.parameters.getParameter(DetectorParameters.ParametersEnum.clutter_occupancy)
+		mask = exclusionMask(occupancy, self.bg_subtractor.occupancy_count, threshold)
+		self.setClutterMask(mask)
+		if mask is not None:
+			LogObject().print1(f"Clutter mask: excluding {np.count_nonzero(mask)} pixels.")
+
+	def getExclusionMask(self):
+		"""
+		Returns the mask of pixels excluded from clustering: the clutter mask if clutter filtering
+		is enabled and the pixels outside the region of interest. Returns None if nothing is excluded.
+		"""
+		clutter_filter = self.parameters.getParameter(DetectorParameters.ParametersEnum.clutter_filter)
+		clutter_mask = self.clutter_mask if clutter_filter else None
+		region = self.getRegion()
+		if region is None:
+			return clutter_mask
+
+		key = (self.clutter_mask_version if clutter_mask is not None else None, region.key)
+		if key != self.exclusion_mask_key:
+			self.exclusion_mask = ~region.mask
+			if clutter_mask is not None and clutter_mask.shape == region.shape:
+				self.exclusion_mask |= clutter_mask
+			self.exclusion_mask_key = key
+		return self.exclusion_mask
+
+	def getRegion(self):
+		"""
+		Returns the region of interest compiled for the current image geometry, or None
+		if no region is defined. The region is compiled only when it or the geometry changes.
+		"""
+		polar_transform = self.getPolarTransform()
+		roi = RegionOfInterest.fromParameters(self.parameters)
+		if not roi.isDefined() or polar_transform is None:
+			self.region = None
+		elif self.region is None or self.region.key != (roi.getKey(), tuple(polar_transform.cart_shape)):
+			self.region = roi.compile(polar_transform)
+			LogObject().print1(f"Region of interest: processing {100 * self.region.fraction():.1f} % of the image.")
+		return self.region
+
+	def updateRegion(self):
+		"""
+		Passes the current region of interest to the background subtractor.
+		Changing the region invalidates the background model.
+		"""
+		self.bg_subtractor.setRegion(self.getRegion())
+
+	def setEchogram(self, echogram):
+		self.echogram = echogram
+
+	def getCandidateFrames(self, count):
+		"""
+		Activity prefilter. Returns a boolean array marking the frames where detection is run,
+		or None if all frames are detected. Activity is measured from the background subtracted
+		echogram if available, otherwise from the foreground pixel count of each frame (see foregroundActivity).
+		"""
+		params = self.parameters
+		if not params.getParameter(DetectorParameters.ParametersEnum.activity_filter):
+			return None
+
+		padding = params.getParameter(DetectorParameters.ParametersEnum.activity_padding)
+		if self.echogram is not None and self.echogram.bgs_data is not None and len(self.echogram.bgs_data) == count:
+			activity = echogramActivity(self.echogram.bgs_data)
+			threshold = params.getParameter(DetectorParameters.ParametersEnum.activity_threshold)
+		else:
+			activity = self.foregroundActivity(count)
+			if activity is None:
+				LogObject().print("Activity prefilter: Foreground not available, detecting all frames.")
+				return None
+			# Frames with fewer foreground pixels than min_fg_pixels are unlikely to contain detections.
+			threshold = params.getParameter(DetectorParameters.ParametersEnum.min_fg_pixels)
+
+		return candidateFrames(activity, threshold, padding)
+
+	def foregroundActivity(self, count):
+		"""
+		Returns the number of foreground pixels in the raw foreground mask of each frame. Masks that are
+		not cached are computed with the trained background model and stored in the mask cache, so that
+		detection does not subtract them again. Returns None if the model is updated while detecting
+		(rolling update) or if computing is stopped.
+		"""
+		if self.bg_subtractor.isRolling():
+			return None
+
+		use_cache = self.prepareMaskCache()
+		if use_cache and self.mask_cache.isComplete():
+			return packedMaskActivity(self.mask_cache.packed)
+
+		activity = np.zeros(count, dtype=np.int64)
+		ten_perc = 0.1 * count
+		print_limit = 0
+		for ind in range(count):
+			if ind > print_limit:
+				LogObject().print("Activity prefilter:", int(float(ind) / count * 100), "%")
+				print_limit += ten_perc
+
+			if self.stop_computing:
+				return None
+
+			if use_cache and self.mask_cache.contains(ind):
+				activity[ind] = packedMaskActivity(self.mask_cache.getPacked(ind)[np.newaxis])[0]
+				continue
+
+			fg_mask_mog = self.getForegroundMask(ind, self.image_provider.getFrame(ind))
+			if fg_mask_mog is not None:
+				activity[ind] = np.count_nonzero(fg_mask_mog)
+		return activity
+
+	def prepareCache(self, cache, key):
+		"""
+		Clears the cache if it does not match the key. Returns True if the cache can be used.
+		"""
+		if key is None:
+			return False
+		if not cache.isValid(key):
+			cache.reset(key, self.image_provider.getFrameCount())
+		return True
+
+	def prepareMaskCache(self):
+		"""
+		Clears the mask cache if it does not match the current file and background model.
+		Returns True if the cache can be used.
+		"""
+		return self.prepareCache(self.mask_cache, self.getMaskCacheKey())
+
+	def prepareFilteredMaskCache(self):
+		return self.prepareCache(self.filtered_mask_cache, self.getFilteredMaskCacheKey())
+
+	def isMaskCached(self, ind):
+		"""
+		Returns True if the frame is not needed to compute the detections of frame ind.
+		"""
+		return (self.prepareFilteredMaskCache() and self.filtered_mask_cache.contains(ind)) \
+			or (self.prepareMaskCache() and self.mask_cache.contains(ind))
+
+	def clustersAvailable(self):
+		"""
+		Returns True if the clusters of all frames are available for the current parameters.
+		"""
+		source = self.cluster_source
+		return self.cluster_key is not None and self.cluster_key == self.getClusterKey() \
+			and source is not None and source is self.detections \
+			and len(source) == self.image_provider.getFrameCount() and np.all(source.computed)
+
+	def getRecomputeStage(self):
+		"""
+		Returns the earliest stage of the detection pipeline that has to be recomputed,
+		based on the applied parameters and the cached stage outputs.
+		Returns None if everything is up to date.
+		"""
+		if self.bg_subtractor.parametersDirty() or self.bg_subtractor.getModelKey() is None:
+			return Stage.BACKGROUND_MODEL
+
+		if self.clustersAvailable():
+			# Median filter and clustering parameters are a part of the cluster key.
+			stage = firstChangedStage(self.applied_parameters, self.parameters)
+			return Stage.DETECTION_GEOMETRY if stage is not None else None
+
+		if self.prepareFilteredMaskCache() and self.filtered_mask_cache.isComplete():
+			return Stage.CLUTTER_MASK
+		if self.prepareMaskCache() and self.mask_cache.isComplete():
+			return Stage.MEDIAN_FILTER
+		return Stage.FOREGROUND_MASK
+
+	def getForegroundMask(self, ind, image):
+		"""
+		Returns the raw foreground mask of frame ind. Uses the mask cache if the mask
+		has already been computed with the current background model.
+		"""
+		if not self.prepareMaskCache():
+			return self.bg_subtractor.subtractBG(image)
+
+		fg_mask_mog = self.mask_cache.get(ind)
+		if fg_mask_mog is None:
+			fg_mask_mog = self.bg_subtractor.subtractBG(image)
+			if fg_mask_mog is not None:
+				self.mask_cache.put(ind, fg_mask_mog)
+		return fg_mask_mog
+
+	def getCachedFilteredMask(self, ind):
+		"""
+		Returns the median filtered mask of frame ind if it has been cached with the current parameters.
+		"""
+		if not self.prepareFilteredMaskCache():
+			return None
+		return self.filtered_mask_cache.get(ind)
+
+	def getFilteredMask(self, ind, fg_mask_mog):
+		"""
+		Returns the median filtered foreground mask of frame ind and its foreground pixels,
+		and stores the mask in the cache.
+		"""
+		fg_mask_filt, pixels = filterMaskPixels(fg_mask_mog, self.parameters)
+		if self.prepareFilteredMaskCache():
+			self.filtered_mask_cache.put(ind, fg_mask_filt)
+		return fg_mask_filt, pixels
 
 	def computeAll(self):
+		if not self.beginComputeAll():
+			return
+
+		count = self.image_provider.getFrameCount()
+		processes = fh.getConfValue(fh.ConfKeys.detection_processes)
+		stage = self.getRecomputeStage()
+		source = self.detections
+		self.detections = DetectionStore(count)
+
+		if stage is None or stage >= Stage.DETECTION_GEOMETRY:
+			LogObject().print1("Computing detections from cached clusters.")
+			self.cluster_source = self.detections
+			completed = self.computeGeometryAll(count, source)
+		else:
+			LogObject().print1(f"Computing detections from stage: {stage.name}")
+			candidates = self.resetClusters(count)
+
+			# Rolling update requires the frames to be processed in order.
+			if processes > 1 and self.canComputeInParallel() and not self.bg_subtractor.isRolling():
+				completed = self.computeAllParallel(count, processes, candidates)
+			else:
+				completed = self.computeAllSerial(count, candidates)
+
+		if not completed:
+			return
+
+		self.finishComputeAll()
+
+	def beginComputeAll(self):
+		"""
+		Prepares computing all frames: trains the background model if needed and updates the
+		region of interest and the clutter mask. Returns False if stopped before detecting.
+		"""
 		self.computing = True
 		self.stop_computing = False
 		self.compute_on_event = False
@@ -195,41 +716,205 @@ class Detector(QtCore.QObject):
 		LogObject().print1(self.bg_subtractor.mog_parameters)
 		LogObject().print1(self.parameters)
 
-		if self.bg_subtractor.parametersDirty():
+		self.updateRegion()
+		rolling = self.bg_subtractor.isRolling()
+		if self.bg_subtractor.parametersDirty() or (rolling and self.bg_subtractor.model_modified):
 			self.initMOG()
 			if self.bg_subtractor.parametersDirty():
 				LogObject().print("Stopped before detecting.")
 				self.abortComputing(True)
-				return
+				return False
 
-		count = self.image_provider.getFrameCount()
+		self.updateClutterMask()
+		return True
+
+	def resetClusters(self, count):
+		"""
+		Clears the cached clusters before detecting all frames.
+		Returns the candidate frames of the activity prefilter (see getCandidateFrames).
+		"""
+		self.cluster_source = self.detections
+		self.cluster_key = self.getClusterKey()
+
+		candidates = self.getCandidateFrames(count)
+		if candidates is not None:
+			skipped = count - np.count_nonzero(candidates)
+			self.skipped_frame_fraction = skipped / count if count > 0 else 0.0
+			LogObject().print(f"Activity prefilter: skipping {skipped} of {count} frames ({100 * self.skipped_frame_fraction:.1f} %).")
+		else:
+			self.skipped_frame_fraction = 0.0
+		return candidates
+
+	def finishComputeAll(self):
+		"""
+		Marks all frames computed with the current parameters and signals the results.
+		"""
+		LogObject().print("Detecting: 100 %")
+		self.computing = False
+		#self.detections_clearable = True
+		self.applied_parameters = self.parameters.copy()
+
+		self.updateVerticalDetections()
+
+		self.state_changed_signal.emit()
+		self.all_computed_signal.emit()
+
+	def computeAllSerial(self, count, candidates=None):
+		"""
+		Detects all frames one by one in the calling thread. If candidates is given,
+		only the candidate frames are detected and the others are recorded as empty.
+		Returns False if the process was stopped.
+		"""
 		ten_perc = 0.1 * count
 		print_limit = 0
+		self.bg_subtractor.beginRolling()
 		for ind in range(count):
 			if ind > print_limit:
 				LogObject().print("Detecting:", int(float(ind) / count * 100), "%")
 				print_limit += ten_perc
+				self.detections.compact()
 
 			if self.stop_computing:
 				LogObject().print("Stopped detecting at", ind)
+				if self.bg_subtractor.rolling_active:
+					# Masks of a partial rolling run depend on the frames processed before them.
+					self.mask_cache.clear()
+					self.filtered_mask_cache.clear()
+				self.bg_subtractor.endRolling()
 				self.abortComputing(False)
-				return
+				return False
+
+			if candidates is not None and not candidates[ind]:
+				self.detections[ind] = []
+				continue
 
-			img = self.image_provider.getFrame(ind)
+			# Frame is not needed if the foreground mask is already cached
+			img = None if self.isMaskCached(ind) else self.image_provider.getFrame(ind)
 			self.computeBase(ind, img)
 
-		LogObject().print("Detecting: 100 %")
-		self.computing = False
-		#self.detections_clearable = True
-		self.applied_parameters = self.parameters.copy()
+		self.bg_subtractor.endRolling()
+		self.detections.compact()
+		return True
 
-		self.updateVerticalDetections()
+	def computeGeometryAll(self, count, source):
+		"""
+		Recomputes the detections of all frames from the clusters of the previous detections (source).
+		Used when only detection geometry parameters have changed.
+		Returns False if the process was stopped.
+		"""
+		detection_size = self.parameters.getParameter(DetectorParameters.ParametersEnum.detection_size)
+		polar_transform = self.getPolarTransform()
+		source.compact()
 
-		self.state_changed_signal.emit()
-		self.all_computed_signal.emit()
+		ten_perc = 0.1 * count
+		print_limit = 0
+		for ind in range(count):
+			if ind > print_limit:
+				LogObject().print("Detecting:", int(float(ind) / count * 100), "%")
+				print_limit += ten_perc
+				self.detections.compact()
+
+			if self.stop_computing:
+				LogObject().print("Stopped detecting at", ind)
+				self.abortComputing(False)
+				return False
+
+			self.detections[ind] = detectionsFromClusters(clustersFromStore(source, ind), detection_size, polar_transform)
+
+		self.detections.compact()
+		return True
+
+	def canComputeInParallel(self):
+		"""
+		Parallel detection requires access to the polar frames and the polar transform,
+		which are sent to the worker processes instead of the (larger) cartesian frames.
+		"""
+		return hasattr(self.image_provider, "getPolarFrame") and self.getPolarTransform() is not None
+
+	def computeAllParallel(self, count, processes, candidates=None):
+		"""
+		Splits the frames into chunks of PARALLEL_CHUNK_SIZE frames and detects them in a pool
+		of worker processes. Each worker rebuilds the background model from the training frames.
+		If candidates is given, only the candidate frames are detected and the others are recorded as empty.
+		Results are gathered in order. Returns False if the process was stopped.
+		"""
+		polar_transform = self.getPolarTransform()
+		use_cache = self.prepareMaskCache()
+
+		# Workers do not need a background model if all the masks are cached.
+		if use_cache and self.mask_cache.isComplete():
+			training_frames = []
+		else:
+			training_frames = [self.image_provider.getPolarFrame(ind) for ind in self.bg_subtractor.getTrainingIndices()]
+		init_args = (self.bg_subtractor.mog_parameters.getParameterDict(), self.parameters.getParameterDict(),
+			   polar_transform, training_frames, self.getExclusionMask(), self.bg_subtractor.trained_region)
+
+		LogObject().print1(f"Detecting in {processes} processes.")
+
+		chunk_starts = list(range(0, count, PARALLEL_CHUNK_SIZE))
+		pending = collections.deque()
+		next_chunk = 0
+		ten_perc = 0.1 * count
+		print_limit = 0
+
+		pool = mp.get_context("spawn").Pool(processes, initDetectionWorker, init_args)
+		try:
+			while next_chunk < len(chunk_starts) or len(pending) > 0:
+				# Keep a bounded number of chunks in flight, so that polar frames
+				# are not all copied to the workers at once.
+				while next_chunk < len(chunk_starts) and len(pending) < 2 * processes:
+					start = chunk_starts[next_chunk]
+					end = min(start + PARALLEL_CHUNK_SIZE, count)
+					next_chunk += 1
+
+					# Frames skipped by the activity prefilter are not sent to the workers.
+					indices = [ind for ind in range(start, end) if candidates is None or candidates[ind]]
+					for ind in range(start, end):
+						if candidates is not None and not candidates[ind]:
+							self.detections[ind] = []
+					if len(indices) == 0:
+						continue
+
+					if use_cache and all(self.mask_cache.contains(ind) for ind in indices):
+						masks = [self.mask_cache.getPacked(ind) for ind in indices]
+						args = (masks, self.mask_cache.shape, False)
+					else:
+						frames = [self.image_provider.getPolarFrame(ind) for ind in indices]
+						args = (frames, None, use_cache)
+					pending.append((start, indices, pool.apply_async(detectChunk, args)))
+
+				if len(pending) == 0:
+					continue
+
+				start, indices, result = pending.popleft()
+				while not result.ready():
+					if self.stop_computing:
+						LogObject().print("Stopped detecting at", start)
+						pool.terminate()
+						self.abortComputing(False)
+						return False
+					result.wait(0.1)
+
+				for ind, (detections, packed) in zip(indices, result.get()):
+					self.detections[ind] = detections
+					if packed is not None:
+						self.mask_cache.putPacked(ind, packed, polar_transform.cart_shape)
+
+				if start > print_limit:
+					LogObject().print("Detecting:", int(float(start) / count * 100), "%")
+					print_limit += ten_perc
+					self.detections.compact()
+
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+
+		self.detections.compact()
+		return True
 
 	def updateVerticalDetections(self):
-		self.vertical_detections = [[d.distance for d in dets if d.center is not None] if dets is not None else [] for dets in self.detections]
+		self.vertical_detections = self.detections.getVerticalDetections()
 
 	def abortComputing(self, mog_aborted):
 		self.stop_computing = False
@@ -245,7 +930,7 @@ class Detector(QtCore.QObject):
 	def clearDetections(self):
 		LogObject().print2("Cleared detections")
 		nof_frames = self.image_provider.getFrameCount()
-		self.detections = [None] * nof_frames
+		self.detections = DetectionStore(nof_frames)
 		self.vertical_detections = []
 		#self.detections_clearable = False
 		self.applied_parameters = None
@@ -268,10 +953,7 @@ class Detector(QtCore.QObject):
 			detections = self.getCurrentDetection()
 
 		colors = sns.color_palette('deep', max([0] + [d.label + 1 for d in detections]))
-		for d in detections:
-			image = d.visualizeArea(image, colors[d.label])
-
-		return image
+		return overlayAreas(image, [(d.runs, colors[d.label]) for d in detections])
 
 	def setParameter(self, key, value):
 		self.parameters.setKeyValuePair(key, value)
@@ -290,15 +972,12 @@ class Detector(QtCore.QObject):
 	def getDetection(self, ind):
 		try:
 			dets = self.detections[ind]
-			if dets is None:
-				return []
-
-			return [d for d in dets if d.center is not None]
+			return [] if dets is None else dets
 		except IndexError:
 			LogObject().print2(traceback.format_exc())
 
 	def getDetections(self):
-		return [[d for d in dets if d.center is not None] if dets is not None else [] for dets in self.detections]
+		return [[] if dets is None else dets for dets in self.detections]
 
 	def getCurrentDetection(self):
 		return self.getDetection(self.current_ind)
@@ -308,7 +987,10 @@ class Detector(QtCore.QObject):
 			detector_params = self.parameters.getParameterDict()
 			bg_sub_params = self.bg_subtractor.mog_parameters.getParameterDict()
 
-			return { "bg_subtractor": bg_sub_params, "detector": detector_params }
+			param_dict = { "bg_subtractor": bg_sub_params, "detector": detector_params }
+			if self.clutter_mask is not None:
+				param_dict["clutter_mask"] = encodeMask(self.clutter_mask)
+			return param_dict
 		else:
 			return None
 
@@ -327,6 +1009,9 @@ class Detector(QtCore.QObject):
 		else:
 			LogObject().print2("Background subtractor parameters not found.")
 
+		if "clutter_mask" in param_dict.keys():
+			self.setClutterMask(decodeMask(param_dict["clutter_mask"]))
+
 	def bgSubtraction(self, image):
 		median_size = self.parameters.getParameter(DetectorParameters.ParametersEnum.median_size)
 		return self.bg_subtractor.subtractBGFiltered(image, median_size)
@@ -342,20 +1027,12 @@ class Detector(QtCore.QObject):
 		Writes current detections to a file at path. Values are separated by ';'.
 		"""
 
-		# Default formatting
-		f1 = "{:.5f}"
-		lineBase1 = "{};" + "{};{};{};".format(f1,f1,f1)
-
 		try:
 			with open(path, "w") as file:
-				file.write("frame;length;distance;angle;corner1 x;corner1 y;corner2 x;corner2 y;corner3 x;corner3 y;corner4 x;corner4 y\n")
+				file.write(DETECTIONS_FILE_HEADER)
 				for frame, dets in enumerate(self.detections):
 					if dets is not None:
-						for d in dets:
-							if d.corners is not None:
-								file.write(lineBase1.format(frame, d.length, d.distance, d.angle))
-								file.write(d.cornersToString(";"))
-								file.write("\n")
+						writeFrameDetections(file, frame, dets)
 				LogObject().print("Detections saved to path:", path)
 
 		except PermissionError as e:
@@ -369,36 +1046,11 @@ class Detector(QtCore.QObject):
 			with open(path, 'r') as file:
 				self.clearDetections()
 				nof_frames = self.image_provider.getFrameCount()
-				ignored_dets = 0
 
 				header = file.readline()
+				frames, ignored_dets = readDetectionLines(file, nof_frames)
 
-				for line in file:
-					split_line = line.split(';')
-					frame = int(split_line[0])
-
-					if frame >= nof_frames:
-						ignored_dets += 1
-						continue
-
-					length = float(split_line[1])
-					distance = float(split_line[2])
-					angle = float(split_line[3])
-
-					c1 = [float(split_line[5]), float(split_line[4])]
-					c2 = [float(split_line[7]), float(split_line[6])]
-					c3 = [float(split_line[9]), float(split_line[8])]
-					c4 = [float(split_line[11]), float(split_line[10])]
-					corners = np.array([c1, c2, c3, c4])
-
-					det = Detection(0)
-					det.init_from_file(corners, length, distance, angle)
-
-					if self.detections[frame] is None:
-						self.detections[frame] = [det]
-					else:
-						self.detections[frame].append(det)
-
+				self.detections = DetectionStore.fromFrames(frames)
 				self.updateVerticalDetections()
 				self.compute_on_event = False
 				if ignored_dets > 0:
@@ -414,12 +1066,19 @@ class Detector(QtCore.QObject):
 		"""
 		Returns a dictionary of detection data to be saved in SaveManager.
 		"""
-		detections = {}
-		for frame, dets in enumerate(self.detections):
-			if dets is None:
-				continue
+		self.detections.compact()
+		columns = self.detections.columns
+
+		# Convert whole columns at once instead of per detection
+		labels = columns.label.tolist()
+		runs = columns.runs
+		run_offsets = columns.run_offsets.tolist()
+		frame_offsets = columns.frame_offsets.tolist()
 
-			dets_in_frame = [d.convertToWritable() for d in dets if d.corners is not None]
+		detections = {}
+		for frame in range(len(frame_offsets) - 1):
+			dets_in_frame = [[labels[i], encodeRuns(runs[run_offsets[i]:run_offsets[i+1]])]
+					for i in range(frame_offsets[frame], frame_offsets[frame+1]) if run_offsets[i] < run_offsets[i+1]]
 			if len(dets_in_frame) > 0:
 				detections[str(frame)] = dets_in_frame
 
@@ -434,6 +1093,7 @@ class Detector(QtCore.QObject):
 		self.setParameterDict(parameters, True)
 
 		polar_transform = self.getPolarTransform()
+		detection_size = self.parameters.getParameter(DetectorParameters.ParametersEnum.detection_size)
 
 		for frame in range(len(self.detections)):
 			frame_dets = []
@@ -443,142 +1103,18 @@ class Detector(QtCore.QObject):
 					label = det_data[0]
 					det_data = det_data[1]
 					det = Detection(int(label))
-					detection_size = self.parameters.getParameter(DetectorParameters.ParametersEnum.detection_size)
-					det.init_from_data(det_data, detection_size, polar_transform)
+					det.init_from_data(readPixels(det_data), detection_size, polar_transform)
 					frame_dets.append(det)
 
-			try:
-				self.detections[frame] = frame_dets
-			except IndexError as e:
-				print(frame, len(self.detections))
-				raise e
+			self.detections[frame] = frame_dets
 
+		self.detections.compact()
 		self.updateVerticalDetections()
 		self.compute_on_event = False
 		self.state_changed_signal.emit()
 		self.all_computed_signal.emit()
 
 
-class Detection:
-	def __init__(self, label):
-		self.label = label
-		self.data = None
-		self.diff = None
-		self.center = None
-		self.corners = None
-
-		self.length = 0
-		self.distance = 0
-		self.angle = 0
-
-	def __repr__(self):
-		return "Detection \"{}\" d:{:.1f}, a:{:.1f}".format(self.label, self.distance, self.angle)
-
-	def init_from_data(self, data, detection_size, polar_transform):
-		"""
-		Initialize detection parameters from the pixel data from the clusterer / detection algorithm. Saved pixel data
-		can also be used to (re)initialize the detection.
-		"""
-		self.data = np.asarray(data)
-
-		ca = np.cov(data, y=None, rowvar=0, bias=1)
-		v, vect = np.linalg.eig(ca)
-		tvect = np.transpose(vect)
-		ar = np.dot(data, np.linalg.inv(tvect))
-
-		# NOTE a fixed parameter --> to UI / file.
-		if ar.shape[0] > detection_size: #10:
-
-			mina = np.min(ar, axis=0)
-			maxa = np.max(ar, axis=0)
-			diff = (maxa - mina) * 0.5
-					
-			center = mina + diff
-
-			# Get the 4 corners by subtracting and adding half the bounding boxes height and width to the center
-			corners = np.array([center+[-diff[0],-diff[1]], \
-								center+[diff[0],-diff[1]], \
-								center+[diff[0],diff[1]], \
-								center+[-diff[0],diff[1]]])#, \
-								#center+[-diff[0],-diff[1]]])
-
-			self.diff = diff
-
-			# Use the the eigenvectors as a rotation matrix and rotate the corners and the center back
-			self.corners = np.dot(corners, tvect)
-			self.center = np.dot(center, tvect)
-
-			if polar_transform is not None:
-				metric_diff = polar_transform.pix2metCI(diff[0], diff[1])
-				self.length = float(2 * metric_diff[1])
-				self.distance, self.angle = polar_transform.cart2polMetric(self.center[0], self.center[1], True)
-				self.distance = float(self.distance)
-				self.angle = float(self.angle / np.pi * 180 + 90)
-
-	def init_from_file(self, corners, length, distance, angle):
-		"""
-		Initialize detection parameters from a csv file. Data is not stored when exporting a csv file,
-		which means it cannot be recovered here. This mainly affects the visualization of the detection.
-		"""
-		self.corners = np.array(corners)
-		self.center = np.average(self.corners, axis=0)
-		self.diff = self.center - self.corners[0]
-		self.length = length
-		self.distance = distance
-		self.angle = angle
-
-	def visualize(self, image, color, show_text, show_detection=True):
-		if self.corners is None:
-			return image
-
-		# Draw size text
-		if show_text:
-			if self.length > 0:
-				size_txt = self.getSizeText()
-				image = cv2.putText(image, size_txt, (int(self.center[1])-20, int(self.center[0])-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1, cv2.LINE_AA)
-
-		# Draw detection area and bounding box
-		if show_detection:
-			self.visualizeArea(image, color)
-
-			for i in range(0,3):
-				cv2.line(image, (int(self.corners[i,1]),int(self.corners[i,0])), (int(self.corners[i+1,1]),int(self.corners[i+1,0])),  (255,255,255), 1)
-			cv2.line(image, (int(self.corners[3,1]),int(self.corners[3,0])), (int(self.corners[0,1]),int(self.corners[0,0])),  (255,255,255), 1)
-
-		return image
-
-	def visualizeArea(self, image, color):
-		if self.data is not None:
-			_color = (int(255*color[0]), int(255*color[1]), int(255*color[2]))
-			for i in range(self.data.shape[0]):
-				cv2.line(image, (self.data[i,1], self.data[i,0]), (self.data[i,1], self.data[i,0]), _color, 2)
-
-		return image
-
-	def getSizeText(self):
-		return 'Size: ' + str(int(100*self.length))
-	
-	def getMessage(self):
-		# This message was used to send data to tracker process (C++) or save detections to file
-		if self.diff is None:
-			return ""
-		
-		return str(int(self.center[1]*10)) + ' ' + str(int(self.center[0]*10)) + ' ' + str(int(self.diff[1]*2))
-
-	def cornersToString(self, delim):
-		if self.corners is None:
-			return ""
-
-		base = "{:.2f}" + delim + "{:.2f}"
-		return delim.join(base.format(cx,cy) for cy, cx in self.corners[0:4])
-
-	def convertToWritable(self):
-		"""
-		Returns data in applicable format to be used by SaveManager
-		"""
-		return [int(self.label), list(map(lambda x: [int(x[0]), int(x[1])], self.data))]
-
-
 class DetectorDisplay:
 	def __init__(self):
 		self.array = [cv2.imread(file, 0) for file in sorted(glob.glob("out/*.png"))]
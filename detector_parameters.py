@@ -18,7 +18,7 @@ along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from enum import Enum, auto
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from parameters_base import ParametersBase
 from mog_parameters import MOGParameters
 
@@ -30,6 +30,16 @@ class DetectorParameters(ParametersBase):
 		median_size: int = 3
 		dbscan_eps: int = 10
 		dbscan_min_samples: int = 10
+		activity_filter: bool = False
+		activity_threshold: int = 1
+		activity_padding: int = 10
+		clutter_filter: bool = False
+		clutter_occupancy: float = 0.5
+		roi_min_range: float = 0.0
+		roi_max_range: float = 0.0
+		roi_min_angle: float = 0.0
+		roi_max_angle: float = 0.0
+		roi_polygon: list = field(default_factory=list)
 
 	class ParametersEnum(Enum):
 		detection_size = auto()
@@ -37,6 +47,16 @@ class DetectorParameters(ParametersBase):
 		median_size = auto()
 		dbscan_eps = auto()
 		dbscan_min_samples = auto()
+		activity_filter = auto()
+		activity_threshold = auto()
+		activity_padding = auto()
+		clutter_filter = auto()
+		clutter_occupancy = auto()
+		roi_min_range = auto()
+		roi_max_range = auto()
+		roi_min_angle = auto()
+		roi_max_angle = auto()
+		roi_polygon = auto()
 
 	def __init__(self, *args, **kwargs):
 		"""
@@ -46,5 +66,15 @@ class DetectorParameters(ParametersBase):
 		median_size: int = 3
 		dbscan_eps: int = 10
 		dbscan_min_samples: int = 10
+		activity_filter: bool = False
+		activity_threshold: int = 1
+		activity_padding: int = 10
+		clutter_filter: bool = False
+		clutter_occupancy: float = 0.5
+		roi_min_range: float = 0.0
+		roi_max_range: float = 0.0
+		roi_min_angle: float = 0.0
+		roi_max_angle: float = 0.0
+		roi_polygon: list = []
 		"""
 		super().__init__(self.Parameters(*args, **kwargs))
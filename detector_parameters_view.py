@@ -29,6 +29,7 @@ from detector_parameters import DetectorParameters
 from file_handler import getFilePathInAppData, checkAppDataPath
 from log_object import LogObject
 from mog_parameters import MOGParameters
+from batch_background import BACKGROUND_MODELS
 
 PARAMETERS_PATH = getFilePathInAppData("detector_parameters.json")
 parameters_lock = QReadWriteLock()
@@ -160,6 +161,18 @@ class DetectorParametersView(QWidget):
         # BG subtraction parameters
         bg_sub = detector.bg_subtractor
         bg_sub_data = bg_sub.mog_parameters.data
+
+        self.bg_model_combobox = QComboBox(self)
+        self.bg_model_combobox.addItems(BACKGROUND_MODELS)
+        self.bg_model_combobox.setCurrentText(bg_sub_data.bg_model)
+        self.bg_model_combobox.setToolTip("mog2: Gaussian mixture model updated frame by frame\n"
+                                          "percentile: Per-pixel percentile of the background frames\n"
+                                          "gaussian: Per-pixel mean and variance of the background frames")
+        lambda_bg_model = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.bg_model, x)
+        self.bg_model_combobox.currentTextChanged.connect(lambda_bg_model)
+        self.bg_model_combobox.currentTextChanged.connect(refresh_lambda)
+        self.form_layout2.addRow("Background model", self.bg_model_combobox)
+
         lambda_mog = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.mog_var_thresh, x)
         self.mog_var_threshold_line = addLine("MOG var threshold", bg_sub_data.mog_var_thresh, QIntValidator(0, 200),[lambda_mog, refresh_lambda], self.form_layout2)
 
@@ -171,6 +184,55 @@ class DetectorParametersView(QWidget):
         lr_validator.setNotation(QDoubleValidator.StandardNotation);
         self.learning_rate_line = addLine("Learning rate", bg_sub_data.learning_rate, lr_validator, [lambda_learning_rate, refresh_lambda], self.form_layout2)
 
+        lambda_bg_percentile = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.bg_percentile, x)
+        self.bg_percentile_line = addLine("Background percentile", bg_sub_data.bg_percentile, QIntValidator(0, 100), [lambda_bg_percentile], self.form_layout2)
+
+        lambda_bg_threshold = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.bg_threshold, x)
+        self.bg_threshold_line = addLine("Background threshold", bg_sub_data.bg_threshold, QIntValidator(0, 255), [lambda_bg_threshold], self.form_layout2)
+
+        # Rolling update
+        self.rolling_update_checkbox = QCheckBox("", self)
+        self.rolling_update_checkbox.setChecked(bg_sub_data.rolling_update)
+        self.rolling_update_checkbox.setToolTip("Update the background model while detecting, so that it follows drifting conditions in long files")
+        lambda_rolling_update = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.rolling_update, x)
+        self.rolling_update_checkbox.stateChanged.connect(lambda_rolling_update)
+        self.form_layout2.addRow("Rolling update", self.rolling_update_checkbox)
+
+        lambda_rolling_lr = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.rolling_learning_rate, x)
+        rolling_lr_validator = FloatValidator(bottom=0.0, top=1.0, decimals=4)
+        rolling_lr_validator.setNotation(QDoubleValidator.StandardNotation)
+        self.rolling_learning_rate_line = addLine("Rolling learning rate", bg_sub_data.rolling_learning_rate, rolling_lr_validator, [lambda_rolling_lr], self.form_layout2)
+
+        lambda_rolling_window = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.rolling_window, x)
+        self.rolling_window_line = addLine("Rolling window", bg_sub_data.rolling_window, QIntValidator(1, 1000000), [lambda_rolling_window], self.form_layout2)
+
+        self.rolling_snapshot_checkbox = QCheckBox("", self)
+        self.rolling_snapshot_checkbox.setChecked(bg_sub_data.rolling_snapshot)
+        self.rolling_snapshot_checkbox.setToolTip("Rebuild the model from the latest window every rolling window frames")
+        lambda_rolling_snapshot = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.rolling_snapshot, x)
+        self.rolling_snapshot_checkbox.stateChanged.connect(lambda_rolling_snapshot)
+        self.form_layout2.addRow("Rolling re-snapshot", self.rolling_snapshot_checkbox)
+
+        lambda_training_scale = lambda x: bg_sub.setParameter(MOGParameters.ParametersEnum.training_scale, x)
+        training_scale_validator = FloatValidator(bottom=0.1, top=1.0, decimals=2)
+        self.training_scale_line = addLine("Training scale", bg_sub_data.training_scale, training_scale_validator, [lambda_training_scale], self.form_layout2)
+        self.training_scale_line.setToolTip("Resolution of the background model relative to the images (< 1 trains faster)")
+
+        # Region of interest, zero leaves the bound open
+        det_param_data = detector.parameters.data
+        def addRegionLine(label, key, value):
+            validator = FloatValidator(bottom=0.0, top=1000.0, decimals=2)
+            validator.setNotation(QDoubleValidator.StandardNotation)
+            lambda_region = lambda x: detector.setParameter(key, x)
+            line = addLine(label, value, validator, [lambda_region], self.form_layout2)
+            line.setToolTip("Zero leaves the bound open")
+            return line
+
+        self.roi_min_range_line = addRegionLine("ROI min range (m)", DetectorParameters.ParametersEnum.roi_min_range, det_param_data.roi_min_range)
+        self.roi_max_range_line = addRegionLine("ROI max range (m)", DetectorParameters.ParametersEnum.roi_max_range, det_param_data.roi_max_range)
+        self.roi_min_angle_line = addRegionLine("ROI min angle (deg)", DetectorParameters.ParametersEnum.roi_min_angle, det_param_data.roi_min_angle)
+        self.roi_max_angle_line = addRegionLine("ROI max angle (deg)", DetectorParameters.ParametersEnum.roi_max_angle, det_param_data.roi_max_angle)
+
         self.verticalLayout.addLayout(self.form_layout2)
 
         self.verticalSpacer1 = QSpacerItem(0, 10, QSizePolicy.Minimum, QSizePolicy.Maximum)
@@ -221,6 +283,33 @@ class DetectorParametersView(QWidget):
         lambda_dbscan_min_samples = lambda x: detector.setParameter(DetectorParameters.ParametersEnum.dbscan_min_samples, x)
         self.dbscan_min_samples_line = addLine("Clustering min samples", det_param_data.dbscan_min_samples, QIntValidator(0, 200), [lambda_dbscan_min_samples, refresh_lambda], self.form_layout)
 
+        # Activity prefilter
+        self.activity_filter_checkbox = QCheckBox("", self)
+        self.activity_filter_checkbox.setChecked(det_param_data.activity_filter)
+        self.activity_filter_checkbox.setToolTip("Detect only frames near activity in the background subtracted echogram")
+        lambda_activity_filter = lambda x: detector.setParameter(DetectorParameters.ParametersEnum.activity_filter, x)
+        self.activity_filter_checkbox.stateChanged.connect(lambda_activity_filter)
+        self.form_layout.addRow("Activity prefilter", self.activity_filter_checkbox)
+
+        lambda_activity_threshold = lambda x: detector.setParameter(DetectorParameters.ParametersEnum.activity_threshold, x)
+        self.activity_threshold_line = addLine("Activity threshold", det_param_data.activity_threshold, QIntValidator(0, 10000), [lambda_activity_threshold], self.form_layout)
+
+        lambda_activity_padding = lambda x: detector.setParameter(DetectorParameters.ParametersEnum.activity_padding, x)
+        self.activity_padding_line = addLine("Activity padding", det_param_data.activity_padding, QIntValidator(0, 1000), [lambda_activity_padding], self.form_layout)
+
+        # Static clutter mask
+        self.clutter_filter_checkbox = QCheckBox("", self)
+        self.clutter_filter_checkbox.setChecked(det_param_data.clutter_filter)
+        self.clutter_filter_checkbox.setToolTip("Ignore pixels that are foreground in most of the background frames")
+        lambda_clutter_filter = lambda x: detector.setParameter(DetectorParameters.ParametersEnum.clutter_filter, x)
+        self.clutter_filter_checkbox.stateChanged.connect(lambda_clutter_filter)
+        self.form_layout.addRow("Exclude static clutter", self.clutter_filter_checkbox)
+
+        lambda_clutter_occupancy = lambda x: detector.setParameter(DetectorParameters.ParametersEnum.clutter_occupancy, x)
+        occupancy_validator = FloatValidator(bottom=0.0, top=1.0, decimals=2)
+        occupancy_validator.setNotation(QDoubleValidator.StandardNotation)
+        self.clutter_occupancy_line = addLine("Clutter occupancy", det_param_data.clutter_occupancy, occupancy_validator, [lambda_clutter_occupancy], self.form_layout)
+
         self.verticalLayout.addLayout(self.form_layout)
 
         self.verticalSpacer3 = QSpacerItem(0, 10, QSizePolicy.Minimum, QSizePolicy.Maximum)
@@ -322,10 +411,27 @@ class DetectorParametersView(QWidget):
         self.median_size_slider.setValue(det_data.median_size)
         self.dbscan_eps_line.setText(str(det_data.dbscan_eps))
         self.dbscan_min_samples_line.setText(str(det_data.dbscan_min_samples))
+        self.activity_filter_checkbox.setChecked(det_data.activity_filter)
+        self.activity_threshold_line.setText(str(det_data.activity_threshold))
+        self.activity_padding_line.setText(str(det_data.activity_padding))
+        self.clutter_filter_checkbox.setChecked(det_data.clutter_filter)
+        self.clutter_occupancy_line.setText(str(det_data.clutter_occupancy))
+        self.roi_min_range_line.setText(str(det_data.roi_min_range))
+        self.roi_max_range_line.setText(str(det_data.roi_max_range))
+        self.roi_min_angle_line.setText(str(det_data.roi_min_angle))
+        self.roi_max_angle_line.setText(str(det_data.roi_max_angle))
 
         self.nof_bg_frames_line.setText(str(mog_data.nof_bg_frames))
         self.learning_rate_line.setText(str(mog_data.learning_rate))
         self.mog_var_threshold_line.setText(str(mog_data.mog_var_thresh))
+        self.bg_model_combobox.setCurrentText(mog_data.bg_model)
+        self.bg_percentile_line.setText(str(mog_data.bg_percentile))
+        self.bg_threshold_line.setText(str(mog_data.bg_threshold))
+        self.rolling_update_checkbox.setChecked(mog_data.rolling_update)
+        self.rolling_learning_rate_line.setText(str(mog_data.rolling_learning_rate))
+        self.rolling_window_line.setText(str(mog_data.rolling_window))
+        self.rolling_snapshot_checkbox.setChecked(mog_data.rolling_snapshot)
+        self.training_scale_line.setText(str(mog_data.training_scale))
 
     def recalculateMOG(self):
         if not self.bg_subtractor.initializing:
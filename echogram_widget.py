@@ -22,7 +22,7 @@ from zoomable_qlabel import ZoomableQLabel, DebugZQLabel
 import cv2
 import numpy as np
 from log_object import LogObject
-from fish_manager import FishEntry, pyqt_palette, pyqt_palette_deep
+from fish_manager import pyqt_palette, pyqt_palette_deep
 from background_subtractor import BackgroundSubtractor
 
 class EchoFigure(ZoomableQLabel):
@@ -174,8 +174,7 @@ class EchoFigure(ZoomableQLabel):
         try:
             for i, heights in enumerate(vertical_detections[self.x_min_limit:self.x_max_limit]):
                 h_pos_1 = (i + 1) / show_frame_count * self.window_width
-                for height in heights:
-                    v_pos = self.window_height - (height - v_min) * v_mult
+                for v_pos in self.window_height - (np.asarray(heights) - v_min) * v_mult:
                     painter.drawLine(h_pos_0, v_pos, h_pos_1, v_pos)
                 h_pos_0 = h_pos_1
         except ZeroDivisionError:
@@ -315,11 +314,13 @@ class EchogramViewer(QtWidgets.QWidget):
         if self.echogram is not None:
             self.echogram.clear()
             self.echogram = None
+        self.detector.setEchogram(None)
         self.vertical_tracks = []
         self.setInputUpdateTimer()
 
     def processEchogram(self):
-        self.echogram.processBuffer(self.playback_manager.getPolarBuffer())
+        self.echogram.processBuffer(self.playback_manager.getPolarBuffer(), self.detector.getRegion())
+        self.detector.setEchogram(self.echogram)
         self.showBGSubtraction(self.show_bg_subtracted)
         self.figure.resetView()
         self.playback_manager.refreshFrame()
@@ -359,12 +360,25 @@ class EchogramViewer(QtWidgets.QWidget):
 
         self.vertical_tracks = [[] for fr in range(self.playback_manager.getFrameCount())]
 
+        # Track centers of all fish are transformed at once.
+        frames = []
+        boxes = []
+        fish_inds = []
         for ind, fish in enumerate(self.fish_manager.fish_list):
-            selected = ind in self.fish_manager.selected_rows
-            for key, (tr, _) in fish.tracks.items():
-                avg_y, avg_x = FishEntry.trackCenter(tr)
-                distance, _ = self.playback_manager.getBeamDistance(avg_x, avg_y, True)
-                self.vertical_tracks[key].append((distance, fish.color_ind, selected))
+            frames.extend(fish.tracks.keys())
+            boxes.extend(tr for tr, _ in fish.tracks.values())
+            fish_inds.extend([ind] * len(fish.tracks))
+
+        if len(frames) > 0:
+            boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+            avg_y = (boxes[:, 0] + boxes[:, 2]) / 2
+            avg_x = (boxes[:, 1] + boxes[:, 3]) / 2
+            distances, _ = self.playback_manager.getBeamDistance(avg_x, avg_y, True)
+
+            fish_list = self.fish_manager.fish_list
+            selected_rows = self.fish_manager.selected_rows
+            for frame, distance, ind in zip(frames, np.asarray(distances).tolist(), fish_inds):
+                self.vertical_tracks[frame].append((distance, fish_list[ind].color_ind, ind in selected_rows))
 
         self.figure.update()
 
@@ -410,27 +424,41 @@ class Echogram():
         self.bgs_data = None
         self.length = length
 
-    def processBuffer(self, buffer):
+        # Range bins (polar rows) processed, limited by the region of interest.
+        self.rows = slice(None)
+
+    def processBuffer(self, buffer, region=None):
         """
         Calculates the normal echogram image and the background subtracted one.
         The data is transposed only when returning the displayed image
         to allow easier iteration.
+        If region (CompiledRegion) is given, only the range bins and beams within
+        the region are processed. Other range bins are left empty.
         """
         try:
             # Calculate echogram
-            buf = [b for b in buffer]
+            if region is not None:
+                self.rows = region.polar_rows
+                buf = [b[region.polar_rows, region.polar_cols] for b in buffer]
+            else:
+                self.rows = slice(None)
+                buf = [b for b in buffer]
             #buf = [b for b in buffer if b is not None]
 
             buf = np.asarray(buf, dtype=np.uint8)
-            self.data = np.max(buf, axis=2)
-            min_v = np.min(self.data)
-            max_v = np.max(self.data)
-            self.data = (255 / (max_v - min_v) * (self.data - min_v)).astype(np.uint8)
+            data = np.max(buf, axis=2)
+            min_v = np.min(data)
+            max_v = np.max(data)
+            data = (255 / (max_v - min_v) * (data - min_v)).astype(np.uint8)
+
+            self.data = np.zeros((len(buffer), buffer[0].shape[0]), dtype=np.uint8)
+            self.data[:, self.rows] = data
 
             # Subtract background
             self.bg_subtractor.initMOG()
-            self.bgs_data = np.squeeze([self.bg_subtractor.subtractBG(column) for column in self.data])
-            self.bgs_data = self.bgs_data.astype(np.uint8)
+            bgs_data = np.squeeze([self.bg_subtractor.subtractBG(column) for column in data])
+            self.bgs_data = np.zeros(self.data.shape, dtype=np.uint8)
+            self.bgs_data[:, self.rows] = bgs_data.reshape(data.shape)
 
         except np.AxisError as e:
             LogObject().print("Echogram processing error:", e)
@@ -453,7 +481,7 @@ class Echogram():
         """
         Returns the column of echogram corresponding to the given frame index.
         """
-        return self.data[ind, :]
+        return self.data[ind, self.rows]
 
 class DebugEchoFigure(DebugZQLabel):
     def __init__(self, echo_figure):
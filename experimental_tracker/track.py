@@ -36,6 +36,7 @@ class Track:
         id: Track's unique id.
         last_measurement: Latest measurement sed to update the track.
         last_position: Last position estimate for the track.
+        detection_index: Index of the detection used to update the track in the latest frame, -1 if none.
     """
 
     def __init__(self, id, detection):
@@ -72,6 +73,7 @@ class Track:
         self.kf.x[2] = detection[1]
 
         self.consecutive_updates = 0
+        self.detection_index = -1
 
     def _predict(self):
         """Performs the predict step of KF."""
@@ -90,6 +92,7 @@ class Track:
 
         self.time_since_update += 1
         self.last_measurement = np.empty((0, 2))
+        self.detection_index = -1
 
         # Set existing tracks initially lost
         if self.status == "Active":
@@ -21,7 +21,11 @@ along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
 import numpy as np
 from scipy.optimize import linear_sum_assignment
 
-from track import Track
+try:
+    from .track import Track
+except ImportError:
+    # Imported as a script (see test.py)
+    from track import Track
 
 class Tracker:
     """Tracker class for track management.
@@ -146,6 +150,7 @@ class Tracker:
 
         Returns:
             Unmatched detections.
+            Indices of the unmatched detections.
         """
 
         track_points = self.get_track_points()
@@ -153,37 +158,39 @@ class Tracker:
 
         # All detetctions unmatched
         if len(ma_indices) == 0:
-            return detections
+            return detections, list(range(len(detections)))
 
         # Update measurements for associated tracks
         for idx in ma_indices:
             self.tracks[idx[1]].last_measurement = detections[idx[0]]
+            self.tracks[idx[1]].detection_index = idx[0]
         
-        return detections[um_detections]
+        return detections[um_detections], um_detections
 
     def _remove_tentative(self): #TODO paremmin
         for t1 in self.tracks:
-            if t1.status is "Removed":
+            if t1.status == "Removed":
                 continue
             t1_loc = t1.last_position
             for t2 in self.tracks:
-                if t2.status is "Removed":
+                if t2.status == "Removed":
                     continue
                 t2_loc = t2.last_position
                 cost = Tracker.distance(t1_loc, t2_loc)
                 if cost == 0:
                     continue
                 if cost < self.search_radius ** 2:
-                    if t1.status is "Tentative":
+                    if t1.status == "Tentative":
                         t1.status = "Removed"
-                    if t1.status is "Active" and t2.status is "Tentative":
+                    if t1.status == "Active" and t2.status == "Tentative":
                         t2.status = "Removed"
 
-    def _initiate_new_tracks(self, detections):
+    def _initiate_new_tracks(self, detections, indices=None):
         """Creates new tracks from detections.
  
         Args:
             detections: Measurements, Numpy array of 2D points.
+            indices: Indices of the detections in the input of update.
         """
 
         for i, detection in enumerate(detections):
@@ -196,7 +203,10 @@ class Tracker:
                     can_initialize = False
 
             if can_initialize:
-                self.tracks.append(Track(self._frame_counter, detection))
+                track = Track(self._frame_counter, detection)
+                if indices is not None:
+                    track.detection_index = indices[i]
+                self.tracks.append(track)
 
     def remove_deleted(self):
         self.tracks = [t for t in self.tracks if not t.status == "Removed"]
@@ -219,13 +229,13 @@ class Tracker:
         #self.remove_deleted()
 
         # Data association
-        unmatched_detections = self._match_detections_and_tracks(detections)
+        unmatched_detections, unmatched_indices = self._match_detections_and_tracks(detections)
 
         # 
         for track in self.tracks:
             track.post_process(self.min_hits)
 
-        self._initiate_new_tracks(unmatched_detections)
+        self._initiate_new_tracks(unmatched_detections, unmatched_indices)
 
         for track in self.tracks:
             track.delete(self.max_age)
@@ -373,17 +373,24 @@ class ConfKeys(Enum):
     batch_save_detections = auto()
     batch_save_tracks = auto()
     batch_save_complete = auto()
+    batch_streaming = auto()
 
+    bg_model_cache_limit = auto()
+    compiled_tracking = auto()
+    detection_processes = auto()
     filter_tracks_on_save = auto()
     latest_batch_directory = auto()
     latest_directory = auto()
     latest_save_directory = auto()
     log_timestamp = auto()
     log_verbosity = auto()
+    mask_cache_memory_limit = auto()
+    mask_cache_on_disk = auto()
     parallel_processes = auto()
     save_as_binary = auto()
     sonar_height = auto()
     test_file_path = auto()
+    tracking_processes = auto()
 
 
 conf_default_values = {
@@ -391,17 +398,24 @@ conf_default_values = {
     ConfKeys.batch_save_detections: False,
     ConfKeys.batch_save_tracks: False,
     ConfKeys.batch_save_complete: True,
+    ConfKeys.batch_streaming: False,
 
+    ConfKeys.bg_model_cache_limit: 512,
+    ConfKeys.compiled_tracking: False,
+    ConfKeys.detection_processes: 1,
     ConfKeys.filter_tracks_on_save: True,
     ConfKeys.latest_batch_directory: str(os.path.expanduser("~")),
     ConfKeys.latest_directory: str(os.path.expanduser("~")),
     ConfKeys.latest_save_directory: str(os.path.expanduser("~")),
     ConfKeys.log_timestamp: False,
     ConfKeys.log_verbosity: 0,
+    ConfKeys.mask_cache_memory_limit: 1024,
+    ConfKeys.mask_cache_on_disk: False,
     ConfKeys.parallel_processes: 1,
     ConfKeys.save_as_binary: False,
     ConfKeys.sonar_height: 1000,
-    ConfKeys.test_file_path: ""
+    ConfKeys.test_file_path: "",
+    ConfKeys.tracking_processes: 1
     }
 
 conf_types = {
@@ -409,17 +423,24 @@ conf_types = {
     ConfKeys.batch_save_detections: bool,
     ConfKeys.batch_save_tracks: bool,
     ConfKeys.batch_save_complete: bool,
+    ConfKeys.batch_streaming: bool,
 
+    ConfKeys.bg_model_cache_limit: int,
+    ConfKeys.compiled_tracking: bool,
+    ConfKeys.detection_processes: int,
     ConfKeys.filter_tracks_on_save: bool,
     ConfKeys.latest_batch_directory: str,
     ConfKeys.latest_directory: str,
     ConfKeys.latest_save_directory: str,
     ConfKeys.log_timestamp: bool,
     ConfKeys.log_verbosity: int,
+    ConfKeys.mask_cache_memory_limit: int,
+    ConfKeys.mask_cache_on_disk: bool,
     ConfKeys.parallel_processes: int,
     ConfKeys.save_as_binary: bool,
     ConfKeys.sonar_height: int,
-    ConfKeys.test_file_path: str
+    ConfKeys.test_file_path: str,
+    ConfKeys.tracking_processes: int
     }
 
 
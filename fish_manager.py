@@ -434,8 +434,8 @@ class FishManager(QtCore.QAbstractTableModel):
 
     def updateDataFromTracker(self):
         """
-        Iterates through the results of the tracker and updates the data in FishManager.
-        If clear_old_data is set, the old data is first removed.
+        Updates the data in FishManager from the results of the tracker (TrackStore),
+        grouped by track id. If clear_old_data is set, the old data is first removed.
         """
 
         if self.clear_old_data:
@@ -443,21 +443,17 @@ class FishManager(QtCore.QAbstractTableModel):
 
         self.clear_old_data = True
 
-        # Iterate through all frames.
-        for frame, tracks in self.tracker.tracks_by_frame.items():
-            try:
-                # Iterate through all tracks in a frame.
-                for tr, det in tracks:
-                    id = tr[4]
-                    if id in self.all_fish:
-                        f = self.all_fish[id]
-                        f.addTrack(tr, det, frame)
-                    else:
-                        f = FishEntryFromTrack(tr, det, frame)
-                        self.all_fish[id] = f
-            except ValueError as e:
-                print(tracks)
-                raise e
+        store = self.tracker.track_store
+        for id, rows in store.groupById():
+            frames = store.frame[rows].tolist()
+            boxes = store.bbox[rows]
+            dets = [store.getDetection(row) for row in rows]
+            if id in self.all_fish:
+                f = self.all_fish[id]
+            else:
+                f = FishEntry(id, frames[0], frames[-1])
+                self.all_fish[id] = f
+            f.addTracks(frames, boxes, dets)
 
         # Trim tails, i.e. remove last tracks with no corresponding detection.
         if self.tracker.parameters.getParameter(TrackerParameters.ParametersEnum.trim_tails):
@@ -486,20 +482,11 @@ class FishManager(QtCore.QAbstractTableModel):
 
     def getDetectionsInFish(self):
         """
-        Returns detections that have been associated with the current fish.
+        Returns the ids of the detections that have been associated with the current fish.
+        See DetectionStore.detectionIds.
         """
-        detections = {}
-        for fish in self.all_fish.values():
-            for frame, (_, det) in fish.tracks.items():
-                if det is None:
-                    continue
-
-                if frame not in detections:
-                    detections[frame] = [det]
-                else:
-                    detections[frame].append(det)
-
-        return detections
+        pairs = [(frame, det) for fish in self.all_fish.values() for frame, (_, det) in fish.tracks.items() if det is not None]
+        return self.tracker.detector.detections.detectionIds([det for _, det in pairs], [frame for frame, _ in pairs])
 
     def applyFiltersAndGetUsedDetections(self, min_detections=None, mad_limit=None):
         """
@@ -520,10 +507,7 @@ class FishManager(QtCore.QAbstractTableModel):
         LogObject().print1(f"Fish after applying filters: {len(self.all_fish)}")
 
         used_dets = self.getDetectionsInFish()
-        count = 0
-        for frame, dets in used_dets.items():
-            count += len(dets)
-        LogObject().print1(f"Total detections used in filtered results: {count}")
+        LogObject().print1(f"Total detections used in filtered results: {len(used_dets)}")
 
         self.min_detections = temp_min_detections
         self.mad_limit = temp_mad_limit
@@ -759,20 +743,12 @@ class FishManager(QtCore.QAbstractTableModel):
                     f = FishEntry(id, frame, frame)
 
                 if det_label is not None:
-                    # Goes through detections in the same frame and tries to assign the
-                    # corresponding detection based on the label.
-
-                    frame_dets = dets[frame]
-                    match_found = False
-                    for fd in frame_dets:
-                        if fd.label == det_label:
-                            # Adds track with a matching detection to the FishEntry
-
-                            f.addTrack(track, fd, frame)
-                            match_found = True
-                            break
-
-                    if not match_found:
+                    # Finds the detection in the same frame with the corresponding label.
+                    fd = dets.getDetectionByLabel(frame, det_label)
+                    if fd is not None:
+                        # Adds track with a matching detection to the FishEntry
+                        f.addTrack(track, fd, frame)
+                    else:
                         LogObject().print("Warning: Match not found in frame {} for label {}".format(frame, det_label))
                 else:
                     f.addTrack(track, None, frame)
@@ -850,6 +826,15 @@ class FishEntry():
             insort(self.lengths, detection.length)
         #self.setFrames()
 
+    def addTracks(self, frames, boxes, detections):
+        """
+        Adds the tracks of several frames at once. boxes: N x 4 array of bounding boxes.
+        """
+        self.tracks.update(zip(frames, zip(boxes, detections)))
+        lengths = [det.length for det in detections if det is not None]
+        if len(lengths) > 0:
+            self.lengths = sorted(self.lengths + lengths)
+
     def copy(self):
         f = FishEntry(self.id, self.frame_in, self.frame_out)
         f.length = self.length
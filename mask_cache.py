@@ -0,0 +1,165 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import atexit
+import tempfile
+import numpy as np
+
+import file_handler as fh
+from log_object import LogObject
+
+# Spill files of all caches, removed at exit if not released before.
+_spill_paths = set()
+
+def removeSpillFile(path):
+    _spill_paths.discard(path)
+    try:
+        os.remove(path)
+    except OSError as e:
+        LogObject().print2(f"Could not remove mask cache file {path}: {e}")
+
+@atexit.register
+def _removeSpillFiles():
+    for path in list(_spill_paths):
+        removeSpillFile(path)
+
+def fileIdentity(path):
+    """
+    Returns a tuple identifying the contents of the file at path.
+    """
+    if path is None or path == "" or not os.path.exists(path):
+        return (path,)
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+def packMask(mask):
+    """
+    Packs a foreground mask (0 / non-zero) into bits.
+    """
+    return np.packbits(np.asarray(mask) > 0, axis=None)
+
+def unpackMask(packed, shape):
+    """
+    Unpacks a mask packed with packMask. Foreground pixels have value 255.
+    """
+    size = shape[0] * shape[1]
+    return (np.unpackbits(packed, count=size).reshape(shape) * 255).astype(np.uint8)
+
+class ForegroundMaskCache:
+    """
+    Stores the raw foreground masks of background subtraction for each frame of a file.
+    Masks are bit-packed and kept in memory. If they do not fit in the memory limit set in
+    the user preferences, they are spilled to a temporary file on disk (if enabled).
+
+    The cache is identified with a key, e.g. (file identity, background subtractor parameters).
+    Using the cache with a different key clears the previously stored masks.
+    """
+    def __init__(self):
+        self.key = None
+        self.frame_count = 0
+        self.shape = None
+        self.packed = None
+        self.cached = None
+        self.spill_path = None
+
+        # [flag] Masks do not fit in the cache with current settings.
+        self.disabled = False
+
+    def reset(self, key=None, frame_count=0):
+        self.releaseStorage()
+        self.key = key
+        self.frame_count = frame_count
+        self.shape = None
+        self.cached = np.zeros(frame_count, dtype=bool)
+        self.disabled = False
+
+    def releaseStorage(self):
+        self.packed = None
+        if self.spill_path is not None:
+            removeSpillFile(self.spill_path)
+            self.spill_path = None
+
+    def clear(self):
+        self.reset()
+
+    def isValid(self, key):
+        return key is not None and self.key == key
+
+    def contains(self, ind):
+        return self.packed is not None and 0 <= ind < self.frame_count and self.cached[ind]
+
+    def isComplete(self):
+        return self.packed is not None and self.frame_count > 0 and np.all(self.cached)
+
+    def allocate(self, shape):
+        """
+        Allocates storage for masks of the given shape. Returns False if the masks do not fit.
+        """
+        self.shape = tuple(shape[:2])
+        packed_len = (self.shape[0] * self.shape[1] + 7) // 8
+        size = self.frame_count * packed_len
+        limit = fh.getConfValue(fh.ConfKeys.mask_cache_memory_limit) * 1024 * 1024
+
+        if size <= limit:
+            self.packed = np.zeros((self.frame_count, packed_len), dtype=np.uint8)
+        elif fh.getConfValue(fh.ConfKeys.mask_cache_on_disk):
+            fd, self.spill_path = tempfile.mkstemp(prefix="fish_tracker_masks_", suffix=".bin")
+            os.close(fd)
+            _spill_paths.add(self.spill_path)
+            self.packed = np.memmap(self.spill_path, dtype=np.uint8, mode="w+", shape=(self.frame_count, packed_len))
+            LogObject().print1(f"Foreground masks ({size / 1024 / 1024:.0f} MB) cached on disk: {self.spill_path}")
+        else:
+            LogObject().print1(f"Foreground masks ({size / 1024 / 1024:.0f} MB) exceed the cache limit and are not cached.")
+            self.disabled = True
+            return False
+
+        return True
+
+    def put(self, ind, mask):
+        self.putPacked(ind, packMask(mask), mask.shape)
+
+    def putPacked(self, ind, packed, shape):
+        """
+        Stores a mask already packed with packMask.
+        """
+        if self.key is None or self.disabled or not 0 <= ind < self.frame_count:
+            return
+
+        if self.packed is None:
+            if not self.allocate(shape):
+                return
+        elif tuple(shape[:2]) != self.shape:
+            # Image size has changed (e.g. sonar height), previous masks are not valid anymore.
+            self.reset(self.key, self.frame_count)
+            if not self.allocate(shape):
+                return
+
+        self.packed[ind] = packed
+        self.cached[ind] = True
+
+    def getPacked(self, ind):
+        if not self.contains(ind):
+            return None
+        return np.array(self.packed[ind])
+
+    def get(self, ind):
+        if not self.contains(ind):
+            return None
+        return unpackMask(self.packed[ind], self.shape)
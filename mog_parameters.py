@@ -28,12 +28,28 @@ class MOGParameters(ParametersBase):
         mixture_count: int = 5
         mog_var_thresh: int = 11
         nof_bg_frames: int = 100
+        bg_model: str = "mog2"
+        bg_percentile: int = 50
+        bg_threshold: int = 25
+        rolling_update: bool = False
+        rolling_learning_rate: float = 0.001
+        rolling_window: int = 1000
+        rolling_snapshot: bool = False
+        training_scale: float = 1.0
 
     class ParametersEnum(Enum):
         learning_rate = auto()
         mixture_count = auto()
         mog_var_thresh = auto()
         nof_bg_frames = auto()
+        bg_model = auto()
+        bg_percentile = auto()
+        bg_threshold = auto()
+        rolling_update = auto()
+        rolling_learning_rate = auto()
+        rolling_window = auto()
+        rolling_snapshot = auto()
+        training_scale = auto()
 
     def __init__(self, *args, **kwargs):
         """
@@ -42,5 +58,13 @@ class MOGParameters(ParametersBase):
         mixture_count: int = 5
         mog_var_thresh: int = 11
         nof_bg_frames: int = 100
+        bg_model: str = "mog2" ("mog2", "percentile" or "gaussian")
+        bg_percentile: int = 50
+        bg_threshold: int = 25
+        rolling_update: bool = False
+        rolling_learning_rate: float = 0.001
+        rolling_window: int = 1000
+        rolling_snapshot: bool = False
+        training_scale: float = 1.0 (< 1 trains the model at reduced resolution)
         """
         super().__init__(self.Parameters(*args, **kwargs))
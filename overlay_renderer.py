@@ -0,0 +1,77 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+import cv2
+from pixel_runs import runsToPixels
+
+# Detection areas are dilated to match the width of the strokes used previously
+# (cv2.line with thickness 2 at every pixel).
+AREA_KERNEL = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+
+def overlayAreas(image, areas, alpha=1.0):
+    """
+    Paints the areas of several detections to image in one pass and returns the image (modified in place).
+    areas is a list of (runs, color) tuples, where runs are the pixel runs of a detection (see pixel_runs)
+    and color is an RGB tuple of floats in [0, 1]. Overlapping areas are painted with the color of the later area.
+    Colors are blended with the image with weight alpha.
+
+    The areas are written to a label image (index of the area + 1) covering their bounding box,
+    which is mapped to colors with a lookup table.
+    """
+    areas = [(runs, color) for runs, color in areas if runs is not None and len(runs) > 0]
+    if len(areas) == 0:
+        return image
+
+    pixels = [runsToPixels(runs) for runs, _ in areas]
+    labels = np.repeat(np.arange(1, len(areas) + 1, dtype=np.uint16), [len(p) for p in pixels])
+    pixels = np.concatenate(pixels)
+
+    height, width = image.shape[:2]
+    inside = (pixels[:, 0] < height) & (pixels[:, 1] < width)
+    pixels = pixels[inside]
+    labels = labels[inside]
+    if len(pixels) == 0:
+        return image
+
+    # Bounding box of all the areas, padded by the dilation.
+    y0 = max(0, int(pixels[:, 0].min()) - 1)
+    x0 = max(0, int(pixels[:, 1].min()) - 1)
+    y1 = min(height, int(pixels[:, 0].max()) + 2)
+    x1 = min(width, int(pixels[:, 1].max()) + 2)
+
+    # Labels are in area order, so later areas overwrite earlier ones as when drawn one by one.
+    label_image = np.zeros((y1 - y0, x1 - x0), dtype=np.uint16)
+    label_image[pixels[:, 0] - y0, pixels[:, 1] - x0] = labels
+    label_image = cv2.dilate(label_image, AREA_KERNEL)
+
+    lut = np.zeros((len(areas) + 1, 3), dtype=np.float32)
+    lut[1:] = [(255 * color[0], 255 * color[1], 255 * color[2]) for _, color in areas]
+
+    painted = label_image > 0
+    window = image[y0:y1, x0:x1]
+    colors = lut[label_image[painted]]
+    if window.ndim == 2:
+        colors = colors.mean(axis=1)
+    if alpha >= 1:
+        window[painted] = colors.astype(np.int32)
+    else:
+        window[painted] = (alpha * colors + (1 - alpha) * window[painted]).astype(np.int32)
+    return image
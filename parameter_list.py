@@ -116,6 +116,17 @@ class ParameterList(QtWidgets.QToolBar):
             self.sonar_viewer.sonar_figure.measure_toggle.append(self.toggleMeasureBtn)
         self.measure_btn.setToolTip("Measure distance\nDraw a line in Sonar View to measure a distance between two points")
 
+        # SonarView region of interest
+        self.region_btn = QtWidgets.QPushButton(self)
+        self.region_btn.setObjectName("drawRegion")
+        self.region_btn.setFlat(True)
+        self.region_btn.setCheckable(True)
+        self.region_btn.setText("ROI")
+        if self.sonar_viewer is not None:
+            self.region_btn.clicked.connect(self.sonar_viewer.drawRegion)
+            self.sonar_viewer.sonar_figure.region_toggle.append(self.toggleRegionBtn)
+        self.region_btn.setToolTip("Region of interest\nLeft click in Sonar View to add polygon vertices, right click to finish.\nLess than three vertices clears the polygon")
+
         # SonarView colormap
         self.colormap_btn = QtWidgets.QPushButton(self)
         self.colormap_btn.setObjectName("setColormap")
@@ -195,6 +206,7 @@ class ParameterList(QtWidgets.QToolBar):
         self.addWidget(self.show_trackingIDs_btn)
         self.addWidget(line2)
         self.addWidget(self.measure_btn)
+        self.addWidget(self.region_btn)
 
     def gammaSliderChanged(self, value):
         applied_value = float(value)/20
@@ -235,6 +247,10 @@ class ParameterList(QtWidgets.QToolBar):
         if self.measure_btn.isChecked() == value:
                 self.measure_btn.toggle()
 
+    def toggleRegionBtn(self, value):
+        if self.region_btn.isChecked() != value:
+            self.region_btn.setChecked(value)
+
 if __name__ == "__main__":
     import sys
     from playback_manager import PlaybackManager
@@ -0,0 +1,344 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+import tempfile
+import multiprocessing as mp
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+
+import file_handler as fh
+from log_object import LogObject
+from mog_parameters import MOGParameters
+from detector_parameters import DetectorParameters
+from tracker_parameters import TrackerParameters
+from background_subtractor import createMOG, getTrainingIndices
+from detector import filterMaskPixels, clusterPixels, detectionsFromClusters
+from detection_store import DetectionStore
+from mask_cache import packMask, unpackMask
+from playback_manager import createPolarTransform
+from pipeline_stages import Stage, stageParameterValues, hashableValue
+from sort import KalmanBoxTracker
+from tracking_engine import createTrackingEngine
+
+# Parameter sweep runs detection and tracking with every combination of the given
+# MOGParameters, DetectorParameters and TrackerParameters values, and reports the results in a table.
+#
+# Work is shared between variants that differ only in the later stages of the pipeline:
+# 1. Each file is decoded once and the foreground masks of all MOG variants are computed in the same pass.
+#    Masks are stored bit-packed in temporary files.
+# 2. Each (file, MOG, median filter, clustering) group is clustered once, and detection geometry
+#    and tracking are run for all the remaining variants in the group. Groups are run in parallel processes.
+#
+# Grid file format (JSON), parameters that are not given use the default values:
+# {
+#     "mog": { "mog_var_thresh": [9, 11, 13] },
+#     "detector": { "dbscan_eps": [5, 10] },
+#     "tracker": { "search_radius": [10, 20] }
+# }
+
+# Max distance (pixels) between detection centers considered the same detection in agreement.
+AGREEMENT_RADIUS = 10
+
+# Parameters of the stages that the sweep does not run (activity prefilter, clutter mask, region of
+# interest and rolling background update). They cannot be given in the grid, since they would not affect the results.
+UNSUPPORTED_KEYS = {
+    MOGParameters: [MOGParameters.ParametersEnum.rolling_update,
+                    MOGParameters.ParametersEnum.rolling_learning_rate,
+                    MOGParameters.ParametersEnum.rolling_window,
+                    MOGParameters.ParametersEnum.rolling_snapshot],
+    DetectorParameters: [DetectorParameters.ParametersEnum.activity_filter,
+                         DetectorParameters.ParametersEnum.activity_threshold,
+                         DetectorParameters.ParametersEnum.activity_padding,
+                         DetectorParameters.ParametersEnum.clutter_filter,
+                         DetectorParameters.ParametersEnum.clutter_occupancy,
+                         DetectorParameters.ParametersEnum.roi_min_range,
+                         DetectorParameters.ParametersEnum.roi_max_range,
+                         DetectorParameters.ParametersEnum.roi_min_angle,
+                         DetectorParameters.ParametersEnum.roi_max_angle,
+                         DetectorParameters.ParametersEnum.roi_polygon]
+    }
+
+def expandGrid(parameters_class, grid):
+    """
+    Returns a list of parameter dictionaries, one for each combination of the values in grid.
+    """
+    defaults = parameters_class().getParameterDict()
+    unsupported = [key.name for key in UNSUPPORTED_KEYS.get(parameters_class, [])]
+    for key in grid.keys():
+        if key not in defaults:
+            raise KeyError(f"Invalid key '{key}' for '{parameters_class.__name__}'")
+        if key in unsupported:
+            raise ValueError(f"'{key}' of '{parameters_class.__name__}' is not supported in parameter sweep, "
+                             f"since the sweep does not run its stage")
+
+    keys = list(grid.keys())
+    values = [grid[key] if isinstance(grid[key], list) else [grid[key]] for key in keys]
+    return [dict(defaults, **dict(zip(keys, combination))) for combination in itertools.product(*values)]
+
+def parametersFromDict(parameters_class, dictionary):
+    parameters = parameters_class()
+    parameters.setParameterDict(dictionary)
+    return parameters
+
+def computeMasks(file, mog_dicts, frame_limit, mask_directory):
+    """
+    Decodes the frames of a file once and computes the foreground masks for each MOG variant.
+    Training frames are kept until their masks have been computed, so they are not decoded again.
+    Returns (polar transform, frame count, mask shape, [(mask path, seconds)] per MOG variant).
+    """
+    sonar = fh.FOpenSonarFile(file)
+    count = sonar.frameCount if frame_limit <= 0 else min(frame_limit, sonar.frameCount)
+    polar_transform = createPolarTransform(sonar)
+    shape = polar_transform.cart_shape
+    packed_len = (shape[0] * shape[1] + 7) // 8
+
+    mog_parameters = [parametersFromDict(MOGParameters, d) for d in mog_dicts]
+    models = [createMOG(p) for p in mog_parameters]
+    times = [0.0] * len(models)
+
+    # Training, each model uses its own training frames (nof_bg_frames).
+    training = {}
+    for i, params in enumerate(mog_parameters):
+        for ind in getTrainingIndices(count, params.data.nof_bg_frames):
+            training.setdefault(ind, []).append(i)
+
+    decode_time = 0.0
+    training_images = {}
+    for ind in sorted(training.keys()):
+        t = time.time()
+        image = polar_transform.remap(sonar.getPolarFrame(ind))
+        decode_time += time.time() - t
+        if ind < count:
+            training_images[ind] = image
+        for i in training[ind]:
+            t = time.time()
+            models[i].apply(image, learningRate=mog_parameters[i].data.learning_rate)
+            times[i] += time.time() - t
+
+    base_name = os.path.join(mask_directory, f"{os.getpid()}_{os.path.basename(file)}")
+    paths = [f"{base_name}_{i}.npy" for i in range(len(models))]
+    masks = [np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(count, packed_len)) for path in paths]
+
+    for ind in range(count):
+        image = training_images.pop(ind, None)
+        if image is None:
+            t = time.time()
+            image = polar_transform.remap(sonar.getPolarFrame(ind))
+            decode_time += time.time() - t
+        for i, model in enumerate(models):
+            t = time.time()
+            masks[i][ind] = packMask(model.apply(image, learningRate=0))
+            times[i] += time.time() - t
+
+    for m in masks:
+        m.flush()
+
+    # Decoding is shared by all the MOG variants.
+    shared_time = decode_time / len(models)
+    return polar_transform, count, shape, [(path, t + shared_time) for path, t in zip(paths, times)]
+
+def trackStore(store, tracker_parameters):
+    """
+    Runs the tracking engine over the detections in store. Returns the number of tracks.
+    """
+    mot_tracker = createTrackingEngine(tracker_parameters.getParameter(TrackerParameters.ParametersEnum.engine),
+                                       tracker_parameters.getParameter(TrackerParameters.ParametersEnum.max_age),
+                                       tracker_parameters.getParameter(TrackerParameters.ParametersEnum.min_hits),
+                                       tracker_parameters.getParameter(TrackerParameters.ParametersEnum.search_radius))
+    KalmanBoxTracker.count = 0
+
+    ids = set()
+    for ind in range(len(store)):
+        tracks = mot_tracker.update(store.getBoxes(ind))
+        ids.update(int(tr[4]) for tr in tracks)
+    return len(ids)
+
+def evaluateGroup(task):
+    """
+    Clusters the masks once with the median filter and clustering parameters of the group,
+    and runs detection geometry and tracking for all the variants of the group.
+    Returns a list of result dictionaries.
+    """
+    count = task["count"]
+    shape = task["shape"]
+    polar_transform = task["polar_transform"]
+    masks = np.load(task["mask_path"], mmap_mode="r")
+    base_parameters = parametersFromDict(DetectorParameters, task["detector_dicts"][0])
+
+    t = time.time()
+    clusters = [clusterPixels(filterMaskPixels(unpackMask(masks[ind], shape), base_parameters)[1], base_parameters)
+                for ind in range(count)]
+    cluster_time = time.time() - t
+
+    results = []
+    geometry_cache = {}
+    for detector_dict in task["detector_dicts"]:
+        detection_size = detector_dict["detection_size"]
+
+        if detection_size not in geometry_cache:
+            t = time.time()
+            store = DetectionStore.fromFrames([detectionsFromClusters(c, detection_size, polar_transform) for c in clusters])
+            geometry_cache[detection_size] = (store, time.time() - t)
+        store, geometry_time = geometry_cache[detection_size]
+
+        for tracker_dict in task["tracker_dicts"]:
+            t = time.time()
+            track_count = trackStore(store, parametersFromDict(TrackerParameters, tracker_dict))
+            track_time = time.time() - t
+
+            results.append({
+                "file": task["file"],
+                "mog": task["mog_dict"],
+                "detector": detector_dict,
+                "tracker": tracker_dict,
+                "detections": store.detectionCount(),
+                "tracks": track_count,
+                "time": task["mask_time"] + cluster_time + geometry_time + track_time,
+                "frame_offsets": store.columns.frame_offsets,
+                "centers": store.columns.center
+                })
+
+    return results
+
+def detectionAgreement(reference, result):
+    """
+    Returns the F1 score of the detections in result compared to the detections in reference.
+    Detections are matched frame by frame based on the distance between their centers.
+    """
+    ref_offsets, ref_centers = reference["frame_offsets"], reference["centers"]
+    offsets, centers = result["frame_offsets"], result["centers"]
+    total = len(ref_centers) + len(centers)
+    if total == 0:
+        return 1.0
+
+    matches = 0
+    for ind in range(len(offsets) - 1):
+        a = ref_centers[ref_offsets[ind]:ref_offsets[ind+1]]
+        b = centers[offsets[ind]:offsets[ind+1]]
+        if len(a) == 0 or len(b) == 0:
+            continue
+        distances = cdist(a, b)
+        rows, cols = linear_sum_assignment(distances)
+        matches += np.count_nonzero(distances[rows, cols] <= AGREEMENT_RADIUS)
+
+    return 2 * matches / total
+
+def runSweep(files, grid, processes=1, frame_limit=-1):
+    """
+    Runs all the combinations in grid for all the files.
+    Returns a list of result dictionaries. Agreement is computed against the first combination of each file.
+    """
+    mog_dicts = expandGrid(MOGParameters, grid.get("mog", {}))
+    detector_dicts = expandGrid(DetectorParameters, grid.get("detector", {}))
+    tracker_dicts = expandGrid(TrackerParameters, grid.get("tracker", {}))
+    LogObject().print(f"Parameter sweep: {len(files)} file(s), "
+                      f"{len(mog_dicts) * len(detector_dicts) * len(tracker_dicts)} combination(s) per file.")
+
+    # Group detector variants that share the median filter and clustering stages.
+    groups = {}
+    for d in detector_dicts:
+        params = parametersFromDict(DetectorParameters, d)
+        key = (stageParameterValues(params, Stage.MEDIAN_FILTER), stageParameterValues(params, Stage.CLUSTERING))
+        groups.setdefault(key, []).append(d)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="fish_tracker_sweep_") as mask_directory:
+        with mp.get_context("spawn").Pool(processes) as pool:
+            mask_results = [pool.apply_async(computeMasks, (file, mog_dicts, frame_limit, mask_directory)) for file in files]
+
+            group_results = []
+            for file, mask_result in zip(files, mask_results):
+                polar_transform, count, shape, masks = mask_result.get()
+                LogObject().print(f"Foreground masks computed: {file}")
+
+                for mog_dict, (mask_path, mask_time) in zip(mog_dicts, masks):
+                    for group in groups.values():
+                        task = { "file": file, "mog_dict": mog_dict, "mask_path": mask_path, "mask_time": mask_time,
+                                 "count": count, "shape": shape, "polar_transform": polar_transform,
+                                 "detector_dicts": group, "tracker_dicts": tracker_dicts }
+                        group_results.append(pool.apply_async(evaluateGroup, (task,)))
+
+            for group_result in group_results:
+                results.extend(group_result.get())
+
+    for file in files:
+        file_results = [r for r in results if r["file"] == file]
+        reference = file_results[0]
+        for r in file_results:
+            r["agreement"] = detectionAgreement(reference, r)
+
+    return results
+
+def getVariedKeys(results, section):
+    """
+    Returns the keys in a result section (e.g. 'mog') that have more than one value.
+    """
+    if len(results) == 0:
+        return []
+    keys = results[0][section].keys()
+    return [k for k in keys if len(set(hashableValue(r[section][k]) for r in results)) > 1]
+
+def formatTable(results, separator=";"):
+    """
+    Returns the results as lines of text. Only the parameters that vary are included.
+    """
+    sections = ["mog", "detector", "tracker"]
+    varied = [(s, k) for s in sections for k in getVariedKeys(results, s)]
+
+    header = ["file"] + [k for s, k in varied] + ["detections", "tracks", "time (s)", "agreement"]
+    lines = [separator.join(header)]
+    for r in results:
+        row = [os.path.basename(r["file"])] + [str(r[s][k]) for s, k in varied] \
+            + [str(r["detections"]), str(r["tracks"]), "{:.2f}".format(r["time"]), "{:.3f}".format(r["agreement"])]
+        lines.append(separator.join(row))
+    return lines
+
+def getParser():
+    parser = argparse.ArgumentParser(description="Runs detection and tracking with a grid of parameters.")
+    parser.add_argument('-f', '--file', type=str, nargs='+', required=True, help=".aris file(s) to be processed")
+    parser.add_argument('-g', '--grid', type=str, required=True, help="JSON file containing the parameter grid")
+    parser.add_argument('-p', '--processes', type=int, default=1, help="number of worker processes")
+    parser.add_argument('-n', '--frames', type=int, default=-1, help="max number of frames processed per file")
+    parser.add_argument('-o', '--output', type=str, default=None, help="file where the result table is written (csv)")
+    return parser
+
+def main():
+    args = getParser().parse_args()
+    with open(args.grid, "r") as f:
+        grid = json.load(f)
+
+    results = runSweep(args.file, grid, args.processes, args.frames)
+    lines = formatTable(results)
+    for line in lines:
+        LogObject().print(line)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        LogObject().print("Results saved to path:", args.output)
+
+if __name__ == "__main__":
+    mp.freeze_support()
+    main()
@@ -0,0 +1,108 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from enum import IntEnum
+
+from mog_parameters import MOGParameters
+from detector_parameters import DetectorParameters
+from tracker_parameters import TrackerParameters
+
+class Stage(IntEnum):
+    """
+    Stages of the analysis pipeline in processing order. The output of a stage
+    depends on its own parameters and the outputs of all the previous stages.
+    """
+    BACKGROUND_MODEL = 1
+    FOREGROUND_MASK = 2
+    ACTIVITY_FILTER = 3
+    MEDIAN_FILTER = 4
+    CLUTTER_MASK = 5
+    CLUSTERING = 6
+    DETECTION_GEOMETRY = 7
+    TRACKING = 8
+    FISH_METRICS = 9
+
+# Parameters that directly affect the output of each stage.
+stage_parameters = {
+    Stage.BACKGROUND_MODEL: [MOGParameters.ParametersEnum.learning_rate,
+                             MOGParameters.ParametersEnum.mixture_count,
+                             MOGParameters.ParametersEnum.mog_var_thresh,
+                             MOGParameters.ParametersEnum.nof_bg_frames,
+                             MOGParameters.ParametersEnum.bg_model,
+                             MOGParameters.ParametersEnum.bg_percentile,
+                             MOGParameters.ParametersEnum.bg_threshold,
+                             MOGParameters.ParametersEnum.rolling_update,
+                             MOGParameters.ParametersEnum.rolling_learning_rate,
+                             MOGParameters.ParametersEnum.rolling_window,
+                             MOGParameters.ParametersEnum.rolling_snapshot,
+                             MOGParameters.ParametersEnum.training_scale,
+                             DetectorParameters.ParametersEnum.roi_min_range,
+                             DetectorParameters.ParametersEnum.roi_max_range,
+                             DetectorParameters.ParametersEnum.roi_min_angle,
+                             DetectorParameters.ParametersEnum.roi_max_angle,
+                             DetectorParameters.ParametersEnum.roi_polygon],
+    Stage.FOREGROUND_MASK: [],
+    Stage.ACTIVITY_FILTER: [DetectorParameters.ParametersEnum.activity_filter,
+                            DetectorParameters.ParametersEnum.activity_threshold,
+                            DetectorParameters.ParametersEnum.activity_padding],
+    Stage.MEDIAN_FILTER: [DetectorParameters.ParametersEnum.median_size],
+    Stage.CLUTTER_MASK: [DetectorParameters.ParametersEnum.clutter_filter,
+                         DetectorParameters.ParametersEnum.clutter_occupancy],
+    Stage.CLUSTERING: [DetectorParameters.ParametersEnum.min_fg_pixels,
+                       DetectorParameters.ParametersEnum.dbscan_eps,
+                       DetectorParameters.ParametersEnum.dbscan_min_samples],
+    Stage.DETECTION_GEOMETRY: [DetectorParameters.ParametersEnum.detection_size],
+    Stage.TRACKING: [TrackerParameters.ParametersEnum.max_age,
+                     TrackerParameters.ParametersEnum.min_hits,
+                     TrackerParameters.ParametersEnum.search_radius,
+                     TrackerParameters.ParametersEnum.engine],
+    Stage.FISH_METRICS: [TrackerParameters.ParametersEnum.trim_tails]
+    }
+
+parameter_stages = { key: stage for stage, keys in stage_parameters.items() for key in keys }
+
+def getParameterStage(key):
+    """
+    Returns the stage the given parameter (ParametersEnum) belongs to.
+    """
+    return parameter_stages[key]
+
+def firstChangedStage(old_parameters, new_parameters):
+    """
+    Compares two parameter objects of the same type (e.g. applied and current DetectorParameters)
+    and returns the earliest stage affected by the differences, or None if the parameters are equal.
+    If old_parameters is None, all the parameters are considered changed.
+    """
+    stages = [getParameterStage(key) for key in type(new_parameters).ParametersEnum
+              if old_parameters is None or old_parameters.getParameter(key) != new_parameters.getParameter(key)]
+    return min(stages) if len(stages) > 0 else None
+
+def hashableValue(value):
+    """
+    Returns a parameter value in a hashable form: lists (e.g. roi_polygon) are converted to tuples.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(hashableValue(v) for v in value)
+    return value
+
+def stageParameterValues(parameters, stage):
+    """
+    Returns the values of the parameters of a stage as a tuple, e.g. to be used as a part of a cache key.
+    """
+    return tuple(hashableValue(parameters.getParameter(key)) for key in stage_parameters[stage] if key in parameters.fields)
@@ -0,0 +1,78 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import base64
+import numpy as np
+
+def pixelsToRuns(pixels):
+    """
+    Encodes pixel coordinates (N x 2, row and column) into horizontal runs:
+    an M x 3 uint16 array of (row, col_start, col_end), col_end inclusive, sorted by row and column.
+    """
+    pixels = np.asarray(pixels).reshape(-1, 2)
+    if len(pixels) == 0:
+        return np.empty((0, 3), dtype=np.uint16)
+
+    order = np.lexsort((pixels[:, 1], pixels[:, 0]))
+    rows = pixels[order, 0].astype(np.int64)
+    cols = pixels[order, 1].astype(np.int64)
+
+    # A run starts where the row changes or the columns are not consecutive.
+    starts = np.ones(len(rows), dtype=bool)
+    starts[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1] + 1)
+    start_inds = np.nonzero(starts)[0]
+    end_inds = np.append(start_inds[1:], len(rows)) - 1
+    return np.stack((rows[start_inds], cols[start_inds], cols[end_inds]), axis=1).astype(np.uint16)
+
+def runsToPixels(runs):
+    """
+    Decodes runs created with pixelsToRuns into pixel coordinates (N x 2 int32, row-major order).
+    """
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 3)
+    lengths = runs[:, 2] - runs[:, 1] + 1
+    offsets = np.cumsum(lengths) - lengths
+    rows = np.repeat(runs[:, 0], lengths)
+    cols = np.arange(np.sum(lengths), dtype=np.int64) + np.repeat(runs[:, 1] - offsets, lengths)
+    return np.stack((rows, cols), axis=1).astype(np.int32)
+
+def runPixelCount(runs):
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 3)
+    return int(np.sum(runs[:, 2] - runs[:, 1] + 1))
+
+def encodeRuns(runs):
+    """
+    Encodes runs into a string that can be written to a save file (JSON / msgpack).
+    """
+    return base64.b64encode(np.asarray(runs, dtype="<u2").tobytes()).decode("ascii")
+
+def decodeRuns(string):
+    """
+    Decodes runs encoded with encodeRuns.
+    """
+    return np.frombuffer(base64.b64decode(string), dtype="<u2").reshape(-1, 3).astype(np.uint16)
+
+def readPixels(value):
+    """
+    Returns the pixel coordinates of a detection read from a save file. Pixels are stored as
+    runs encoded with encodeRuns, or as a list of [row, column] pairs in older files.
+    """
+    if isinstance(value, str):
+        return runsToPixels(decodeRuns(value))
+    return np.asarray(value).reshape(-1, 2)
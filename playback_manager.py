@@ -33,6 +33,18 @@ from log_object import LogObject
 
 FRAME_SIZE = 1.5
 
+def createPolarTransform(sonar, height=None):
+    """
+    Creates the polar to cartesian mapping of a sonar file.
+    If height is not given, the sonar image height set in user preferences is used.
+    """
+    radius_limits = (sonar.windowStart, sonar.windowStart + sonar.windowLength)
+    if height is None:
+        height = fh.getSonarHeight()
+    beam_angle = 2 * sonar.firstBeamAngle/180*np.pi
+
+    return PolarTransform(sonar.DATA_SHAPE, height, radius_limits, beam_angle)
+
 class Event(list):
     def __call__(self, *args, **kwargs):
         for f in self:
@@ -384,11 +396,25 @@ class PlaybackManager(QObject):
         """
         Non-threaded option to get cartesinan frames.
         """
+        return self.remapPolarFrame(self.getPolarFrame(i))
+
+    def remapPolarFrame(self, polar):
+        """
+        Transforms a polar frame to a cartesian frame. Does not access the file or the buffer,
+        so it can be called from worker threads (cv2.remap releases the GIL).
+        """
+        return self.playback_thread.polar_transform.remap(polar)
+
+    def getPolarFrame(self, i):
+        """
+        Non-threaded option to get polar frames. Frames that are not yet
+        in the buffer are read from the file and stored.
+        """
         polar = self.playback_thread.buffer[i]
         if polar is None:
             polar = self.sonar.getPolarFrame(i)
             self.playback_thread.buffer[i] = polar
-        return self.playback_thread.polar_transform.remap(polar)
+        return polar
 
     def getFrameCount(self):
         if self.sonar:
@@ -522,11 +548,7 @@ class PlaybackThread(QRunnable):
             self.signals.polars_loaded_signal.emit()
 
     def createMapping(self):
-        radius_limits = (self.sonar.windowStart, self.sonar.windowStart + self.sonar.windowLength)
-        height = fh.getSonarHeight()
-        beam_angle = 2 * self.sonar.firstBeamAngle/180*np.pi
-
-        return PolarTransform(self.sonar.DATA_SHAPE, height, radius_limits, beam_angle)
+        return createPolarTransform(self.sonar)
 
     def mappingDone(self, result):
         if self.alive:
@@ -0,0 +1,166 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import numpy as np
+import cv2
+
+from log_object import LogObject
+
+class RegionOfInterest:
+    """
+    Region of interest defined in metric terms: range gates (m), angle gates (deg, same
+    convention as Detection.angle) and an optional polygon of (distance, angle) vertices.
+    Max values of zero leave the corresponding bound open.
+    """
+    def __init__(self, min_range=0.0, max_range=0.0, min_angle=0.0, max_angle=0.0, polygon=()):
+        self.min_range = float(min_range)
+        self.max_range = float(max_range)
+        self.min_angle = float(min_angle)
+        self.max_angle = float(max_angle)
+        self.polygon = tuple((float(d), float(a)) for d, a in polygon)
+
+    @staticmethod
+    def fromParameters(parameters):
+        """
+        Creates a region from the roi_* values of DetectorParameters.
+        """
+        data = parameters.data
+        return RegionOfInterest(data.roi_min_range, data.roi_max_range, data.roi_min_angle,
+                                data.roi_max_angle, data.roi_polygon)
+
+    def isDefined(self):
+        return self.min_range > 0 or self.max_range > 0 or self.min_angle > 0 \
+            or self.max_angle > 0 or len(self.polygon) >= 3
+
+    def getKey(self):
+        return (self.min_range, self.max_range, self.min_angle, self.max_angle, self.polygon)
+
+    def compile(self, polar_transform):
+        """
+        Compiles the region to a CompiledRegion for the image geometry of polar_transform.
+        Returns None if the region is not defined.
+        """
+        if not self.isDefined() or polar_transform is None:
+            return None
+
+        # Metric polar coordinates of each cartesian pixel, as in Detection.
+        height, width = polar_transform.cart_shape
+        ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+        distance, angle = polar_transform.cart2polMetric(ys, xs, True)
+        angle = angle / np.pi * 180 + 90
+
+        mask = distance >= self.min_range
+        if self.max_range > 0:
+            mask &= distance <= self.max_range
+        if self.min_angle > 0:
+            mask &= angle >= self.min_angle
+        if self.max_angle > 0:
+            mask &= angle <= self.max_angle
+
+        if len(self.polygon) >= 3:
+            points = [polar_transform.pol2cartMetric(d, (a - 90) / 180 * np.pi, True) for d, a in self.polygon]
+            points = np.array([[x, y] for y, x in points], dtype=np.int32)
+            polygon_mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.fillPoly(polygon_mask, [points], 1)
+            mask &= polygon_mask > 0
+
+        if not np.any(mask):
+            LogObject().print("Region of interest does not contain any pixels and is ignored.")
+            return None
+
+        key = (self.getKey(), tuple(polar_transform.cart_shape))
+        return CompiledRegion(key, mask, polar_transform.map_y, polar_transform.map_x)
+
+
+class CompiledRegion:
+    """
+    Region of interest compiled to a pixel mask of a specific image geometry.
+    Processing is limited to the bounding box of the mask (crop / expand) and the pixels
+    outside the mask are set to background (apply). The corresponding polar index ranges
+    (rows: range bins, cols: beams) are used for polar data, e.g. in Echogram.
+    """
+    def __init__(self, key, mask, map_y, map_x):
+        self.key = key
+        self.mask = mask
+        self.shape = mask.shape
+
+        rows = np.flatnonzero(np.any(mask, axis=1))
+        cols = np.flatnonzero(np.any(mask, axis=0))
+        if len(rows) == 0:
+            self.slices = (slice(0, 0), slice(0, 0))
+            self.polar_rows = self.polar_cols = slice(0, 0)
+        else:
+            self.slices = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            polar_y = map_y[mask]
+            polar_x = map_x[mask]
+            self.polar_rows = slice(max(0, math.floor(np.min(polar_y))), math.ceil(np.max(polar_y)) + 1)
+            self.polar_cols = slice(max(0, math.floor(np.min(polar_x))), math.ceil(np.max(polar_x)) + 1)
+
+        self.cropped_mask = mask[self.slices]
+
+        # Mapping from polar frames directly to the cropped cartesian image.
+        self.map_y = np.ascontiguousarray(map_y[self.slices])
+        self.map_x = np.ascontiguousarray(map_x[self.slices])
+
+    def fraction(self):
+        """
+        Returns the fraction of the image processed (bounding box of the mask).
+        """
+        return self.cropped_mask.size / self.mask.size if self.mask.size > 0 else 0.0
+
+    def matches(self, image):
+        return image is not None and image.shape[:2] == self.shape
+
+    def crop(self, image):
+        return image[self.slices]
+
+    def remap(self, polar_image, interpolation=cv2.INTER_LINEAR):
+        """
+        Transforms a polar frame to the cropped cartesian image, skipping the pixels outside the bounding box.
+        """
+        return cv2.remap(polar_image, self.map_x, self.map_y, interpolation)
+
+    def expand(self, cropped):
+        """
+        Places an image computed from a cropped image back to the full image size.
+        Pixels outside the region are zero.
+        """
+        image = np.zeros(self.shape + cropped.shape[2:], dtype=cropped.dtype)
+        image[self.slices] = cropped
+        image[self.slices][~self.cropped_mask] = 0
+        return image
+
+    def apply(self, image):
+        """
+        Returns a copy of image where the pixels outside the region are zero.
+        """
+        if not self.matches(image):
+            return image
+        image = image.copy()
+        image[~self.mask] = 0
+        return image
+
+    def contains(self, y, x):
+        """
+        Returns a boolean array telling which of the points (y, x) are inside the region.
+        """
+        y = np.clip(np.asarray(y, dtype=np.int64), 0, self.shape[0] - 1)
+        x = np.clip(np.asarray(x, dtype=np.int64), 0, self.shape[1] - 1)
+        return self.mask[y, x]
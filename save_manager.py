@@ -34,7 +34,7 @@ from log_object import LogObject
 File format as follows:
 {
     "file type": "FishTracker"
-    "version": "0.1",
+    "version": "0.2",
     "path": "C:\Vetsjoki\Vetsi_2016-06-18_170000.aris",
     "inverted upstream": false,
     "detector": {
@@ -49,7 +49,12 @@ File format as follows:
             "min_fg_pixels": 25,
             "median_size": 3,
             "dbscan_eps": 10,
-            "dbscan_min_samples": 10
+            "dbscan_min_samples": 10,
+            ...
+        },
+        "clutter_mask": {
+            "shape": [height, width],
+            "data": base64 encoded bit-packed mask
         }
     },
     "tracker": {
@@ -57,7 +62,8 @@ File format as follows:
             "max_age": 10,
             "min_hits": 5,
             "search_radius": 10,
-            "trim_tails": true
+            "trim_tails": true,
+            "engine": "sort"
         },
         "filtering": {
             "min_duration": 2,
@@ -67,13 +73,17 @@ File format as follows:
             "max_age": 10,
             "min_hits": 5,
             "search_radius": 10,
-            "trim_tails": true
+            "trim_tails": true,
+            "engine": "sort"
         }
     },
     "detections":
     {
-        frame_1: [[detection_label_0, [[x,y], [x,y], [x,y], [x,y]]]],
-        frame_2: [[detection_label_1, [[x,y], [x,y]]], [detection_label_2, [[x,y], [x,y], [x,y]]]]
+        frame_1: [[detection_label_0, runs]],
+        frame_2: [[detection_label_1, runs], [detection_label_2, runs]]
+
+        runs: base64 encoded uint16 array of (row, col_start, col_end) per pixel run (see pixel_runs).
+        Older files store a list of pixels instead: [[x,y], [x,y], [x,y]].
     },
     "fish":
     {
@@ -120,7 +130,7 @@ class SaveManager(QtCore.QObject):
 		detections = self.detector.getSaveDictionary()
 		fish = self.fish_manager.getSaveDictionary()
 
-		data = { "file type": "FishTracker", "version": "0.1" }
+		data = { "file type": "FishTracker", "version": "0.2" }
 		data["path"] = os.path.abspath(self.playback_manager.path)
 		data["inverted upstream"] = self.fish_manager.up_down_inverted
 		data["detector"] = dp_dict
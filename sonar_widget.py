@@ -26,10 +26,12 @@ from main_window import MainWindow
 from image_manipulation import ImageProcessor
 from zoomable_qlabel import ZoomableQLabel
 from detector import Detector
+from detector_parameters import DetectorParameters
 from tracker import Tracker
 from fish_manager import FishManager, FishEntry, pyqt_palette, color_palette_deep, N_COLORS
 from playback_manager import Event
 from log_object import LogObject
+from overlay_renderer import overlayAreas
 
 ## DEBUG :{ following block of libraries for debug only
 import os
@@ -179,7 +181,10 @@ class SonarViewer(QtWidgets.QDialog):
             if sfig.show_tracks or sfig.show_track_id:
                 sfig.visualized_tracks = self.fish_manager.getFishInFrame(ind)
 
-            # Overlay detections used in tracking and remove them from other detections
+            # Detection areas (runs, color) are painted on the image in one pass.
+            tracked_areas = []
+
+            # Collect detections used in tracking and remove them from other detections
             if sfig.show_tracks:
                 dets_in_tracks = set()
                 for fish in sfig.visualized_tracks:
@@ -187,23 +192,24 @@ class SonarViewer(QtWidgets.QDialog):
                     if det is not None:
                         dets_in_tracks.add(det)
                         if sfig.show_detections:
-                            image = det.visualizeArea(image, color_palette_deep[fish.color_ind])
+                            tracked_areas.append((det.runs, color_palette_deep[fish.color_ind]))
                     
                 detections = [d for d in self.detector.getCurrentDetection() if d not in dets_in_tracks]
             else:
                 detections = self.detector.getCurrentDetection()
             
             # Overlay rest of the detections
+            areas = []
             if sfig.show_detections or (sfig.show_detection_size and not sfig.show_tracks):
                 sfig.visualized_dets = detections
                 if sfig.show_detections:
                     if sfig.show_tracks:
-                        for det in detections:
-                            image = det.visualizeArea(image, [0.9] * 3)
+                        areas = [(det.runs, [0.9] * 3) for det in detections]
                     else:
                         colors = sns.color_palette('deep', max([0] + [det.label + 1 for det in detections]))
-                        for det in detections:
-                            image = det.visualizeArea(image, colors[det.label])
+                        areas = [(det.runs, colors[det.label]) for det in detections]
+
+            image = overlayAreas(image, tracked_areas + areas)
         
             if self.show_first_frame:
                 sfig.resetViewToShape(image.shape)
@@ -248,6 +254,31 @@ class SonarViewer(QtWidgets.QDialog):
 
     def measureDistance(self, value):
         self.sonar_figure.setMeasuring(value)
+
+    def drawRegion(self, value):
+        self.sonar_figure.setDrawingRegion(value)
+
+    def regionDone(self, points):
+        """
+        Sets the polygon drawn in SonarFigure (list of (x, y) image coordinates) as the region of interest.
+        Less than three points clears the polygon.
+        """
+        polygon = []
+        if points is not None and len(points) >= 3 and self.polar_transform is not None:
+            for x, y in points:
+                distance, angle = self.polar_transform.cart2polMetric(y, x, True)
+                polygon.append([float(distance), float(angle / np.pi * 180 + 90)])
+        self.detector.setParameter(DetectorParameters.ParametersEnum.roi_polygon, polygon)
+
+    def getRegionPolygon(self):
+        """
+        Returns the vertices of the region of interest polygon in image coordinates (x, y).
+        """
+        if self.polar_transform is None:
+            return []
+        polygon = self.detector.parameters.getParameter(DetectorParameters.ParametersEnum.roi_polygon)
+        points = [self.polar_transform.pol2cartMetric(d, (a - 90) / 180 * np.pi, True) for d, a in polygon]
+        return [(x, y) for y, x in points]
     
     def FBackgroundSubtract(self):
         """
@@ -595,6 +626,11 @@ class SonarFigure(ZoomableQLabel):
 
         self.measure_toggle = Event()
 
+        # Region of interest polygon being drawn (image coordinates).
+        self.drawing_region = False
+        self.region_points = []
+        self.region_toggle = Event()
+
         self.visualized_dets = []
         self.visualized_tracks = []
         self.visualized_id = 0
@@ -610,6 +646,16 @@ class SonarFigure(ZoomableQLabel):
     def mousePressEvent(self, event):
         super().mousePressEvent(event)
 
+        if self.drawing_region and self.pixmap():
+            if event.button() == QtCore.Qt.LeftButton:
+                self.region_points.append((self.view2imageX(event.x()), self.view2imageY(event.y())))
+                self.update()
+            elif event.button() == QtCore.Qt.RightButton:
+                # Right click closes the polygon.
+                self.sonar_viewer.regionDone(self.region_points)
+                self.setDrawingRegion(False)
+            return
+
         if event.button() == QtCore.Qt.LeftButton:
             xs = self.view2imageX(event.x())
             ys = self.view2imageY(event.y())
@@ -637,6 +683,12 @@ class SonarFigure(ZoomableQLabel):
             self.measure_point = None
             self.update()
     
+    def setDrawingRegion(self, value):
+        self.drawing_region = value
+        self.region_points = []
+        self.region_toggle(value)
+        self.update()
+
     def mouseMoveEvent(self, event):
         super().mouseMoveEvent(event)
 
@@ -645,6 +697,9 @@ class SonarFigure(ZoomableQLabel):
         self.measure_point = (self.view2imageX(event.x()), self.view2imageY(event.y()))
 
         if self.sonar_viewer:
+            if self.drawing_region and len(self.region_points) > 0:
+                self.update()
+
             if self.measure_origin is not None:
                 self.update()
                 self.sonar_viewer.setStatusBarDistance((self.measure_origin[1], self.measure_origin[0], ys, xs))
@@ -662,6 +717,7 @@ class SonarFigure(ZoomableQLabel):
         self.drawUpDown(painter)
         self.drawDepthAxis(painter)
         self.drawMeasurementLine(painter)
+        self.drawRegion(painter)
 
         self.visualizeDetections(painter, self.visualized_dets)
         self.visualizeFishTracks(painter, self.visualized_tracks)
@@ -727,6 +783,24 @@ class SonarFigure(ZoomableQLabel):
 
         painter.drawLine(x[0], y[0] ,x[1] ,y[1])
 
+    def drawRegion(self, painter):
+        """
+        Draws the region of interest polygon, or the polygon being drawn.
+        """
+        points = self.region_points if self.drawing_region else self.sonar_viewer.getRegionPolygon()
+        if len(points) == 0:
+            return
+
+        painter.setPen(QtCore.Qt.yellow)
+        x = self.image2viewX(np.array([p[0] for p in points]))
+        y = self.image2viewY(np.array([p[1] for p in points]))
+        for i in range(len(points) - 1):
+            painter.drawLine(x[i], y[i], x[i+1], y[i+1])
+        if not self.drawing_region or self.measure_point is None:
+            painter.drawLine(x[-1], y[-1], x[0], y[0])
+        else:
+            painter.drawLine(x[-1], y[-1], self.image2viewX(self.measure_point[0]), self.image2viewY(self.measure_point[1]))
+
     def visualizeDetections(self, painter, detections):
         painter.setPen(QtCore.Qt.white)
 
@@ -36,9 +36,17 @@ from skimage import io
 import glob
 import time
 import argparse
-from filterpy.kalman import KalmanFilter
 
 from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Phases of Sort.update, in the order they are run.
+UPDATE_PHASES = ("predict", "associate", "spawn", "prune")
+
+# Above this number of detection-track pairs, gating uses KD-trees instead of a dense distance matrix.
+DENSE_GATING_LIMIT = 1024
 
 def linear_assignment(cost_matrix):
   x, y = linear_sum_assignment(cost_matrix)
@@ -79,117 +87,343 @@ def eucl_batch(bb_test, bb_gt, radius=10):
 
   return o
 
-class KalmanBoxTracker(object):
+def _rows(name):
   """
-  This class represents the internal state of individual tracked objects observed as bbox.
+  Property returning the rows in use of the array attribute name of an ArrayBank.
   """
-  count = 0
+  return property(lambda self: getattr(self, name)[:self.count])
 
-  def __init__(self, z):
+class ArrayBank(object):
+  """
+  Per-track arrays stacked row by row, allocated with spare capacity. The first count rows are in use.
+  Subclasses allocate their arrays with allocate.
+  """
+  __slots__ = ("count", "_arrays")
 
-    KalmanBoxTracker.count += 1
+  def __init__(self):
+    self.count = 0
+    self._arrays = []
+
+  def __len__(self):
+    return self.count
 
-    self.kf = KalmanFilter(dim_x=4, dim_z=2)
-    self.id = KalmanBoxTracker.count
+  def allocate(self, name, shape, dtype, capacity=16):
+    setattr(self, name, np.zeros((capacity,) + shape, dtype=dtype))
+    self._arrays.append(name)
 
+  def add_row(self):
+    """
+    Reserves a new row (filled with zeros) and returns its index.
+    """
+    for name in self._arrays:
+      array = getattr(self, name)
+      if self.count == len(array):
+        setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+      getattr(self, name)[self.count] = 0
+    self.count += 1
+    return self.count - 1
+
+  def remove(self, keep):
+    """
+    Removes the rows where keep (boolean array) is False.
+    """
+    kept = int(np.count_nonzero(keep))
+    for name in self._arrays:
+      array = getattr(self, name)
+      array[:kept] = array[:self.count][keep]
+    self.count = kept
+
+class KalmanFilterBank(ArrayBank):
+  """
+  Constant velocity Kalman filters of all the tracks of a Sort tracker. All the tracks share
+  the same model (F, H, Q, R), so their states and covariances are kept in stacked arrays and
+  predicted and updated together. The equations are the same as in filterpy.kalman.KalmanFilter
+  (the covariance update uses the Joseph form).
+  Rows are in the order of the rows of TrackBank.
+  """
+  __slots__ = ("F", "H", "R", "Q", "P0", "I", "_x", "_P")
+
+  def __init__(self):
+    super().__init__()
     dt = 0.1
-    self.kf.F = np.array([[1, dt,  0,  0],
-                          [0,  1,  0,  0],
-                          [0,  0,  1, dt],  
-                          [0,  0,  0,  1]])
-    
-    self.kf.H = np.array([[1,0,0,0],
-                          [0,0,1,0]])
-
-    self.kf.R *= 1
-    self.kf.P *= 1000.0
-    self.kf.Q *= 0.1
-
-    self.kf.x[0] = z[0]
-    self.kf.x[2] = z[1]
-
-    self.time_since_update = 0
-    self.history = []
-    self.hits = 0
-    self.hit_streak = 0
-    self.age = 0
-    self.last_det_frame = 0
-    self.last_det_ind = -1
-    self.status = 0 # 0 = candidate, 1 = active, 2 = lost, 3 = removed
-    self.search_radius_coeff = 1
-  
-  def update(self, z):
-    self.kf.update(z)
+    self.F = np.array([[1, dt,  0,  0],
+                       [0,  1,  0,  0],
+                       [0,  0,  1, dt],
+                       [0,  0,  0,  1]], dtype=float)
+
+    self.H = np.array([[1,0,0,0],
+                       [0,0,1,0]], dtype=float)
+
+    self.R = np.eye(2)
+    self.Q = np.eye(4) * 0.1
+    self.P0 = np.eye(4) * 1000.0
+    self.I = np.eye(4)
+
+    self.allocate("_x", (4,), float)
+    self.allocate("_P", (4, 4), float)
+
+  x = _rows("_x")
+  P = _rows("_P")
+
+  def add(self, z):
+    """
+    Adds a filter initialized at position z. Returns the row of the new filter.
+    """
+    row = self.add_row()
+    self._x[row] = [z[0], 0, z[1], 0]
+    self._P[row] = self.P0
+    return row
 
   def predict(self):
-    self.kf.predict()
-    self.history.append([self.kf.x[0], self.kf.x[2]])
-    #if len(self.history) > 200:
-    #  self.history.pop(0)
-    return self.history[-1]
+    """
+    Predicts all the filters one step forward. Returns the predicted positions (N x 2).
+    """
+    x = self.x
+    x[:] = x @ self.F.T
+    P = self.P
+    P[:] = self.F @ P @ self.F.T + self.Q
+    return self.positions()
 
-  def get_state(self):
-    return np.array([self.kf.x[0], self.kf.x[2]])
+  def update(self, rows, z):
+    """
+    Updates the filters at rows with the measured positions z (len(rows) x 2).
+    """
+    if len(rows) == 0:
+      return
+    x = self._x[rows]
+    P = self._P[rows]
 
-  def get_status(self):
-    return self.status
+    y = z - x @ self.H.T
+    PHT = P @ self.H.T
+    S = self.H @ PHT + self.R
+    K = PHT @ np.linalg.inv(S)
+    x = x + (K @ y[..., np.newaxis])[..., 0]
 
-  def set_status(self, status):
-    self.status = status
+    I_KH = self.I - K @ self.H
+    KT = np.swapaxes(K, 1, 2)
+    P = I_KH @ P @ np.swapaxes(I_KH, 1, 2) + K @ self.R @ KT
 
-  def get_hit_streak(self):
-    return self.hit_streak
+    self._x[rows] = x
+    self._P[rows] = P
 
-def associate_detections_to_trackers(detections, trackers, search_radius=10):
+  def positions(self):
+    """
+    Returns the positions (N x 2) of all the filters.
+    """
+    return self.x[:, [0, 2]]
 
-  if len(trackers) == 0:
-    return np.empty((0,2), dtype=int), np.arange(len(detections)), np.empty((0,2), dtype=int)
+class TrackBank(ArrayBank):
+  """
+  Bookkeeping of all the tracks of a Sort tracker: id, time since update, hit streak, status
+  (0 = candidate, 1 = active, 2 = lost) and the latest associated detection.
+  If history_length > 0, the latest history_length predicted positions of each track are kept
+  in a ring buffer.
+  """
+  __slots__ = ("history_length", "_id", "_time_since_update", "_hit_streak", "_status",
+               "_last_det_ind", "_last_det_frame", "_history", "_history_count")
+
+  def __init__(self, history_length=0):
+    super().__init__()
+    self.history_length = history_length
+    self.allocate("_id", (), np.int64)
+    self.allocate("_time_since_update", (), np.int64)
+    self.allocate("_hit_streak", (), np.int64)
+    self.allocate("_status", (), np.int8)
+    self.allocate("_last_det_ind", (), np.int64)
+    self.allocate("_last_det_frame", (), np.int64)
+    if history_length > 0:
+      self.allocate("_history", (history_length, 2), float)
+      self.allocate("_history_count", (), np.int64)
+
+  id = _rows("_id")
+  time_since_update = _rows("_time_since_update")
+  hit_streak = _rows("_hit_streak")
+  status = _rows("_status")
+  last_det_ind = _rows("_last_det_ind")
+  last_det_frame = _rows("_last_det_frame")
+
+  def add(self, id, det_ind, frame):
+    row = self.add_row()
+    self._id[row] = id
+    self._last_det_ind[row] = det_ind
+    self._last_det_frame[row] = frame
+    return row
+
+  def record_history(self, positions):
+    """
+    Adds the current positions (N x 2) of all the tracks to their history.
+    """
+    if self.history_length <= 0 or self.count == 0:
+      return
+    counts = self._history_count[:self.count]
+    self._history[np.arange(self.count), counts % self.history_length] = positions
+    counts += 1
 
-  cost_matrix = eucl_batch(detections, trackers, search_radius)
-  
-  if min(cost_matrix.shape) > 0:
-    matched_indices = linear_assignment(cost_matrix)
+  def get_history(self, row):
+    """
+    Returns the latest positions of the track at row, oldest first.
+    """
+    if self.history_length <= 0:
+      return np.empty((0, 2))
+    count = self._history_count[row]
+    inds = np.arange(max(0, count - self.history_length), count) % self.history_length
+    return self._history[row, inds]
+
+class KalmanBoxTracker(object):
+  """
+  Allocates the ids of the tracks. The state of the tracks is kept in TrackBank and KalmanFilterBank.
+  """
+  __slots__ = ()
+  count = 0
+
+  @staticmethod
+  def next_id():
+    KalmanBoxTracker.count += 1
+    return KalmanBoxTracker.count
+
+def gate_pairs(detections, trackers, search_radius):
+  """
+  Returns the detection-track pairs within search_radius: (detection indices, track indices, squared distances).
+  """
+  if len(detections) * len(trackers) <= DENSE_GATING_LIMIT:
+    d_inds, t_inds = np.nonzero(eucl_batch(detections, trackers, search_radius) <= search_radius ** 2)
   else:
-    matched_indices = np.empty(shape=(0, 2))
-
-  unmatched_detections = []
-  for d, det in enumerate(detections):
-    if d not in matched_indices[:, 0]:
-      unmatched_detections.append(d)
-  unmatched_trackers = []
-  for t, trk in enumerate(trackers):
-    if t not in matched_indices[:, 1]:
-      unmatched_trackers.append(t)
-
-  # Filter out matched with too high cost
+    d_tree = cKDTree(detections)
+    t_tree = cKDTree(trackers)
+    pairs = d_tree.sparse_distance_matrix(t_tree, search_radius * (1 + 1e-9), output_type='ndarray')
+    d_inds = pairs['i'].astype(int)
+    t_inds = pairs['j'].astype(int)
+
+  diff = trackers[t_inds] - detections[d_inds]
+  cost = diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1]
+  valid = cost <= search_radius ** 2
+  return d_inds[valid], t_inds[valid], cost[valid]
+
+def associate_detections_to_trackers(detections, trackers, search_radius=10):
+  """
+  Assigns detections to the predicted track positions, minimizing the total squared distance.
+  Only pairs within search_radius are considered. The pairs form a bipartite graph, which is split
+  into connected components that are solved separately.
+  Returns (matches (K x 2: detection, track), unmatched detections, unmatched trackers).
+  Matches are sorted by detection and the unmatched indices are in ascending order. New tracks are
+  created from the unmatched detections in this order, which determines the ids of the new tracks and,
+  of two unmatched detections within search_radius of each other, the one that starts a track.
+  """
+  detections = np.asarray(detections, dtype=float).reshape(-1, 2)
+  trackers = np.asarray(trackers, dtype=float).reshape(-1, 2)
+  n_dets = len(detections)
+  n_trks = len(trackers)
+
+  if n_trks == 0 or n_dets == 0:
+    return np.empty((0,2), dtype=int), np.arange(n_dets), np.arange(n_trks)
+
+  d_inds, t_inds, cost = gate_pairs(detections, trackers, search_radius)
   matches = []
-  for m in matched_indices:
-    if cost_matrix[m[0], m[1]] > search_radius ** 2 * 100000000: # TODO
-      unmatched_detections.append(m[0])
-      unmatched_trackers.append(m[1])
-    else:
-      matches.append(m.reshape(1, 2))
+
+  if len(d_inds) > 0:
+    # Components of the graph where detections are nodes 0..n_dets-1 and tracks n_dets..
+    graph = coo_matrix((np.ones(len(d_inds)), (d_inds, t_inds + n_dets)), shape=(n_dets + n_trks,) * 2)
+    _, labels = connected_components(graph, directed=False)
+    edge_labels = labels[d_inds]
+
+    order = np.argsort(edge_labels, kind='stable')
+    splits = np.nonzero(np.diff(edge_labels[order]))[0] + 1
+    for edges in np.split(order, splits):
+      if len(edges) == 1:
+        matches.append([d_inds[edges[0]], t_inds[edges[0]]])
+        continue
+
+      comp_dets, d_local = np.unique(d_inds[edges], return_inverse=True)
+      comp_trks, t_local = np.unique(t_inds[edges], return_inverse=True)
+
+      # Gated pairs cost more than any set of valid pairs, so the number of valid matches is maximized first.
+      gated_cost = (search_radius ** 2 + 1) * (min(len(comp_dets), len(comp_trks)) + 1)
+      cost_matrix = np.full((len(comp_dets), len(comp_trks)), gated_cost, dtype=float)
+      cost_matrix[d_local, t_local] = cost[edges]
+      gated = np.ones(cost_matrix.shape, dtype=bool)
+      gated[d_local, t_local] = False
+
+      rows, cols = linear_sum_assignment(cost_matrix)
+      valid = ~gated[rows, cols]
+      matches.extend(zip(comp_dets[rows[valid]], comp_trks[cols[valid]]))
+
   if len(matches) == 0:
     matches = np.empty((0, 2), dtype=int)
   else:
-    matches = np.concatenate(matches, axis=0)
+    matches = np.array(matches, dtype=int)
+    matches = matches[np.argsort(matches[:, 0], kind='stable')]
 
-  return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+  det_matched = np.zeros(n_dets, dtype=bool)
+  det_matched[matches[:, 0]] = True
+  trk_matched = np.zeros(n_trks, dtype=bool)
+  trk_matched[matches[:, 1]] = True
+
+  return matches, np.nonzero(~det_matched)[0], np.nonzero(~trk_matched)[0]
 
 
 class Sort(object):
 
-  def __init__(self, max_age=1, min_hits=3, search_radius=10):
+  def __init__(self, max_age=1, min_hits=3, search_radius=10, history_length=0):
     """
-    Sets key parameters for SORT
+    Sets key parameters for SORT.
+    history_length: Number of the latest predicted positions kept for each track (0 = no history).
     """
     self.max_age = max_age
     self.min_hits = min_hits
     self.search_radius = search_radius
 
-    self.trackers = []
+    self.tracks = TrackBank(history_length)
+    self.kf_bank = KalmanFilterBank()
     self.frame_count = 0
-  
+
+    # Time spent in each phase of update (seconds).
+    self.timings = dict.fromkeys(UPDATE_PHASES, 0.0)
+
+  def reset_timings(self):
+    self.timings = dict.fromkeys(UPDATE_PHASES, 0.0)
+
+  def get_timings(self):
+    return dict(self.timings)
+
+  def add_time(self, phase, start):
+    """
+    Adds the time elapsed since start to the phase. Returns the current time.
+    """
+    now = time.perf_counter()
+    self.timings[phase] += now - start
+    return now
+
+  def add_tracker(self, z, det_ind):
+    self.kf_bank.add(z)
+    return self.tracks.add(KalmanBoxTracker.next_id(), det_ind, self.frame_count)
+
+  def remove_trackers(self, keep):
+    """
+    Removes the tracks where keep (boolean array) is False.
+    """
+    self.tracks.remove(keep)
+    self.kf_bank.remove(keep)
+
+  def spawn_allowed(self, candidates):
+    """
+    Returns a boolean array telling which of the candidate positions (N x 2) may start a new track,
+    when candidates are added in order. A new track is not started within search_radius of an existing
+    track or of a track started from an earlier candidate.
+    """
+    r2 = self.search_radius ** 2
+    positions = self.kf_bank.positions()
+    if len(positions) > 0:
+      allowed = ~np.any(eucl_batch(candidates, positions, self.search_radius) < r2, axis=1)
+    else:
+      allowed = np.ones(len(candidates), dtype=bool)
+
+    # Tracks started in this step also block the later candidates.
+    close = eucl_batch(candidates, candidates, self.search_radius) < r2
+    for i in range(len(candidates)):
+      if allowed[i]:
+        allowed[i + 1:] &= ~close[i, i + 1:]
+    return allowed
+
   def update(self, detz=np.empty((0, 4))):
 
     dets = np.empty((0, 2))
@@ -199,92 +433,79 @@ class Sort(object):
       dets[:, 1] = detz[:, 1] + (detz[:, 3] - detz[:, 1]) / 2.0
 
     self.frame_count += 1
-    trks = np.zeros((len(self.trackers), 2))
-    to_del = []
-    ret = []
-    for t, trk in enumerate(trks):
-
-      self.trackers[t].time_since_update += 1
-      
-      # Existing track set to lost
-      if self.trackers[t].get_status() == 1:
-        self.trackers[t].set_status(2)
-      
-      # Do not initiate tracks withtout consecutive associations
-      if self.trackers[t].get_status() == 0 and self.trackers[t].time_since_update > 0:
-        self.trackers[t].time_since_update = self.max_age + 1
-
-      pos = self.trackers[t].predict()
-      trk[:] = [pos[0], pos[1]]
-      if np.any(np.isnan(pos)):
-        to_del.append(t)
-
-    # TODO alla oleva turha?
-    trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
-
-    for t in reversed(to_del):
-      self.trackers.pop(t)
+    t = time.perf_counter()
+    tracks = self.tracks
 
-    matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks, self.search_radius)
+    tracks.time_since_update[:] += 1
 
-    for m in matched:
-
-      tr = self.trackers[m[1]]
-      tr.update(dets[m[0], :])
-
-      tr.time_since_update = 0
-      tr.hit_streak += 1
-
-      tr.last_det_ind = m[0]
-      tr.last_det_frame = self.frame_count
-
-      if tr.get_status() == 0 and tr.get_hit_streak() > self.min_hits:
-        tr.set_status(1)
-
-      if tr.get_status() == 2:
-        tr.set_status(1)
-    
-    for m in unmatched_trks:
-      tr = self.trackers[m]
-      if tr.get_status() == 2:
-        tr.hit_streak = 0
-
-    # create and initialise new trackers for unmatched detections
-    for i in unmatched_dets:
-      # do not initialize new track to existing bounding box area
-      new_allowed = True
-      for trk in self.trackers:
-        bb = np.array([trk.get_state()[0], trk.get_state()[1]]).reshape(1, -1)
-        cost = eucl_batch(bb, [dets[i, :]], self.search_radius)
-        if cost[0, 0] < self.search_radius ** 2:
-          new_allowed = False
-
-      if new_allowed:
-        trk = KalmanBoxTracker(dets[i, :])
-        trk.last_det_ind = i
-        trk.last_det_frame = self.frame_count
-        self.trackers.append(trk)
-    
-    i = len(self.trackers)
-    
-    for trk in reversed(self.trackers):
-        if True:
-          d = np.array([trk.get_state()[0], trk.get_state()[1]])
-          d_ind = trk.last_det_ind if trk.last_det_frame == self.frame_count else -1
-          status = trk.get_status()
-          # HACK: "lost" are treated as "tracked", this is for main application use
-          if status == 2:
-              status = 1
-          
-          ret.append(np.concatenate((d[0]-10, d[1]-10, d[0]+10, d[1]+10, [trk.id], [status], [trk.get_hit_streak()], [d_ind], [self.search_radius])).reshape(1,-1))
-        i -= 1
- 
-        # Delete tracks
-        if trk.time_since_update > self.max_age:
-          self.trackers.pop(i)
-          #trk.status = 3
+    # Existing track set to lost
+    status = tracks.status
+    status[status == 1] = 2
+
+    # Do not initiate tracks withtout consecutive associations
+    tracks.time_since_update[(status == 0) & (tracks.time_since_update > 0)] = self.max_age + 1
+
+    trks = self.kf_bank.predict()
+    tracks.record_history(trks)
+
+    valid = ~np.any(np.isnan(trks), axis=1)
+    if not np.all(valid):
+      self.remove_trackers(valid)
+      trks = trks[valid]
+    t = self.add_time("predict", t)
+
+    matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks, self.search_radius)
 
-    if len(ret) > 0:
-      return np.concatenate(ret)
+    if len(matched) > 0:
+      rows = matched[:, 1]
+      self.kf_bank.update(rows, dets[matched[:, 0], :])
+
+      tracks.time_since_update[rows] = 0
+      tracks.hit_streak[rows] += 1
+      tracks.last_det_ind[rows] = matched[:, 0]
+      tracks.last_det_frame[rows] = self.frame_count
+
+      matched_status = tracks.status[rows]
+      matched_status[(matched_status == 0) & (tracks.hit_streak[rows] > self.min_hits)] = 1
+      matched_status[matched_status == 2] = 1
+      tracks.status[rows] = matched_status
+
+    if len(unmatched_trks) > 0:
+      lost = unmatched_trks[tracks.status[unmatched_trks] == 2]
+      tracks.hit_streak[lost] = 0
+    t = self.add_time("associate", t)
+
+    # create and initialise new trackers for unmatched detections,
+    # but do not initialize new track to existing bounding box area
+    if len(unmatched_dets) > 0:
+      allowed = self.spawn_allowed(dets[unmatched_dets])
+      for i in unmatched_dets[allowed]:
+        self.add_tracker(dets[i, :], i)
+    t = self.add_time("spawn", t)
+
+    # Output rows are in reverse order of the tracks.
+    n = len(tracks)
+    ret = np.empty((n, 9))
+    if n > 0:
+      positions = self.kf_bank.positions()[::-1]
+      ret[:, 0:2] = positions - 10
+      ret[:, 2:4] = positions + 10
+      ret[:, 4] = tracks.id[::-1]
+      status = tracks.status[::-1].copy()
+      # HACK: "lost" are treated as "tracked", this is for main application use
+      status[status == 2] = 1
+      ret[:, 5] = status
+      ret[:, 6] = tracks.hit_streak[::-1]
+      ret[:, 7] = np.where(tracks.last_det_frame == self.frame_count, tracks.last_det_ind, -1)[::-1]
+      ret[:, 8] = self.search_radius
+
+      # Delete tracks
+      keep = tracks.time_since_update <= self.max_age
+      if not np.all(keep):
+        self.remove_trackers(keep)
+    self.add_time("prune", t)
+
+    if n > 0:
+      return ret
    
-    return np.empty((0, 8))
+    return np.empty((0, 9))
@@ -0,0 +1,535 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from collections import namedtuple
+import numpy as np
+from numba import njit
+
+from sort import KalmanBoxTracker
+
+# Columns of the tracks of a block of frames. Each row is the state of a track in a frame,
+# in the same format as the rows of TrackStore.
+TrackTable = namedtuple("TrackTable", ["frame", "id", "bbox", "status", "hit_streak", "det_ind"])
+
+# Model of the Kalman filters, the same as in sort.KalmanFilterBank.
+_DT = 0.1
+_Q = 0.1
+_P0 = 1000.0
+
+def boxCenters(boxes):
+    """
+    Returns the centers of the bounding boxes (N x 4) used as the measurements, computed as in Sort.update.
+    """
+    centers = np.empty((len(boxes), 2))
+    centers[:, 0] = boxes[:, 0] + (boxes[:, 2] - boxes[:, 0]) / 2.0
+    centers[:, 1] = boxes[:, 1] + (boxes[:, 3] - boxes[:, 1]) / 2.0
+    return centers
+
+@njit
+def _augmentingPath(cost, u, v, path, row4col, shortest, sr, sc, remaining, cur_row):
+    """
+    Finds the shortest augmenting path from cur_row. Returns the sink column (-1 if infeasible) and its cost.
+    """
+    nc = cost.shape[1]
+    min_val = 0.0
+    num_remaining = nc
+    for it in range(nc):
+        remaining[it] = nc - it - 1
+    sr[:] = False
+    sc[:] = False
+    shortest[:] = np.inf
+
+    sink = -1
+    i = cur_row
+    while sink == -1:
+        index = -1
+        lowest = np.inf
+        sr[i] = True
+        for it in range(num_remaining):
+            j = remaining[it]
+            r = min_val + cost[i, j] - u[i] - v[j]
+            if r < shortest[j]:
+                path[j] = i
+                shortest[j] = r
+            if shortest[j] < lowest or (shortest[j] == lowest and row4col[j] == -1):
+                lowest = shortest[j]
+                index = it
+
+        min_val = lowest
+        if min_val == np.inf:
+            return -1, min_val
+
+        j = remaining[index]
+        if row4col[j] == -1:
+            sink = j
+        else:
+            i = row4col[j]
+        sc[j] = True
+        num_remaining -= 1
+        remaining[index] = remaining[num_remaining]
+    return sink, min_val
+
+@njit
+def _linearSumAssignment(cost):
+    """
+    Solves the rectangular linear sum assignment problem with the shortest augmenting path method,
+    as scipy.optimize.linear_sum_assignment does, so that ties are resolved the same way.
+    Returns (rows, cols) of the assigned pairs.
+    """
+    transpose = cost.shape[1] < cost.shape[0]
+    if transpose:
+        cost = cost.T.copy()
+    nr, nc = cost.shape
+
+    u = np.zeros(nr)
+    v = np.zeros(nc)
+    shortest = np.empty(nc)
+    path = np.full(nc, -1, np.int64)
+    col4row = np.full(nr, -1, np.int64)
+    row4col = np.full(nc, -1, np.int64)
+    sr = np.zeros(nr, np.bool_)
+    sc = np.zeros(nc, np.bool_)
+    remaining = np.empty(nc, np.int64)
+
+    for cur_row in range(nr):
+        sink, min_val = _augmentingPath(cost, u, v, path, row4col, shortest, sr, sc, remaining, cur_row)
+        if sink < 0:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+
+        u[cur_row] += min_val
+        for i in range(nr):
+            if sr[i] and i != cur_row:
+                u[i] += min_val - shortest[col4row[i]]
+        for j in range(nc):
+            if sc[j]:
+                v[j] -= min_val - shortest[j]
+
+        j = sink
+        while True:
+            i = path[j]
+            row4col[j] = i
+            previous = col4row[i]
+            col4row[i] = j
+            j = previous
+            if i == cur_row:
+                break
+
+    if transpose:
+        return col4row, np.arange(nr)
+    return np.arange(nr), col4row
+
+@njit
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+@njit
+def _associate(dets, trks, r2):
+    """
+    Assigns detections to the predicted track positions as sort.associate_detections_to_trackers does:
+    pairs within the search radius form a bipartite graph whose connected components are solved separately.
+    Returns the matched track of each detection (-1 if unmatched).
+    """
+    n = dets.shape[0]
+    m = trks.shape[0]
+    det_match = np.full(n, -1, np.int64)
+    if n == 0 or m == 0:
+        return det_match
+
+    parent = np.arange(n + m)
+    has_edge = np.zeros(n + m, np.bool_)
+    for d in range(n):
+        for t in range(m):
+            dx = trks[t, 0] - dets[d, 0]
+            dy = trks[t, 1] - dets[d, 1]
+            if dx * dx + dy * dy <= r2:
+                has_edge[d] = True
+                has_edge[n + t] = True
+                a = _find(parent, d)
+                b = _find(parent, n + t)
+                if a != b:
+                    parent[b] = a
+
+    # Nodes of each component in ascending order (CSR), separately for detections and tracks.
+    comp_id = np.full(n + m, -1, np.int64)
+    comp_count = 0
+    for node in range(n + m):
+        if has_edge[node]:
+            root = _find(parent, node)
+            if comp_id[root] < 0:
+                comp_id[root] = comp_count
+                comp_count += 1
+            comp_id[node] = comp_id[root]
+    if comp_count == 0:
+        return det_match
+
+    det_offsets = np.zeros(comp_count + 1, np.int64)
+    trk_offsets = np.zeros(comp_count + 1, np.int64)
+    for node in range(n + m):
+        if has_edge[node]:
+            if node < n:
+                det_offsets[comp_id[node] + 1] += 1
+            else:
+                trk_offsets[comp_id[node] + 1] += 1
+    for c in range(comp_count):
+        det_offsets[c + 1] += det_offsets[c]
+        trk_offsets[c + 1] += trk_offsets[c]
+
+    det_nodes = np.empty(det_offsets[comp_count], np.int64)
+    trk_nodes = np.empty(trk_offsets[comp_count], np.int64)
+    det_fill = det_offsets[:-1].copy()
+    trk_fill = trk_offsets[:-1].copy()
+    for node in range(n + m):
+        if has_edge[node]:
+            c = comp_id[node]
+            if node < n:
+                det_nodes[det_fill[c]] = node
+                det_fill[c] += 1
+            else:
+                trk_nodes[trk_fill[c]] = node - n
+                trk_fill[c] += 1
+
+    for c in range(comp_count):
+        comp_dets = det_nodes[det_offsets[c]:det_offsets[c + 1]]
+        comp_trks = trk_nodes[trk_offsets[c]:trk_offsets[c + 1]]
+        nd = len(comp_dets)
+        nt = len(comp_trks)
+        if nd == 1 and nt == 1:
+            det_match[comp_dets[0]] = comp_trks[0]
+            continue
+
+        # Gated pairs cost more than any set of valid pairs, so the number of valid matches is maximized first.
+        gated_cost = (r2 + 1) * (min(nd, nt) + 1)
+        cost = np.empty((nd, nt))
+        for i in range(nd):
+            for j in range(nt):
+                dx = trks[comp_trks[j], 0] - dets[comp_dets[i], 0]
+                dy = trks[comp_trks[j], 1] - dets[comp_dets[i], 1]
+                d2 = dx * dx + dy * dy
+                cost[i, j] = d2 if d2 <= r2 else gated_cost
+
+        rows, cols = _linearSumAssignment(cost)
+        for k in range(len(rows)):
+            if cost[rows[k], cols[k]] <= r2:
+                det_match[comp_dets[rows[k]]] = comp_trks[cols[k]]
+
+    return det_match
+
+@njit
+def _compact(keep, count, x, P, ids, tsu, hit, status, last_det_ind, last_det_frame):
+    """
+    Removes the tracks where keep is False, preserving the order. Returns the new number of tracks.
+    """
+    kept = 0
+    for k in range(count):
+        if keep[k]:
+            if kept != k:
+                x[kept] = x[k]
+                P[kept] = P[k]
+                ids[kept] = ids[k]
+                tsu[kept] = tsu[k]
+                hit[kept] = hit[k]
+                status[kept] = status[k]
+                last_det_ind[kept] = last_det_ind[k]
+                last_det_frame[kept] = last_det_frame[k]
+            kept += 1
+    return kept
+
+@njit
+def _predict(x, P, count):
+    """
+    Kalman filter predict step of the first count filters: x = F x, P = F P F' + Q.
+    """
+    F = np.eye(4)
+    F[0, 1] = _DT
+    F[2, 3] = _DT
+    FP = np.empty((4, 4))
+    for k in range(count):
+        x0 = x[k, 0] + _DT * x[k, 1]
+        x2 = x[k, 2] + _DT * x[k, 3]
+        x[k, 0] = x0
+        x[k, 2] = x2
+
+        for a in range(4):
+            for b in range(4):
+                s = 0.0
+                for c in range(4):
+                    s += F[a, c] * P[k, c, b]
+                FP[a, b] = s
+        for a in range(4):
+            for b in range(4):
+                s = 0.0
+                for c in range(4):
+                    s += FP[a, c] * F[b, c]
+                P[k, a, b] = s + (_Q if a == b else 0.0)
+
+@njit
+def _update(x, P, k, z0, z1):
+    """
+    Kalman filter update step of filter k with the measured position (z0, z1).
+    The covariance is updated in the Joseph form, as in sort.KalmanFilterBank.
+    """
+    y0 = z0 - x[k, 0]
+    y1 = z1 - x[k, 2]
+
+    # S = H P H' + R
+    s00 = P[k, 0, 0] + 1.0
+    s01 = P[k, 0, 2]
+    s10 = P[k, 2, 0]
+    s11 = P[k, 2, 2] + 1.0
+    det = s00 * s11 - s01 * s10
+    i00 = s11 / det
+    i01 = -s01 / det
+    i10 = -s10 / det
+    i11 = s00 / det
+
+    # K = P H' S^-1
+    K = np.empty((4, 2))
+    for a in range(4):
+        K[a, 0] = P[k, a, 0] * i00 + P[k, a, 2] * i10
+        K[a, 1] = P[k, a, 0] * i01 + P[k, a, 2] * i11
+    for a in range(4):
+        x[k, a] += K[a, 0] * y0 + K[a, 1] * y1
+
+    # P = (I - K H) P (I - K H)' + K R K'
+    A = np.eye(4)
+    for a in range(4):
+        A[a, 0] -= K[a, 0]
+        A[a, 2] -= K[a, 1]
+    AP = np.empty((4, 4))
+    for a in range(4):
+        for b in range(4):
+            s = 0.0
+            for c in range(4):
+                s += A[a, c] * P[k, c, b]
+            AP[a, b] = s
+    for a in range(4):
+        for b in range(4):
+            s = 0.0
+            for c in range(4):
+                s += AP[a, c] * A[b, c]
+            P[k, a, b] = s + K[a, 0] * K[b, 0] + K[a, 1] * K[b, 1]
+
+@njit
+def _trackFrames(offsets, centers, start, first_frame, max_age, min_hits, search_radius,
+                 x, P, ids, tsu, hit, status, last_det_ind, last_det_frame, state,
+                 out_frame, out_id, out_bbox, out_status, out_hit, out_det, out_count):
+    """
+    Runs the steps of Sort.update for the frames from start on. State holds the number of tracks,
+    the frame counter and the latest allocated track id. Stops before a frame if the track arrays or
+    the output arrays might not have room for it. Returns the index of the next frame and the number of output rows.
+    """
+    n_frames = len(offsets) - 1
+    r2 = float(search_radius) ** 2
+    capacity = x.shape[0]
+    out_capacity = out_frame.shape[0]
+    count = state[0]
+
+    for f in range(start, n_frames):
+        d_start = offsets[f]
+        n = offsets[f + 1] - d_start
+        if count + n > capacity or out_count + count + n > out_capacity:
+            state[0] = count
+            return f, out_count
+
+        state[1] += 1
+        frame_count = state[1]
+
+        for k in range(count):
+            tsu[k] += 1
+            # Existing tracks set to lost
+            if status[k] == 1:
+                status[k] = 2
+            # Do not initiate tracks without consecutive associations
+            if status[k] == 0 and tsu[k] > 0:
+                tsu[k] = max_age + 1
+
+        _predict(x, P, count)
+        valid = np.ones(count, np.bool_)
+        all_valid = True
+        for k in range(count):
+            if np.isnan(x[k, 0]) or np.isnan(x[k, 2]):
+                valid[k] = False
+                all_valid = False
+        if not all_valid:
+            count = _compact(valid, count, x, P, ids, tsu, hit, status, last_det_ind, last_det_frame)
+
+        dets = centers[d_start:d_start + n]
+        trks = np.empty((count, 2))
+        for k in range(count):
+            trks[k, 0] = x[k, 0]
+            trks[k, 1] = x[k, 2]
+        det_match = _associate(dets, trks, r2)
+
+        matched = np.zeros(count, np.bool_)
+        for d in range(n):
+            k = det_match[d]
+            if k < 0:
+                continue
+            matched[k] = True
+            _update(x, P, k, dets[d, 0], dets[d, 1])
+            tsu[k] = 0
+            hit[k] += 1
+            last_det_ind[k] = d
+            last_det_frame[k] = frame_count
+            if status[k] == 0 and hit[k] > min_hits:
+                status[k] = 1
+            if status[k] == 2:
+                status[k] = 1
+
+        for k in range(count):
+            if not matched[k] and status[k] == 2:
+                hit[k] = 0
+
+        # Create new tracks for unmatched detections, but not close to existing tracks
+        # or to tracks created from earlier detections in this frame.
+        existing = count
+        for d in range(n):
+            if det_match[d] >= 0:
+                continue
+            allowed = True
+            for k in range(existing):
+                dx = dets[d, 0] - x[k, 0]
+                dy = dets[d, 1] - x[k, 2]
+                if dx * dx + dy * dy < r2:
+                    allowed = False
+                    break
+            if allowed:
+                for k in range(existing, count):
+                    dx = dets[d, 0] - x[k, 0]
+                    dy = dets[d, 1] - x[k, 2]
+                    if dx * dx + dy * dy < r2:
+                        allowed = False
+                        break
+            if not allowed:
+                continue
+
+            state[2] += 1
+            x[count, 0] = dets[d, 0]
+            x[count, 1] = 0.0
+            x[count, 2] = dets[d, 1]
+            x[count, 3] = 0.0
+            P[count] = 0.0
+            for a in range(4):
+                P[count, a, a] = _P0
+            ids[count] = state[2]
+            tsu[count] = 0
+            hit[count] = 0
+            status[count] = 0
+            last_det_ind[count] = d
+            last_det_frame[count] = frame_count
+            count += 1
+
+        # Output rows are in reverse order of the tracks, as in Sort.update.
+        for k in range(count - 1, -1, -1):
+            out_frame[out_count] = first_frame + f
+            out_id[out_count] = ids[k]
+            out_bbox[out_count, 0] = x[k, 0] - 10
+            out_bbox[out_count, 1] = x[k, 2] - 10
+            out_bbox[out_count, 2] = x[k, 0] + 10
+            out_bbox[out_count, 3] = x[k, 2] + 10
+            # "Lost" tracks are output as "tracked"
+            out_status[out_count] = 1 if status[k] == 2 else status[k]
+            out_hit[out_count] = hit[k]
+            out_det[out_count] = last_det_ind[k] if last_det_frame[k] == frame_count else -1
+            out_count += 1
+
+        keep = np.empty(count, np.bool_)
+        all_kept = True
+        for k in range(count):
+            keep[k] = tsu[k] <= max_age
+            all_kept = all_kept and keep[k]
+        if not all_kept:
+            count = _compact(keep, count, x, P, ids, tsu, hit, status, last_det_ind, last_det_frame)
+
+    state[0] = count
+    return n_frames, out_count
+
+class SortCore:
+    """
+    Numba compiled SORT tracker. Runs the same steps as Sort.update, and gives the same tracks up to
+    floating point rounding, but processes a block of frames per call. All the track state is kept in
+    preallocated arrays, which grow when needed, so a file can be tracked in consecutive blocks.
+    Track ids are allocated from KalmanBoxTracker.count.
+    """
+    def __init__(self, max_age=1, min_hits=3, search_radius=10, capacity=64):
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.search_radius = search_radius
+
+        # Number of tracks, frame counter, latest allocated id
+        self.state = np.zeros(3, dtype=np.int64)
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        """
+        Allocates the track arrays with the given capacity, keeping the current tracks.
+        """
+        count = self.state[0]
+        arrays = { "x": ((4,), np.float64), "P": ((4, 4), np.float64), "ids": ((), np.int64),
+                   "time_since_update": ((), np.int64), "hit_streak": ((), np.int64), "status": ((), np.int8),
+                   "last_det_ind": ((), np.int64), "last_det_frame": ((), np.int64) }
+        for name, (shape, dtype) in arrays.items():
+            new = np.zeros((capacity,) + shape, dtype=dtype)
+            if count > 0:
+                new[:count] = getattr(self, name)[:count]
+            setattr(self, name, new)
+
+    def __len__(self):
+        return int(self.state[0])
+
+    def trackBlock(self, offsets, centers, first_frame=0):
+        """
+        Tracks a block of frames. The detection centers (see boxCenters) of frame i of the block are
+        centers[offsets[i]:offsets[i+1]] (CSR format). Returns a TrackTable of the tracks of all the frames.
+        Frame numbers start from first_frame and the detection indices are relative to the frame.
+        """
+        offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        centers = np.ascontiguousarray(centers, dtype=np.float64).reshape(-1, 2)
+        n_frames = len(offsets) - 1
+
+        out_capacity = max(1024, 2 * (len(self) + len(centers)))
+        out = TrackTable(np.zeros(out_capacity, np.int32), np.zeros(out_capacity, np.int32), np.zeros((out_capacity, 4)),
+                         np.zeros(out_capacity, np.int8), np.zeros(out_capacity, np.int32), np.zeros(out_capacity, np.int32))
+        out_count = 0
+
+        self.state[2] = KalmanBoxTracker.count
+        frame = 0
+        while frame < n_frames:
+            frame, out_count = _trackFrames(offsets, centers, frame, first_frame, self.max_age, self.min_hits, self.search_radius,
+                                            self.x, self.P, self.ids, self.time_since_update, self.hit_streak, self.status,
+                                            self.last_det_ind, self.last_det_frame, self.state, *out, out_count)
+            if frame == n_frames:
+                break
+
+            # Grow the arrays that might not have room for the next frame.
+            n = offsets[frame + 1] - offsets[frame]
+            count = len(self)
+            if count + n > len(self.x):
+                self.allocate(2 * (count + n))
+            if out_count + count + n > len(out.frame):
+                capacity = 2 * (out_count + count + n)
+                out = TrackTable(*[np.concatenate((column, np.zeros((capacity - len(column),) + column.shape[1:], column.dtype)))
+                                   for column in out])
+
+        KalmanBoxTracker.count = int(self.state[2])
+        return TrackTable(*[column[:out_count] for column in out])
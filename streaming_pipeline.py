@@ -0,0 +1,311 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import threading
+import queue
+import traceback
+
+from log_object import LogObject
+from detection_store import DetectionStore
+from track_store import TrackStore
+from tracker_parameters import TrackerParameters
+from sort import KalmanBoxTracker
+from detector import DETECTIONS_FILE_HEADER, writeFrameDetections
+
+# Maximum number of frames waiting between two stages.
+STREAM_QUEUE_SIZE = 8
+
+# Number of detected frames tracked at a time. The detections of a block are moved
+# to the column arrays of the DetectionStore before the block is tracked.
+STREAM_BLOCK_SIZE = 200
+
+# Marks the end of the stream in a queue.
+_END = None
+
+class StreamingPipeline:
+    """
+    Streaming mode for detecting and tracking all frames of a file (an alternative to
+    Detector.computeAll followed by Tracker.primaryTrack). Frames flow through the stages
+    read -> remap -> subtract -> cluster -> track. Each stage runs in its own thread and the
+    stages are connected with bounded queues, so tracking runs while the following frames are
+    being detected and only a few frames per stage are in memory at once.
+
+    Each stage processes the frames in order, so the results equal the sequential run.
+    If detections_path is given, detections of the frames outside the tracker's max_age window
+    are written to the file while the stream runs (see Detector.saveDetectionsToFile). If release_detections
+    is also set, the written detections are released from memory. Only the detections associated with tracks
+    are kept (in the TrackStore), so the released frames cannot be used e.g. in secondary tracking.
+    """
+    def __init__(self, detector, tracker, detections_path=None, queue_size=STREAM_QUEUE_SIZE, release_detections=False):
+        self.detector = detector
+        self.tracker = tracker
+        self.image_provider = detector.image_provider
+        self.detections_path = detections_path
+        self.queue_size = queue_size
+        self.release_detections = release_detections and detections_path is not None
+        self.stopped = False
+
+        # Frames are read in polar coordinates and remapped in a separate stage if possible.
+        self.remap_polar = hasattr(self.image_provider, "getPolarFrame") and hasattr(self.image_provider, "remapPolarFrame")
+
+        self.candidates = None
+        self.detections_file = None
+        self.flushed = 0
+
+    def stop(self):
+        self.stopped = True
+
+    def isStopped(self):
+        return self.stopped or self.detector.stop_computing or self.tracker.stop_tracking
+
+    def run(self):
+        """
+        Detects and tracks all frames. Signals the results like computeAll and primaryTrack.
+        Returns False if the process was stopped.
+        """
+        detector = self.detector
+        tracker = self.tracker
+
+        tracker.beginPrimaryTrack()
+        tracker.stop_tracking = False
+        if not detector.beginComputeAll():
+            LogObject().print("Stopped before tracking.")
+            tracker.abortComputing(True)
+            return False
+
+        count = self.image_provider.getFrameCount()
+        detector.detections = DetectionStore(count)
+        self.candidates = detector.resetClusters(count)
+        LogObject().print1(tracker.parameters)
+        LogObject().print1(f"Streaming {count} frames.")
+
+        queues = [queue.Queue(self.queue_size) for _ in range(4)]
+        stages = [("read", None, queues[0]),
+                  ("remap", queues[0], queues[1]),
+                  ("subtract", queues[1], queues[2]),
+                  ("cluster", queues[2], queues[3])]
+        threads = [threading.Thread(target=self.runStage, args=stage, daemon=True) for stage in stages]
+
+        detector.bg_subtractor.beginRolling()
+        for thread in threads:
+            thread.start()
+
+        try:
+            if self.detections_path is not None:
+                self.detections_file = open(self.detections_path, "w")
+                self.detections_file.write(DETECTIONS_FILE_HEADER)
+            track_store, received = self.trackStream(queues[-1], count)
+        except Exception:
+            LogObject().print(f"Streaming stopped due to an error:\n{traceback.format_exc()}")
+            track_store, received = None, 0
+        finally:
+            # Stops the other stages if tracking ended early.
+            if received < count:
+                self.stopped = True
+            for thread in threads:
+                thread.join()
+            if self.detections_file is not None:
+                self.detections_file.close()
+                self.detections_file = None
+
+        if received < count:
+            LogObject().print("Stopped streaming at", received)
+            if detector.bg_subtractor.rolling_active:
+                # Masks of a partial rolling run depend on the frames processed before them.
+                detector.mask_cache.clear()
+                detector.filtered_mask_cache.clear()
+            detector.bg_subtractor.endRolling()
+            detector.abortComputing(False)
+            tracker.abortComputing(True)
+            return False
+
+        detector.bg_subtractor.endRolling()
+        detector.finishComputeAll()
+        if self.detections_path is not None:
+            LogObject().print("Detections saved to path:", self.detections_path)
+
+        tracker.applied_detections = detector.detections
+        tracker.track_store = track_store
+        tracker.primary_track_store = track_store
+        tracker.finishPrimaryTrack()
+        return True
+
+    def runStage(self, name, source, target):
+        """
+        Runs a stage in its own thread: reads frames from the source queue (or the file if source is None),
+        processes them with the method of the same name and passes the results to the target queue.
+        """
+        process = getattr(self, name)
+        try:
+            items = self.readFrames() if source is None else self.iterQueue(source)
+            for item in items:
+                if not self.put(target, process(*item)):
+                    return
+        except Exception:
+            LogObject().print(f"Streaming stage '{name}' failed:\n{traceback.format_exc()}")
+            self.stopped = True
+        finally:
+            self.put(target, _END)
+
+    def put(self, target, item):
+        """
+        Puts an item to a bounded queue, waiting for free space. Returns False if stopped while waiting.
+        """
+        while True:
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if self.isStopped():
+                    return False
+
+    def iterQueue(self, source):
+        """
+        Yields the items of a queue until the end of the stream or until stopped.
+        """
+        while True:
+            try:
+                item = source.get(timeout=0.1)
+            except queue.Empty:
+                if self.isStopped():
+                    return
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def readFrames(self):
+        """
+        Read stage. Yields (index, skipped, frame) for each frame. Frames skipped by the activity prefilter
+        and frames whose foreground mask is cached are not read.
+        """
+        for ind in range(self.image_provider.getFrameCount()):
+            if self.candidates is not None and not self.candidates[ind]:
+                yield ind, True, None
+            elif self.detector.isMaskCached(ind):
+                yield ind, False, None
+            elif self.remap_polar:
+                yield ind, False, self.image_provider.getPolarFrame(ind)
+            else:
+                yield ind, False, self.image_provider.getFrame(ind)
+
+    def remap(self, ind, skipped, frame):
+        if frame is not None and self.remap_polar:
+            frame = self.image_provider.remapPolarFrame(frame)
+        return ind, skipped, frame
+
+    def subtract(self, ind, skipped, image):
+        """
+        Background subtraction stage. Frames are processed in order, which rolling background updates require.
+        """
+        if skipped:
+            return ind, True, None, None
+
+        fg_mask_filt = self.detector.getCachedFilteredMask(ind)
+        fg_mask_mog = None
+        if fg_mask_filt is None:
+            fg_mask_mog = self.detector.getForegroundMask(ind, image)
+        return ind, False, fg_mask_mog, fg_mask_filt
+
+    def cluster(self, ind, skipped, fg_mask_mog, fg_mask_filt):
+        """
+        Median filter, clustering and detection geometry stage. Returns (index, detections).
+        Detections are None if the frame could not be detected.
+        """
+        if skipped:
+            return ind, []
+        if fg_mask_mog is None and fg_mask_filt is None:
+            return ind, None
+
+        detections, _ = self.detector.detectFromForeground(ind, fg_mask_mog, fg_mask_filt)
+        return ind, detections
+
+    def trackStream(self, source, count):
+        """
+        Track stage, run in the calling thread. Stores the detections of each frame and tracks them
+        in blocks of STREAM_BLOCK_SIZE frames. Returns the tracks and the number of frames received.
+        """
+        detector = self.detector
+        tracker = self.tracker
+        max_age = tracker.parameters.getParameter(TrackerParameters.ParametersEnum.max_age)
+        mot_tracker = tracker.createMotTracker(tracker.parameters)
+        KalmanBoxTracker.count = 0
+        region = detector.getRegion()
+
+        track_store = TrackStore()
+        block = []
+        received = 0
+        ten_perc = 0.1 * count
+        print_limit = 0
+
+        for ind, detections in self.iterQueue(source):
+            if detections is not None:
+                detector.detections[ind] = detections
+            block.append(ind)
+            received += 1
+
+            if len(block) >= STREAM_BLOCK_SIZE or received == count:
+                self.trackBlock(mot_tracker, track_store, block, region)
+                self.flushDetections(track_store, block[-1] - max_age)
+                block = []
+
+            if ind > print_limit:
+                LogObject().print("Streaming:", int(float(ind) / count * 100), "%")
+                print_limit += ten_perc
+
+        if received == count:
+            self.flushDetections(track_store, count)
+            LogObject().print("Tracking: 100 %")
+            LogObject().print2("Tracking time by phase: " + ", ".join(f"{phase} {t:.2f} s" for phase, t in mot_tracker.get_timings().items()))
+        return track_store, received
+
+    def trackBlock(self, mot_tracker, track_store, frames, region):
+        """
+        Moves the detections of the given frames to the column arrays and tracks them.
+        """
+        store = self.detector.detections
+        store.compact()
+        for ind in frames:
+            tracks, detections = self.tracker.trackFrame(mot_tracker, store, ind, region)
+            track_store.append(ind, tracks, detections)
+
+    def flushDetections(self, track_store, end):
+        """
+        Writes the detections of the frames before end to the detections file, and releases them
+        from memory if release_detections is set. Tracks can no longer be associated with detections
+        older than the tracker's max_age window.
+        """
+        if self.detections_file is None or end <= self.flushed:
+            return
+        for ind in range(self.flushed, end):
+            dets = self.detector.detections[ind]
+            if dets is not None:
+                writeFrameDetections(self.detections_file, ind, dets)
+
+        if self.release_detections:
+            # Tracks keep copies of their own detections, which do not refer to the released columns.
+            for ind in range(self.flushed, end):
+                dets = track_store.detections.get(ind)
+                if dets is None:
+                    continue
+                used = set(int(track_store.det_ind[row]) for row in track_store.frameRows(ind))
+                track_store.detections[ind] = [d.toDetection() if i in used else None for i, d in enumerate(dets)]
+            self.detector.detections.release(end)
+        self.flushed = end
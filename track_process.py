@@ -30,6 +30,7 @@ from detector import Detector, DetectorParameters
 from tracker import Tracker, AllTrackerParameters, TrackerParameters, FilterParameters, TrackingState
 from fish_manager import FishManager
 from save_manager import SaveManager
+from streaming_pipeline import StreamingPipeline
 from output_widget import WriteStream, StreamReceiver
 import file_handler as fh
 from log_object import LogObject
@@ -88,6 +89,9 @@ class TrackProcessInfo:
         # Save results as a binary file
         as_binary: bool = True
 
+        # Detect and track in a streaming pipeline (see StreamingPipeline)
+        streaming: bool = False
+
 class TrackProcess(QtCore.QObject):
     """
     TrackProcess launches individual PlaybackManager, Detector and Tracker,
@@ -117,6 +121,7 @@ class TrackProcess(QtCore.QObject):
         self.save_tracks = info.save_tracks
         self.save_complete = info.save_complete
         self.binary = info.as_binary
+        self.streaming = info.streaming
 
         if info.display:
             self.main_window = QtWidgets.QMainWindow()
@@ -181,8 +186,15 @@ class TrackProcess(QtCore.QObject):
         when the playback_manager is ready to feed frames.
         """
         self.detector.initMOG()
-        self.detector.computeAll()
-        self.tracker.primaryTrack()
+        if self.streaming:
+            # Detections are exported while streaming. Exported detections are released from memory
+            # unless they are needed later (secondary tracking, complete save file or display).
+            det_path = self.getSaveFilePath("_dets.txt") if self.save_detections else None
+            release = not (self.secondary_tracking or self.save_complete or self.display)
+            StreamingPipeline(self.detector, self.tracker, det_path, release_detections=release).run()
+        else:
+            self.detector.computeAll()
+            self.tracker.primaryTrack()
 
         if self.secondary_tracking:
             self.secondary_tracking_started = True
@@ -249,7 +261,7 @@ class TrackProcess(QtCore.QObject):
         Saves and/or exports results to the directory provided earlier.
         """
         file_name = os.path.splitext(self.file)[0]
-        if self.save_detections:
+        if self.save_detections and not self.streaming:
             det_path = self.getSaveFilePath("_dets.txt")
             self.detector.saveDetectionsToFile(det_path)
 
@@ -0,0 +1,160 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+
+class TrackStore:
+    """
+    Growable columnar storage of tracking results. Each row is the state of a track in a frame:
+    frame, track id, bounding box [min_y, min_x, max_y, max_x], status, hit streak and the index of
+    the associated detection in the frame (-1 if the track was not updated in the frame).
+    Rows are appended frame by frame, so the frame column is sorted.
+
+    The detections passed to the tracker are kept by frame, so that the associated Detection
+    of a row can be returned.
+    """
+    def __init__(self, capacity=1024):
+        self.count = 0
+        self._frame = np.zeros(capacity, dtype=np.int32)
+        self._id = np.zeros(capacity, dtype=np.int32)
+        self._bbox = np.zeros((capacity, 4), dtype=np.float64)
+        self._status = np.zeros(capacity, dtype=np.int8)
+        self._hit_streak = np.zeros(capacity, dtype=np.int32)
+        self._det_ind = np.zeros(capacity, dtype=np.int32)
+
+        # Detections used in tracking: frame index -> list of detections
+        self.detections = {}
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def frame(self):
+        return self._frame[:self.count]
+
+    @property
+    def id(self):
+        return self._id[:self.count]
+
+    @property
+    def bbox(self):
+        return self._bbox[:self.count]
+
+    @property
+    def status(self):
+        return self._status[:self.count]
+
+    @property
+    def hit_streak(self):
+        return self._hit_streak[:self.count]
+
+    @property
+    def det_ind(self):
+        return self._det_ind[:self.count]
+
+    def reserve(self, count):
+        """
+        Grows the arrays (by doubling) so that count more rows fit.
+        """
+        capacity = len(self._frame)
+        if self.count + count <= capacity:
+            return
+        while capacity < self.count + count:
+            capacity *= 2
+        for name in ("_frame", "_id", "_bbox", "_status", "_hit_streak", "_det_ind"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def append(self, frame, tracks, detections=None):
+        """
+        Appends the output of Sort.update for a frame (N x 9: bbox, id, status, hit streak,
+        detection index, search radius) and the detections that were passed to the tracker.
+        """
+        if detections is not None and len(detections) > 0:
+            self.detections[frame] = detections
+        n = len(tracks)
+        if n == 0:
+            return
+        self.reserve(n)
+        rows = slice(self.count, self.count + n)
+        self._frame[rows] = frame
+        self._bbox[rows] = tracks[:, 0:4]
+        self._id[rows] = tracks[:, 4]
+        self._status[rows] = tracks[:, 5]
+        self._hit_streak[rows] = tracks[:, 6]
+        self._det_ind[rows] = tracks[:, 7]
+        self.count += n
+
+    def appendTable(self, table):
+        """
+        Appends the rows of a sort_core.TrackTable (tracks of several frames, in frame order).
+        The detections of the frames are set separately in self.detections.
+        """
+        n = len(table.frame)
+        if n == 0:
+            return
+        self.reserve(n)
+        rows = slice(self.count, self.count + n)
+        self._frame[rows] = table.frame
+        self._id[rows] = table.id
+        self._bbox[rows] = table.bbox
+        self._status[rows] = table.status
+        self._hit_streak[rows] = table.hit_streak
+        self._det_ind[rows] = table.det_ind
+        self.count += n
+
+    def getDetection(self, row):
+        """
+        Returns the detection associated with the row, or None.
+        """
+        ind = self._det_ind[row]
+        if ind < 0:
+            return None
+        return self.detections[int(self._frame[row])][ind]
+
+    def frameRows(self, frame):
+        """
+        Returns the range of rows of the given frame.
+        """
+        frames = self.frame
+        return range(np.searchsorted(frames, frame, side="left"), np.searchsorted(frames, frame, side="right"))
+
+    def getFrame(self, frame):
+        """
+        Returns the tracks of a frame as a list of (track, detection) tuples. Tracks are in the format of
+        Sort.update without the search radius column.
+        """
+        return [(self.getTrack(row), self.getDetection(row)) for row in self.frameRows(frame)]
+
+    def getTrack(self, row):
+        return np.concatenate((self._bbox[row], [self._id[row], self._status[row], self._hit_streak[row], self._det_ind[row]]))
+
+    def groupById(self):
+        """
+        Yields (track id, rows) for each track, rows sorted by frame.
+        """
+        ids = self.id
+        order = np.lexsort((self.frame, ids))
+        splits = np.nonzero(np.diff(ids[order]))[0] + 1
+        for rows in np.split(order, splits):
+            if len(rows) > 0:
+                yield int(ids[rows[0]]), rows
@@ -17,15 +17,68 @@ You should have received a copy of the GNU General Public License
 along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import time
 import numpy as np
 import cv2
 import seaborn as sns
+import multiprocessing as mp
 from enum import Enum
-from sort import Sort, KalmanBoxTracker
+from sort import KalmanBoxTracker
+from tracking_engine import createTrackingEngine, SORT_ENGINE
+from sort_core import SortCore, boxCenters
 from PyQt5 import QtCore
 from tracker_parameters import TrackerParameters
 from filter_parameters import FilterParameters
 from log_object import LogObject
+from detection_store import DetectionStore, DetectionView
+from track_store import TrackStore
+import file_handler as fh
+from pipeline_stages import Stage, firstChangedStage
+
+# Minimum number of frames in a segment tracked in a worker process.
+MIN_SEGMENT_LENGTH = 500
+
+# Number of frames tracked per call of the compiled SORT core. Tracking can be stopped between the calls.
+CORE_BLOCK_SIZE = 200
+
+def findQuietFrames(detection_counts, max_age):
+    """
+    Returns the frames at which a tracker is known to be empty: frames preceded by at least
+    max_age + 1 frames with no detections, after which all tracks have been removed.
+    Tracking can be restarted at these frames with a new tracker without changing the results.
+    """
+    gap = max(0, max_age) + 1
+    empty = np.concatenate(([0], np.cumsum(np.asarray(detection_counts) == 0)))
+    frames = np.arange(gap, len(detection_counts))
+    return frames[empty[frames] - empty[frames - gap] == gap]
+
+def splitSegments(detection_counts, max_age, segment_count):
+    """
+    Splits the frames into at most segment_count segments of about equal length, cut at quiet frames.
+    Returns a list of (start, end) ranges.
+    """
+    count = len(detection_counts)
+    target = max(MIN_SEGMENT_LENGTH, count // max(1, segment_count))
+    segments = []
+    start = 0
+    for cut in findQuietFrames(detection_counts, max_age):
+        if cut - start >= target and count - cut >= MIN_SEGMENT_LENGTH:
+            segments.append((start, int(cut)))
+            start = int(cut)
+    segments.append((start, count))
+    return segments
+
+def trackSegment(boxes, max_age, min_hits, search_radius, engine):
+    """
+    Tracks a segment of frames with a new tracker in a worker process.
+    boxes: Bounding boxes of the detections in each frame (None if the frame has no detections).
+    Returns (tracks of each frame, number of track ids allocated, time spent in each phase).
+    Track ids are allocated from 1 and are renumbered when the segments are stitched together.
+    """
+    mot_tracker = createTrackingEngine(engine, max_age, min_hits, search_radius)
+    KalmanBoxTracker.count = 0
+    tracks = [mot_tracker.update() if b is None else mot_tracker.update(b) for b in boxes]
+    return tracks, KalmanBoxTracker.count, mot_tracker.get_timings()
 
 class TrackingState(Enum):
     IDLE = 1
@@ -71,7 +124,11 @@ class Tracker(QtCore.QObject):
         self.applied_parameters = None
         self.applied_detector_parameters = None
         self.applied_secondary_parameters = None
-        self.tracks_by_frame = {}
+        self.track_store = TrackStore()
+
+        # Output of the latest primary tracking and the detections it was computed from.
+        self.primary_track_store = TrackStore()
+        self.applied_detections = None
 
     # TODO: Use AllTrackerParameters instead of separate objects.
     def resetParameters(self):
@@ -98,13 +155,11 @@ class Tracker(QtCore.QObject):
 
     def primaryTrack(self):
         """
-        Tracks all detections from detector and stores the results in tracks_by_frame dictionary.
+        Tracks all detections from detector and stores the results in track_store.
         Signals when the computation has finished.
         """
 
-        self.tracking_state = TrackingState.PRIMARY
-        self.state_changed_signal.emit()
-        self.init_signal.emit(True)
+        self.beginPrimaryTrack()
 
         if self.detector.allCalculationAvailable():
             self.detector.computeAll()
@@ -115,9 +170,27 @@ class Tracker(QtCore.QObject):
                 self.abortComputing(True)
                 return
 
-        LogObject().print1(f"Primary tracking. Available detections: {self.detectionCount(self.detector.detections)}")
-        self.tracks_by_frame = self.trackDetections(self.detector.detections, self.parameters, reset_count=True)
+        if self.getRecomputeStage() == Stage.FISH_METRICS:
+            # Only parameters used when creating fish from the tracks have changed.
+            LogObject().print1("Primary tracking. Using previous tracks.")
+            self.track_store = self.primary_track_store
+        else:
+            LogObject().print1(f"Primary tracking. Available detections: {self.detectionCount(self.detector.detections)}")
+            self.applied_detections = self.detector.detections
+            self.track_store = self.trackDetections(self.detector.detections, self.parameters, reset_count=True)
+            self.primary_track_store = self.track_store
+
+        self.finishPrimaryTrack()
 
+    def beginPrimaryTrack(self):
+        self.tracking_state = TrackingState.PRIMARY
+        self.state_changed_signal.emit()
+        self.init_signal.emit(True)
+
+    def finishPrimaryTrack(self):
+        """
+        Marks the primary tracks in track_store computed with the current parameters and signals the results.
+        """
         self.applied_parameters = self.parameters.copy()
         self.applied_detector_parameters = self.detector.parameters.copy()
         self.applied_secondary_parameters = None
@@ -132,7 +205,7 @@ class Tracker(QtCore.QObject):
         tracker parameters. Previous results are replaced with the new results.
         Signals when the computation has finished.
 
-        used_detections: Dictionary: frame_index -> list of detections in that frame.
+        used_detections: Ids of the detections to exclude (see DetectionStore.detectionIds).
         tracker_parameters: TrackerParameters object containing the parameters for tracking. 
         """
 
@@ -140,19 +213,10 @@ class Tracker(QtCore.QObject):
         self.state_changed_signal.emit()
         self.init_signal.emit(False)
 
-        detections = [[] for i in range(len(self.detector.detections))]
-        for frame, dets in enumerate(self.detector.detections):
-            if frame in used_detections:
-                used_dets = used_detections[frame]
-                for det in dets:
-                    if det not in used_dets:
-                        detections[frame].append(det)
-            else:
-                detections[frame] = dets
-
+        detections = self.detector.detections.excluding(used_detections)
 
         LogObject().print1(f"Secondary tracking. Available detections: {self.detectionCount(detections)}")
-        self.tracks_by_frame = self.trackDetections(detections, tracker_parameters, reset_count=False)
+        self.track_store = self.trackDetections(detections, tracker_parameters, reset_count=False)
 
         self.applied_secondary_parameters = self.secondary_parameters.copy()
 
@@ -161,6 +225,8 @@ class Tracker(QtCore.QObject):
         self.all_computed_signal.emit(TrackingState.SECONDARY)
 
     def detectionCount(self, detections):
+        if isinstance(detections, DetectionStore):
+            return detections.detectionCount()
         return 0 if detections is None \
             else np.sum([len(dets) for dets in detections if dets is not None])
         
@@ -168,25 +234,32 @@ class Tracker(QtCore.QObject):
     def trackDetections(self, detection_frames, tracker_parameters: TrackerParameters, reset_count=False):
         """
         Tracks all detections in the given frames.
-        Returns a dictionary containing tracks by frame.
+        Returns a TrackStore containing the tracks of all frames.
         """
 
         LogObject().print1(tracker_parameters)
 
         self.stop_tracking = False
         count = len(detection_frames)
-        returned_tracks_by_frame = {}
-        mot_tracker = Sort(max_age = tracker_parameters.getParameter(TrackerParameters.ParametersEnum.max_age),
-                           min_hits = tracker_parameters.getParameter(TrackerParameters.ParametersEnum.min_hits),
-                           search_radius = tracker_parameters.getParameter(TrackerParameters.ParametersEnum.search_radius))
 
         if reset_count:
             KalmanBoxTracker.count = 0
 
+        processes = fh.getConfValue(fh.ConfKeys.tracking_processes)
+        if processes > 1 and count >= 2 * MIN_SEGMENT_LENGTH:
+            return self.trackDetectionsParallel(detection_frames, tracker_parameters, processes)
+
+        engine = tracker_parameters.getParameter(TrackerParameters.ParametersEnum.engine)
+        if fh.getConfValue(fh.ConfKeys.compiled_tracking) and engine == SORT_ENGINE and isinstance(detection_frames, DetectionStore):
+            return self.trackDetectionsCompiled(detection_frames, tracker_parameters)
+
+        track_store = TrackStore()
+        mot_tracker = self.createMotTracker(tracker_parameters)
         ten_perc = 0.1 * count
         print_limit = 0
+        region = self.detector.getRegion()
 
-        for i, dets in enumerate(detection_frames):
+        for i in range(count):
             if i > print_limit:
                 LogObject().print("Tracking:", int(float(i) / count * 100), "%")
                 print_limit += ten_perc
@@ -194,34 +267,217 @@ class Tracker(QtCore.QObject):
             if self.stop_tracking:
                 LogObject().print("Stopped tracking at", i)
                 self.abortComputing(False)
-                return {}
+                return TrackStore()
 
-            returned_tracks_by_frame[i] = self.trackBase(mot_tracker, dets, i)
+            tracks, detections = self.trackFrame(mot_tracker, detection_frames, i, region)
+            track_store.append(i, tracks, detections)
                 
         LogObject().print("Tracking: 100 %")    
-        return returned_tracks_by_frame
+        LogObject().print2("Tracking time by phase: " + ", ".join(f"{phase} {t:.2f} s" for phase, t in mot_tracker.get_timings().items()))
+        return track_store
+
+    def createMotTracker(self, tracker_parameters: TrackerParameters):
+        """
+        Returns a new tracker of the engine selected in tracker_parameters (see tracking_engine).
+        """
+        return createTrackingEngine(tracker_parameters.getParameter(TrackerParameters.ParametersEnum.engine),
+                                    tracker_parameters.getParameter(TrackerParameters.ParametersEnum.max_age),
+                                    tracker_parameters.getParameter(TrackerParameters.ParametersEnum.min_hits),
+                                    tracker_parameters.getParameter(TrackerParameters.ParametersEnum.search_radius))
+
+    def trackFrame(self, mot_tracker, detection_frames, ind, region=None):
+        """
+        Tracks the detections of frame ind with mot_tracker.
+        Returns the tracks and the detections they refer to.
+        """
+        dets = detection_frames[ind]
 
-    def trackBase(self, mot_tracker, frame, ind):
+        # Bounding boxes are read directly from the columns when available
+        boxes = detection_frames.getBoxes(ind) if isinstance(detection_frames, DetectionStore) and dets is not None else None
+        if region is not None and dets is not None:
+            dets, boxes = self.filterRegion(region, dets, boxes)
+        return self.trackBase(mot_tracker, dets, ind, boxes)
+
+    def trackDetectionsCompiled(self, detection_frames, tracker_parameters: TrackerParameters):
+        """
+        Tracks all detections in the given DetectionStore with the compiled SORT core (see sort_core),
+        a block of frames at a time. Used if enabled in the user preferences (compiled_tracking).
+        The results equal the results of the loop in trackDetections.
+        """
+        timings = { "input": 0.0, "core": 0.0, "output": 0.0 }
+        t = time.perf_counter()
+        count = len(detection_frames)
+        track_store = TrackStore()
+        columns = detection_frames.columns
+
+        # Inputs of all frames in CSR format: frame i uses the rows rows[offsets[i]:offsets[i+1]].
+        offsets, rows = detection_frames.getRows()
+        corners = columns.corners[rows]
+        boxes = np.concatenate((np.min(corners, axis=1), np.max(corners, axis=1)), axis=1)
+        region = self.detector.getRegion()
+        if region is not None:
+            inside = region.contains((boxes[:,0] + boxes[:,2]) / 2, (boxes[:,1] + boxes[:,3]) / 2)
+            frames = np.repeat(np.arange(count), np.diff(offsets))[inside]
+            rows = rows[inside]
+            boxes = boxes[inside]
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(frames, minlength=count)))).astype(np.int64)
+        centers = boxCenters(boxes)
+
+        invalid = count - int(np.count_nonzero(detection_frames.computed))
+        if invalid > 0:
+            LogObject().print("Invalid detector results encountered in", invalid, "frames. Consider rerunning the detector.")
+
+        core = SortCore(tracker_parameters.getParameter(TrackerParameters.ParametersEnum.max_age),
+                        tracker_parameters.getParameter(TrackerParameters.ParametersEnum.min_hits),
+                        tracker_parameters.getParameter(TrackerParameters.ParametersEnum.search_radius))
+        timings["input"] += time.perf_counter() - t
+
+        ten_perc = 0.1 * count
+        print_limit = 0
+        for start in range(0, count, CORE_BLOCK_SIZE):
+            if start > print_limit:
+                LogObject().print("Tracking:", int(float(start) / count * 100), "%")
+                print_limit += ten_perc
+
+            if self.stop_tracking:
+                LogObject().print("Stopped tracking at", start)
+                self.abortComputing(False)
+                return TrackStore()
+
+            t = time.perf_counter()
+            end = min(start + CORE_BLOCK_SIZE, count)
+            block_offsets = offsets[start:end + 1]
+            table = core.trackBlock(block_offsets - block_offsets[0], centers[block_offsets[0]:block_offsets[-1]], start)
+            timings["core"] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            track_store.appendTable(table)
+            # Detections the detection indices of the tracks refer to
+            for ind in range(start, end):
+                if offsets[ind + 1] > offsets[ind]:
+                    track_store.detections[ind] = [DetectionView(columns, r) for r in rows[offsets[ind]:offsets[ind + 1]]]
+            timings["output"] += time.perf_counter() - t
+
+        LogObject().print("Tracking: 100 %")
+        LogObject().print2("Tracking time by phase: " + ", ".join(f"{phase} {t:.2f} s" for phase, t in timings.items()))
+        return track_store
+
+    def trackDetectionsParallel(self, detection_frames, tracker_parameters: TrackerParameters, processes):
+        """
+        Tracks all detections in the given frames in worker processes. The frames are split into
+        segments at quiet frames (see findQuietFrames), so that each segment starts with an empty tracker
+        and can be tracked independently. Track ids are renumbered in segment order, so that the results
+        equal the results of the sequential loop in trackDetections.
+        """
+        count = len(detection_frames)
+        track_store = TrackStore()
+        region = self.detector.getRegion()
+        max_age = tracker_parameters.getParameter(TrackerParameters.ParametersEnum.max_age)
+        params = (max_age,
+                  tracker_parameters.getParameter(TrackerParameters.ParametersEnum.min_hits),
+                  tracker_parameters.getParameter(TrackerParameters.ParametersEnum.search_radius),
+                  tracker_parameters.getParameter(TrackerParameters.ParametersEnum.engine))
+
+        # Inputs of all frames: the detections and their bounding boxes.
+        frame_detections = []
+        frame_boxes = []
+        for i, dets in enumerate(detection_frames):
+            boxes = detection_frames.getBoxes(i) if isinstance(detection_frames, DetectionStore) and dets is not None else None
+            if region is not None and dets is not None:
+                dets, boxes = self.filterRegion(region, dets, boxes)
+            detections, boxes = self.frameInput(dets, i, boxes)
+            frame_detections.append(detections)
+            frame_boxes.append(boxes)
+
+        counts = np.array([0 if b is None else len(b) for b in frame_boxes])
+        segments = splitSegments(counts, max_age, 4 * processes)
+        LogObject().print1(f"Tracking {len(segments)} segments in {processes} processes.")
+
+        id_offset = KalmanBoxTracker.count
+        timings = {}
+        pool = mp.get_context("spawn").Pool(processes)
+        try:
+            results = [(start, end, pool.apply_async(trackSegment, (frame_boxes[start:end],) + params)) for start, end in segments]
+            pool.close()
+
+            for start, end, result in results:
+                while not result.ready():
+                    if self.stop_tracking:
+                        LogObject().print("Stopped tracking at", start)
+                        pool.terminate()
+                        self.abortComputing(False)
+                        return TrackStore()
+                    result.wait(0.1)
+
+                segment_tracks, id_count, segment_timings = result.get()
+                for i, tracks in zip(range(start, end), segment_tracks):
+                    if len(tracks) > 0:
+                        tracks[:, 4] += id_offset
+                    track_store.append(i, tracks, frame_detections[i])
+                id_offset += id_count
+                for phase, t in segment_timings.items():
+                    timings[phase] = timings.get(phase, 0.0) + t
+
+                LogObject().print("Tracking:", int(float(end) / count * 100), "%")
+        finally:
+            pool.terminate()
+            pool.join()
+
+        KalmanBoxTracker.count = id_offset
+        LogObject().print2("Tracking time by phase (all processes): " + ", ".join(f"{phase} {t:.2f} s" for phase, t in timings.items()))
+        return track_store
+
+    def filterRegion(self, region, dets, boxes=None):
+        """
+        Removes the detections whose center is outside the region of interest (CompiledRegion),
+        e.g. detections loaded from a file or computed before the region was set.
+        Returns the remaining detections and their boxes.
+        """
+        if boxes is not None:
+            inside = region.contains((boxes[:,0] + boxes[:,2]) / 2, (boxes[:,1] + boxes[:,3]) / 2)
+            return [d for d, keep in zip(dets, inside) if keep], boxes[inside]
+
+        dets = [d for d in dets if d.center is None or region.contains(d.center[0], d.center[1])]
+        return dets, None
+
+    def trackBase(self, mot_tracker, frame, ind, boxes=None):
         """
         Performs tracking step for a single frame.
-        Returns (track, detection) if the track was updated this frame, otherwise (track, None).
+        Returns the tracks (output of Sort.update) and the detections the detection indices of the tracks refer to.
+        boxes: Optional precomputed bounding boxes of the detections in frame.
+        """
+        detections, dets = self.frameInput(frame, ind, boxes)
+        if dets is not None:
+            tracks = mot_tracker.update(dets)
+        else:
+            tracks = mot_tracker.update()
+
+        return tracks, detections
+
+    def frameInput(self, frame, ind, boxes=None):
+        """
+        Returns the detections of a frame used in tracking and their bounding boxes,
+        or None as the boxes if there are no detections to track.
         """
         if frame is None:
             LogObject().print("Invalid detector results encountered at frame " + str(ind) +". Consider rerunning the detector.")
-            return mot_tracker.update()
+            return None, None
 
-        detections = [d for d in frame if d.corners is not None]
-        if len(detections) > 0:
-            dets = np.array([np.min(d.corners,0).flatten().tolist() + np.max(d.corners,0).flatten().tolist() for d in detections])
-            tracks = mot_tracker.update(dets)
+        if boxes is not None:
+            detections = frame
+            dets = boxes
         else:
-            tracks = mot_tracker.update()
+            detections = [d for d in frame if d.corners is not None]
+            dets = np.array([np.min(d.corners,0).flatten().tolist() + np.max(d.corners,0).flatten().tolist() for d in detections])
 
-        return [(tr, detections[int(tr[7])]) if tr[7] >= 0 else (tr, None) for tr in tracks]
+        if len(detections) == 0:
+            return detections, None
+        return detections, dets
 
     def abortComputing(self, detector_aborted):
         self.tracking_state = TrackingState.IDLE
         self.applied_parameters = None
+        self.applied_detections = None
         self.stop_tracking = False
         if detector_aborted:
             self.applied_detector_parameters = None
@@ -229,16 +485,17 @@ class Tracker(QtCore.QObject):
 
     def visualize(self, image, ind):
         """
-        Visualizes the tracked fish in the frame [ind] of tracks_by_frame.
+        Visualizes the tracked fish in the frame [ind] of track_store.
         Note: This is not used in the main application anymore and similar methods can
         be found in the sonar_widget.py file.
         """
 
-        if ind not in self.tracks_by_frame:
+        tracks = self.track_store.getFrame(ind)
+        if len(tracks) == 0:
             return image
         
-        colors = sns.color_palette('deep', len(self.tracks_by_frame[ind]))
-        for tr, det in self.tracks_by_frame[ind]:
+        colors = sns.color_palette('deep', len(tracks))
+        for tr, det in tracks:
 
             if self._show_id:
                 center = [(tr[0] + tr[2]) / 2, (tr[1] + tr[3]) / 2]
@@ -257,6 +514,15 @@ class Tracker(QtCore.QObject):
 
         return image
 
+    def getRecomputeStage(self):
+        """
+        Returns the earliest stage of primary tracking (tracking or fish metrics) that has
+        to be recomputed, or None if the previous results are up to date.
+        """
+        if self.applied_detections is None or self.applied_detections is not self.detector.detections:
+            return Stage.TRACKING
+        return firstChangedStage(self.applied_parameters, self.parameters)
+
     def parametersDirty(self):
         return self.parameters != self.applied_parameters or self.applied_detector_parameters != self.detector.parameters \
             or self.applied_detector_parameters != self.detector.applied_parameters
@@ -349,6 +615,9 @@ if __name__ == "__main__":
                 self.allCalculationAvailable = lambda: False
                 self.parameters = DetectorParameters()
 
+            def getRegion(self):
+                return None
+
         class DetectionTest:
             def __init__(self):
                 self.center = center = np.random.uniform(5, 95, (1,2))
@@ -365,7 +634,7 @@ if __name__ == "__main__":
         detector = DetectorTest()
         tracker = Tracker(detector)
         detection_frames = [[DetectionTest() for j in range(int(np.random.uniform(0,5)))] for i in range(50)]
-        tracker.trackDetections(detection_frames)
+        tracker.trackDetections(detection_frames, tracker.parameters)
 
     def playbackTest(secondary):
         """
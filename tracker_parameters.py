@@ -28,12 +28,14 @@ class TrackerParameters(ParametersBase):
         min_hits: int = 5
         search_radius: int = 10
         trim_tails: bool = True
+        engine: str = "sort"
 
     class ParametersEnum(Enum):
         max_age = auto()
         min_hits = auto()
         search_radius = auto()
         trim_tails = auto()
+        engine = auto()
 
     def __init__(self, *args, **kwargs):
         """
@@ -42,5 +44,6 @@ class TrackerParameters(ParametersBase):
         min_hits: int = 5
         search_radius: int = 10
         trim_tails: bool = True
+        engine: str = "sort" ("sort" or "gnn", see tracking_engine)
         """
         super().__init__(self.Parameters(*args, **kwargs))
@@ -31,10 +31,14 @@ from filter_parameters import FilterParameters
 from log_object import LogObject
 from tracker import Tracker, TrackingState
 from tracker_parameters import TrackerParameters
+from tracking_engine import TRACKING_ENGINES
 
 PARAMETERS_PATH = getFilePathInAppData("tracker_parameters.json")
 parameters_lock = QReadWriteLock()
 
+ENGINE_TOOLTIP = ("sort: SORT tracker with a Kalman filter per track\n"
+                  "gnn: Global nearest neighbour tracker with tentative, active and lost track states")
+
 class TrackerParametersView(QScrollArea):
     def __init__(self, playback_manager, tracker, detector, fish_manager=None, debug=False):
         super().__init__()
@@ -142,6 +146,14 @@ class TrackerParametersView(QScrollArea):
         self.trim_tails_checkbox_p.stateChanged.connect(lambda_trim_tails_p)
         self.form_layout_p.addRow("Trim tails", self.trim_tails_checkbox_p)
 
+        self.engine_combobox_p = QComboBox(self)
+        self.engine_combobox_p.addItems(TRACKING_ENGINES)
+        self.engine_combobox_p.setCurrentText(self.tracker.parameters.getParameter(TrackerParameters.ParametersEnum.engine))
+        self.engine_combobox_p.setToolTip(ENGINE_TOOLTIP)
+        lambda_engine_p = lambda x: self.tracker.setPrimaryParameter(TrackerParameters.ParametersEnum.engine, x)
+        self.engine_combobox_p.currentTextChanged.connect(lambda_engine_p)
+        self.form_layout_p.addRow("Engine", self.engine_combobox_p)
+
         self.collapsible_p = CollapsibleBox("Primary tracking", self)
         self.collapsible_p.setContentLayout(self.form_layout_p)
         self.vertical_layout.addWidget(self.collapsible_p)
@@ -203,6 +215,14 @@ class TrackerParametersView(QScrollArea):
         self.trim_tails_checkbox_s.stateChanged.connect(lambda_trim_tails_s)
         self.form_layout_s.addRow("Trim tails", self.trim_tails_checkbox_s)
 
+        self.engine_combobox_s = QComboBox(self)
+        self.engine_combobox_s.addItems(TRACKING_ENGINES)
+        self.engine_combobox_s.setCurrentText(self.tracker.secondary_parameters.getParameter(TrackerParameters.ParametersEnum.engine))
+        self.engine_combobox_s.setToolTip(ENGINE_TOOLTIP)
+        lambda_engine_s = lambda x: self.tracker.setSecondaryParameter(TrackerParameters.ParametersEnum.engine, x)
+        self.engine_combobox_s.currentTextChanged.connect(lambda_engine_s)
+        self.form_layout_s.addRow("Engine", self.engine_combobox_s)
+
         self.collapsible_s = CollapsibleBox("Secondary tracking", self)
         self.collapsible_s.setContentLayout(self.form_layout_s)
         self.vertical_layout.addWidget(self.collapsible_s)
@@ -312,6 +332,7 @@ class TrackerParametersView(QScrollArea):
         self.min_hits_slider_p.setValue(primary_data.min_hits)
         self.search_radius_slider_p.setValue(primary_data.search_radius)
         self.trim_tails_checkbox_p.setChecked(primary_data.trim_tails)
+        self.engine_combobox_p.setCurrentText(primary_data.engine)
 
         self.min_detections_slider.setValue(filter_data.min_duration)
         self.mad_slider.setValue(filter_data.mad_limit)
@@ -320,6 +341,7 @@ class TrackerParametersView(QScrollArea):
         self.min_hits_slider_s.setValue(secondary_data.min_hits)
         self.search_radius_slider_s.setValue(secondary_data.search_radius)
         self.trim_tails_checkbox_s.setChecked(secondary_data.trim_tails)
+        self.engine_combobox_s.setCurrentText(secondary_data.engine)
 
     def printValues(self):
         primary_data = self.tracker.parameters.data
@@ -329,7 +351,8 @@ class TrackerParametersView(QScrollArea):
         print(f"P Max Age: {primary_data.max_age}")
         print(f"P Min Hits: {primary_data.min_hits}")
         print(f"P Search Radius: {primary_data.search_radius}")
-        print(f"P Trim tails: {primary_data.trim_tails}\n")
+        print(f"P Trim tails: {primary_data.trim_tails}")
+        print(f"P Engine: {primary_data.engine}\n")
 
         print(f"F Min Duration: {filter_data.min_duration}")
         print(f"F MAD Limit: {filter_data.mad_limit}\n")
@@ -337,7 +360,8 @@ class TrackerParametersView(QScrollArea):
         print(f"S Max Age: {secondary_data.max_age}")
         print(f"S Min Hits: {secondary_data.min_hits}")
         print(f"S Search Radius: {secondary_data.search_radius}")
-        print(f"S Trim tails: {secondary_data.trim_tails}\n")
+        print(f"S Trim tails: {secondary_data.trim_tails}")
+        print(f"S Engine: {secondary_data.engine}\n")
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,176 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import json
+import time
+import argparse
+import tracemalloc
+
+from log_object import LogObject
+from tracker_parameters import TrackerParameters
+from detector import readDetectionLines
+from detection_store import DetectionStore
+from sort import KalmanBoxTracker
+from tracking_engine import TRACKING_ENGINES, createTrackingEngine
+
+# Tracking benchmark runs the tracking engines (see tracking_engine) on the same detection sets, and reports
+# the speed (frames per second), the peak memory allocated while tracking and the agreement of the tracks
+# with the tracks of the first engine.
+#
+# Detection sets are detection files exported from Fish Tracker (see Detector.saveDetectionsToFile).
+# Agreement is the F1 score of the track links: pairs of detections that are consecutive in the same track.
+# Links do not depend on the track ids, so engines that number their tracks differently can be compared.
+
+def loadDetectionSet(path):
+    """
+    Reads a detections file into a DetectionStore.
+    """
+    with open(path, "r") as file:
+        file.readline()
+        frames, _ = readDetectionLines(file)
+    return DetectionStore.fromFrames(frames)
+
+def trackStore(store, engine, tracker_parameters, links=None):
+    """
+    Tracks all the frames in store with the given engine. Returns the time spent in the tracker (seconds).
+    If links is given (set), the track links are added to it.
+    """
+    mot_tracker = createTrackingEngine(engine,
+                                       tracker_parameters.getParameter(TrackerParameters.ParametersEnum.max_age),
+                                       tracker_parameters.getParameter(TrackerParameters.ParametersEnum.min_hits),
+                                       tracker_parameters.getParameter(TrackerParameters.ParametersEnum.search_radius))
+    KalmanBoxTracker.count = 0
+
+    # Track id -> (frame, detection index) of the latest detection of the track
+    latest = {}
+    total = 0.0
+    for ind in range(len(store)):
+        dets = store[ind]
+        t = time.perf_counter()
+        if dets is None or len(dets) == 0:
+            tracks = mot_tracker.update()
+        else:
+            tracks = mot_tracker.update(store.getBoxes(ind))
+        total += time.perf_counter() - t
+
+        if links is None:
+            continue
+        for tr in tracks:
+            if tr[7] < 0:
+                continue
+            det = (ind, int(tr[7]))
+            previous = latest.get(int(tr[4]))
+            if previous is not None:
+                links.add((previous, det))
+            latest[int(tr[4])] = det
+
+    return total
+
+def runEngine(store, engine, tracker_parameters):
+    """
+    Runs an engine on a detection set. Returns a result dictionary. Memory is measured in a separate run,
+    since tracing the allocations slows down tracking.
+    """
+    links = set()
+    total = trackStore(store, engine, tracker_parameters, links)
+
+    tracemalloc.start()
+    trackStore(store, engine, tracker_parameters)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tracks = len(set(a for a, b in links) | set(b for a, b in links))
+    return { "engine": engine, "frames": len(store), "time": total, "peak": peak, "links": links,
+             "detections_in_tracks": tracks }
+
+def linkAgreement(reference, links):
+    """
+    Returns the F1 score of the track links compared to the reference links.
+    """
+    total = len(reference) + len(links)
+    if total == 0:
+        return 1.0
+    return 2 * len(reference & links) / total
+
+def runBenchmark(files, engines, tracker_parameters):
+    """
+    Runs all the engines on all the files. Returns a list of result dictionaries.
+    Agreement is computed against the first engine.
+    """
+    results = []
+    for file in files:
+        store = loadDetectionSet(file)
+        LogObject().print(f"Tracking benchmark: {file}, {len(store)} frames, {store.detectionCount()} detections.")
+
+        file_results = []
+        for engine in engines:
+            r = runEngine(store, engine, tracker_parameters)
+            r["file"] = file
+            file_results.append(r)
+
+        reference = file_results[0]["links"]
+        for r in file_results:
+            r["agreement"] = linkAgreement(reference, r["links"])
+        results.extend(file_results)
+
+    return results
+
+def formatTable(results, separator=";"):
+    """
+    Returns the results as lines of text.
+    """
+    header = ["file", "engine", "frames", "linked detections", "fps", "peak memory (MB)", "agreement"]
+    lines = [separator.join(header)]
+    for r in results:
+        fps = r["frames"] / r["time"] if r["time"] > 0 else float("inf")
+        row = [os.path.basename(r["file"]), r["engine"], str(r["frames"]), str(r["detections_in_tracks"]),
+               "{:.1f}".format(fps), "{:.2f}".format(r["peak"] / (1024 * 1024)), "{:.3f}".format(r["agreement"])]
+        lines.append(separator.join(row))
+    return lines
+
+def getParser():
+    parser = argparse.ArgumentParser(description="Compares the tracking engines on the same detections.")
+    parser.add_argument('-f', '--file', type=str, nargs='+', required=True, help="detection file(s) exported from Fish Tracker")
+    parser.add_argument('-e', '--engine', type=str, nargs='+', default=list(TRACKING_ENGINES), choices=TRACKING_ENGINES,
+                        help="engines to compare, the first one is the reference for agreement")
+    parser.add_argument('-t', '--tracker', type=str, default=None, help="JSON file containing tracker parameters")
+    parser.add_argument('-o', '--output', type=str, default=None, help="file where the result table is written (csv)")
+    return parser
+
+def main():
+    args = getParser().parse_args()
+    tracker_parameters = TrackerParameters()
+    if args.tracker is not None:
+        with open(args.tracker, "r") as f:
+            tracker_parameters.setParameterDict(json.load(f))
+
+    results = runBenchmark(args.file, args.engine, tracker_parameters)
+    lines = formatTable(results)
+    for line in lines:
+        LogObject().print(line)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        LogObject().print("Results saved to path:", args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+This file is part of Fish Tracker.
+Copyright 2021, VTT Technical research centre of Finland Ltd.
+Developed by: Mikael Uimonen.
+
+Fish Tracker is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fish Tracker is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fish Tracker.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import time
+import numpy as np
+
+from sort import Sort, KalmanBoxTracker
+
+# Tracking engines selectable in TrackerParameters.engine.
+SORT_ENGINE = "sort"
+GNN_ENGINE = "gnn"
+TRACKING_ENGINES = (SORT_ENGINE, GNN_ENGINE)
+
+# Status values in the output of update (see Sort.update).
+GNN_STATUS = { "Tentative": 0, "Active": 1, "Lost": 1 }
+
+# Half of the box size of a GNN track before its size is known from a detection.
+DEFAULT_HALF_SIZE = 10
+
+def createTrackingEngine(engine, max_age, min_hits, search_radius):
+    """
+    Returns a tracker with the interface of Sort: update(boxes) returns the tracks of a frame
+    as an N x 9 array (bounding box, id, status, hit streak, detection index, search radius).
+    """
+    if engine == GNN_ENGINE:
+        return GNNTracker(max_age=max_age, min_hits=min_hits, search_radius=search_radius)
+    if engine != SORT_ENGINE:
+        raise ValueError(f"Unknown tracking engine: {engine}")
+    return Sort(max_age=max_age, min_hits=min_hits, search_radius=search_radius)
+
+class GNNTracker:
+    """
+    Runs the global nearest neighbour tracker in experimental_tracker behind the interface of Sort.
+    Tracks are given ids from KalmanBoxTracker.count when they are created, like in Sort.
+    The box of a track is the box of the detection it was updated with. In frames without a
+    detection, the box of the latest detection is moved to the predicted position.
+    """
+    def __init__(self, max_age=1, min_hits=3, search_radius=10):
+        # Requires filterpy, which is only needed when this engine is used.
+        from experimental_tracker.tracker import Tracker as ExperimentalTracker
+
+        self.tracker = ExperimentalTracker(max_age=max_age, min_hits=min_hits, search_radius=search_radius)
+        self.search_radius = search_radius
+
+        # Track -> id
+        self.ids = {}
+        # Track -> half of the box size of the latest detection
+        self.half_sizes = {}
+        self.timings = { "update": 0.0 }
+
+    def reset_timings(self):
+        self.timings = { "update": 0.0 }
+
+    def get_timings(self):
+        return dict(self.timings)
+
+    def update(self, detz=np.empty((0, 4))):
+        t = time.perf_counter()
+
+        dets = np.empty((0, 2))
+        if len(detz) > 0:
+            dets = np.empty((len(detz), 2))
+            dets[:, 0] = detz[:, 0] + (detz[:, 2] - detz[:, 0]) / 2.0
+            dets[:, 1] = detz[:, 1] + (detz[:, 3] - detz[:, 1]) / 2.0
+
+        self.tracker.update(dets)
+        tracks = self.tracker.tracks
+
+        ret = np.empty((len(tracks), 9))
+        for i, track in enumerate(tracks):
+            if track not in self.ids:
+                self.ids[track] = KalmanBoxTracker.next_id()
+                # Trajectories are not used by the application.
+                track.save_history = False
+            ind = track.detection_index
+            if ind >= 0:
+                ret[i, 0:4] = detz[ind, 0:4]
+                self.half_sizes[track] = (detz[ind, 2:4] - detz[ind, 0:2]) / 2.0
+            else:
+                position = track.last_position
+                half_size = self.half_sizes.get(track, DEFAULT_HALF_SIZE)
+                ret[i, 0:2] = position - half_size
+                ret[i, 2:4] = position + half_size
+            ret[i, 4] = self.ids[track]
+            ret[i, 5] = GNN_STATUS[track.status]
+            ret[i, 6] = track.consecutive_updates
+            ret[i, 7] = track.detection_index
+            ret[i, 8] = self.search_radius
+
+        # Forget the removed tracks
+        if len(self.ids) > len(tracks):
+            self.ids = { track: self.ids[track] for track in tracks }
+            self.half_sizes = { track: self.half_sizes[track] for track in tracks if track in self.half_sizes }
+
+        self.timings["update"] += time.perf_counter() - t
+        if len(tracks) > 0:
+            return ret
+        return np.empty((0, 9))
@@ -78,6 +78,32 @@ class UserPreferencesDialog(QtWidgets.QDialog):
         sh_tooltip = "Determines the image height used in the SonarViewer. This affects the speed of the analysis and the obtained results."
         self.sonar_height_line = addLine("Sonar image height\t\t", sh_tooltip, val, QtGui.QIntValidator(100, 10000), [fun], self.form_layout)
 
+        #"detection_processes": 1,
+        self.detection_processes_slider = setupSlider("Detection processes", "Number of processes used when detecting all frames. 1: Detection is run in a single process.",
+                                          self.form_layout, fh.ConfKeys.detection_processes, 1, 16)
+        self.tracking_processes_slider = setupSlider("Tracking processes", "Number of processes used when tracking long files. 1: Tracking is run in a single process.",
+                                          self.form_layout, fh.ConfKeys.tracking_processes, 1, 16)
+
+        #"compiled_tracking": false,
+        self.check_compiled_tracking = setupCheckbox("Compiled tracking", "If checked, SORT tracking is run with a compiled tracker core, which is faster for long files.",
+                                                self.form_layout, fh.ConfKeys.compiled_tracking)
+
+        #"mask_cache_memory_limit": 1024,
+        val = fh.getConfValue(fh.ConfKeys.mask_cache_memory_limit)
+        fun = lambda x: fh.setConfValue(fh.ConfKeys.mask_cache_memory_limit, x)
+        mc_tooltip = "Memory (MB) used to cache background subtraction results, so that detection can be rerun faster when only detector parameters change."
+        self.mask_cache_line = addLine("Mask cache size (MB)", mc_tooltip, val, QtGui.QIntValidator(0, 1000000), [fun], self.form_layout)
+
+        #"mask_cache_on_disk": false,
+        self.check_mask_cache_disk = setupCheckbox("Cache masks on disk", "If checked, background subtraction results that do not fit in the mask cache are stored in a temporary file.",
+                                              self.form_layout, fh.ConfKeys.mask_cache_on_disk)
+
+        #"bg_model_cache_limit": 512,
+        val = fh.getConfValue(fh.ConfKeys.bg_model_cache_limit)
+        fun = lambda x: fh.setConfValue(fh.ConfKeys.bg_model_cache_limit, x)
+        bc_tooltip = "Disk space (MB) used to store trained background models (percentile and gaussian) and the training frames of MOG2 models, so that reopening a file does not require reading the training frames again. 0: Disabled."
+        self.bg_model_cache_line = addLine("Background model cache (MB)", bc_tooltip, val, QtGui.QIntValidator(0, 1000000), [fun], self.form_layout)
+
         #"save_as_binary": false,
         self.check_binary = setupCheckbox("Save as binary", "If checked, saves the results in binary format to save space.",
                                               self.form_layout, fh.ConfKeys.save_as_binary)